@@ -0,0 +1,170 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+#
+# asyncio flavour of NRF24 (Python 3 only).
+#
+# SPI transfers take microseconds and stay plain calls. What blocks in NRF24, waiting
+# for TX_DS, MAX_RT or a received payload, becomes a coroutine here: it awaits the IRQ
+# line (RPi.GPIO edge detection, through a future set from the GPIO thread) or short
+# timer sleeps, so the event loop keeps running other tasks meanwhile.
+#
+#     radio = AsyncNRF24(GPIO, spidev.SpiDev())
+#     radio.begin(0, 25, 24)
+#     ok = await radio.write(buf)
+#     if await radio.wait_available(timeout=0.5):
+#         radio.read_into(rx_buf)
+
+
+import asyncio
+import time
+
+from lib_nrf24 import NRF24, _BV
+
+
+class AsyncNRF24(NRF24):
+    # Sleep between checks when there is no IRQ line, or no edge detection on it
+    poll_interval = 0.0005
+
+    def __init__(self, gpio, spidev):
+        NRF24.__init__(self, gpio, spidev)
+        self.irq_event = None #*< Set from the GPIO thread on each IRQ falling edge.
+        self.irq_loop = None
+
+    def _irq_edge(self, channel):
+        # Runs in the RPi.GPIO callback thread
+        self.irq_loop.call_soon_threadsafe(self.irq_event.set)
+
+    def _watch_irq(self):
+        # Edge detection is set up on first use, from the running event loop
+        if self.irq_event is None:
+            self.irq_event = asyncio.Event()
+            self.irq_loop = asyncio.get_event_loop()
+            if hasattr(self.GPIO, "add_event_detect"):
+                self.GPIO.add_event_detect(self.irq_pin, self.GPIO.FALLING,
+                                           callback=self._irq_edge)
+            else:
+                self.irq_event = False
+        return self.irq_event
+
+    def end(self):
+        if self.irq_event and hasattr(self.GPIO, "remove_event_detect"):
+            self.GPIO.remove_event_detect(self.irq_pin)
+        self.irq_event = None
+        NRF24.end(self)
+
+    async def wait_for_event(self, timeout):
+        # Await RX_DR, TX_DS or MAX_RT, or timeout (s). Returns True if an event is
+        # pending. The STATUS flags are left untouched.
+        deadline = time.time() + timeout
+        if not self.irq_pin:
+            # No IRQ line, poll STATUS
+            while not self.get_status() & (_BV(NRF24.RX_DR) | _BV(NRF24.TX_DS) | _BV(NRF24.MAX_RT)):
+                if time.time() > deadline:
+                    return False
+                await asyncio.sleep(self.poll_interval)
+            return True
+
+        irq_event = self._watch_irq()
+        while True:
+            if irq_event:
+                # Clear before reading the level: an edge falling in between sets it again
+                irq_event.clear()
+            # IRQ is a level: it stays low as long as a flag is set
+            if self.GPIO.input(self.irq_pin) == self.GPIO.LOW:
+                return True
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return False
+            if irq_event:
+                try:
+                    await asyncio.wait_for(irq_event.wait(), remaining)
+                except asyncio.TimeoutError:
+                    pass
+            else:
+                await asyncio.sleep(min(remaining, self.poll_interval))
+
+    async def write(self, buf):
+        # Send a payload and await its ACK. Returns True if it was acknowledged.
+        self.startWrite(buf)
+        await self.wait_for_event(self.getMaxTimeout())
+        return self.write_result()
+
+    async def tx_standby(self, timeout=None):
+        # Await the payloads queued by write_fast(), see NRF24.tx_standby().
+        queued = self.tx_queued
+        if timeout is None:
+            timeout = self.getMaxTimeout() * max(queued, 1)
+        deadline = time.time() + timeout
+
+        acked = self._tx_progress(queued, deadline)
+        while acked is None:
+            if self.irq_pin:
+                # TX_DS would hold IRQ low: clear it before waiting on the line
+                self.write_register(NRF24.STATUS, _BV(NRF24.TX_DS))
+                await self.wait_for_event(deadline - time.time())
+            else:
+                await asyncio.sleep(self.poll_interval)
+            acked = self._tx_progress(queued, deadline)
+        return self._tx_standby_end(queued, acked)
+
+    async def wait_available(self, pipe_num=None, timeout=0.5):
+        # Await a payload in the RX FIFO. Returns available(pipe_num), False on timeout.
+        deadline = time.time() + timeout
+        while not self.available(pipe_num):
+            remaining = deadline - time.time()
+            if remaining <= 0 or not await self.wait_for_event(remaining):
+                return False
+        return True
+
+
+# SELF TEST (if script is executed directly)
+if __name__ == '__main__':
+    from nrf24_emulator import Air, EmulatedGPIO
+
+    air = Air(loss=0.1, seed=1)
+    GPIO = EmulatedGPIO(air)
+    GPIO.add_chip(0, 25, 24)
+    GPIO.add_chip(1, 22, 23)
+    pipes = [[0xF0, 0xF0, 0xF0, 0xF0, 0xE1], [0xF0, 0xF0, 0xF0, 0xF0, 0xD2]]
+
+    radios = []
+    for csn_pin, ce_pin, irq_pin in [(0, 25, 24), (1, 22, 23)]:
+        radio = AsyncNRF24(GPIO, GPIO.SpiDev())
+        radio.begin(csn_pin, ce_pin, irq_pin)
+        radio.setRetries(4, 15)
+        radio.setChannel(0x4C)
+        radio.enableDynamicPayloads()
+        radios.append(radio)
+    sender, receiver = radios
+    sender.openWritingPipe(pipes[0])
+    receiver.openReadingPipe(1, pipes[0])
+    receiver.startListening()
+
+    async def send(num_packets):
+        num_ok = 0
+        for n in range(num_packets):
+            num_ok += bool(await sender.write(bytearray([0xA9, n])))
+        return num_ok
+
+    async def receive(num_packets):
+        num_received = 0
+        rx_buf = bytearray(32)
+        while num_received < num_packets and await receiver.wait_available([0], 0.5):
+            receiver.read_into(rx_buf, receiver.getDynamicPayloadSize())
+            num_received += 1
+        return num_received
+
+    async def ticks(task):
+        # Runs while the radios wait
+        num_ticks = 0
+        while not task.done():
+            num_ticks += 1
+            await asyncio.sleep(0.001)
+        return num_ticks
+
+    async def main():
+        sending = asyncio.ensure_future(send(50))
+        results = await asyncio.gather(sending, receive(50), ticks(sending))
+        print("Acknowledged: %d, received: %d, other task ran %d times meanwhile." % tuple(results))
+
+    asyncio.run(main())
@@ -26,6 +26,22 @@
 
 import sys
 import time
+import os
+import struct
+import ctypes
+import json
+
+from nrf24_timing import Timing
+try:
+    import fcntl
+except ImportError:
+    # No ioctl (eg virtGPIO on a PC): transactions fall back to one xfer2 per frame
+    fcntl = None
+try:
+    import spidev
+except ImportError:
+    # Not on a Pi (virtGPIO, emulator)
+    spidev = None
 
 if __name__ == '__main__':
     print (sys.argv[0], 'is an importable module:')
@@ -38,6 +54,68 @@ def _BV(x):
     return 1 << x
 
 
+# struct spi_ioc_transfer from linux/spi/spidev.h: tx_buf, rx_buf, len, speed_hz,
+# delay_usecs, bits_per_word, cs_change, tx_nbits, rx_nbits, word_delay_usecs, pad
+SPI_IOC_TRANSFER = "=QQIIHBBBBBB"
+
+def read_spi_profile(path, bus, device):
+    # SPI clock rate (Hz) recorded for /dev/spidev<bus>.<device> by spi_calibration.py,
+    # None if the file or the device entry is missing
+    try:
+        with open(path) as profile_file:
+            profile = json.load(profile_file)
+    except (IOError, OSError, ValueError):
+        return None
+    entry = profile.get("spidev%d.%d" % (bus, device))
+    if not entry:
+        return None
+    return entry.get("max_speed_hz")
+
+def write_spi_profile(path, bus, device, speed_hz, details=None):
+    # Record the SPI clock rate of a device, keeping the entries of the other devices
+    try:
+        with open(path) as profile_file:
+            profile = json.load(profile_file)
+    except (IOError, OSError, ValueError):
+        profile = {}
+    entry = {"max_speed_hz": speed_hz}
+    if details:
+        entry.update(details)
+    profile["spidev%d.%d" % (bus, device)] = entry
+    with open(path, "w") as profile_file:
+        json.dump(profile, profile_file, indent=2, sort_keys=True)
+
+
+def SPI_IOC_MESSAGE(n):
+    # _IOW(SPI_IOC_MAGIC, 0, char[SPI_MSGSIZE(n)])
+    return (1 << 30) | ((n * struct.calcsize(SPI_IOC_TRANSFER)) << 16) | (ord('k') << 8)
+
+def spi_ioc_message(fd, frames, speed_hz):
+    # Clock several frames in a single ioctl, CSN going high between them like it does
+    # between xfer2 calls. Returns the list of the bytes received for each frame.
+    lengths = [len(frame) for frame in frames]
+    tx = ctypes.create_string_buffer(bytes(bytearray(byte for frame in frames for byte in frame)),
+                                     sum(lengths))
+    rx = ctypes.create_string_buffer(sum(lengths))
+    transfers = []
+    offset = 0
+    for n, length in enumerate(lengths):
+        cs_change = 1 if n < len(frames) - 1 else 0
+        transfers.append(struct.pack(SPI_IOC_TRANSFER,
+                                     ctypes.addressof(tx) + offset, ctypes.addressof(rx) + offset,
+                                     length, speed_hz, 0, 8, cs_change, 0, 0, 0, 0))
+        offset += length
+    fcntl.ioctl(fd, SPI_IOC_MESSAGE(len(frames)), b"".join(transfers))
+
+    data = bytearray(rx.raw)
+    responses = []
+    offset = 0
+    for length in lengths:
+        responses.append(list(data[offset:offset + length]))
+        offset += length
+    return responses
+
+
 class NRF24:
     MAX_CHANNEL = 127
     MAX_PAYLOAD_SIZE = 32
@@ -177,6 +255,18 @@ class NRF24:
     child_payload_size = [RX_PW_P0, RX_PW_P1, RX_PW_P2, RX_PW_P3, RX_PW_P4, RX_PW_P5]
     child_pipe_enable = [ERX_P0, ERX_P1, ERX_P2, ERX_P3, ERX_P4, ERX_P5]
 
+    # Zeros used to pad fixed size payloads
+    blank_payload = bytearray(MAX_PAYLOAD_SIZE)
+
+    # Registers the chip updates by itself: never served from the shadow copy
+    volatile_registers = [STATUS, OBSERVE_TX, CD, FIFO_STATUS]
+    # Configuration registers reloaded by resync()
+    config_registers = [CONFIG, EN_AA, EN_RXADDR, SETUP_AW, SETUP_RETR, RF_CH, RF_SETUP,
+                        RX_PW_P0, RX_PW_P1, RX_PW_P2, RX_PW_P3, RX_PW_P4, RX_PW_P5, DYNPD, FEATURE]
+
+    # SPI clock rates found reliable by spi_calibration.py on this host, loaded by begin()
+    SPI_PROFILE = os.path.join(os.path.expanduser("~"), ".nrf24_spi_profile.json")
+
     GPIO = None
     spidev = None
 
@@ -195,6 +285,20 @@ class NRF24:
         self.dynamic_payloads_enabled = False #*< Whether dynamic payloads are enabled.
         self.ack_payload_length = 5 #*< Dynamic size of pending ack payload.
         self.pipe0_reading_address = None #*< Last address set on pipe 0 for reading.
+        self.shadow = {} #*< Write-through copy of the single byte configuration registers.
+        self.irq_pin = 0 #*< GPIO wired to the active low IRQ output, 0 if not connected.
+        self.last_status = 0x0E #*< Last STATUS seen when checking or clearing its flags.
+        # Preallocated SPI frames for the payload commands
+        self.tx_buffer = bytearray(1 + NRF24.MAX_PAYLOAD_SIZE)
+        self.tx_buffer[0] = NRF24.W_TX_PAYLOAD
+        self.rx_request = [NRF24.R_RX_PAYLOAD] + [NRF24.NOP] * NRF24.MAX_PAYLOAD_SIZE
+        self.tx_queued = 0 #*< Payloads queued by write_fast() since the last tx_standby().
+        self.tx_streaming = False #*< CE held high by write_fast().
+        self.spi_fd = None #*< spidev file descriptor for multi-frame ioctls, None if unavailable.
+        self.spi_profile = NRF24.SPI_PROFILE #*< SPI clock profile file, None to keep the spidev default.
+        self.timing = Timing() #*< Microsecond delays, calibrated by begin().
+        self.csn_pin = 0
+        self.spi_fd_owned = False
 
     def ce(self, level):
         if self.ce_pin == 0:
@@ -217,11 +321,21 @@ class NRF24:
 
         resp = self.spidev.xfer2(buf)
         if blen == 1:
+            if reg not in NRF24.volatile_registers:
+                self.shadow[reg] = resp[1]
             return resp[1]
 
         return resp[1:blen + 1]
 
     def write_register(self, reg, value, length=-1):
+        status = self.spidev.xfer2(self._register_frame(reg, value, length))[0]
+        if reg == NRF24.STATUS:
+            # Flags are being cleared: remember whether the RX FIFO still holds data
+            self.last_status = status
+        return status
+
+    def _register_frame(self, reg, value, length=-1):
+        # W_REGISTER frame, recorded in the shadow copy
         buf = [NRF24.W_REGISTER | ( NRF24.REGISTER_MASK & reg )]
         ###if isinstance(value, (int, long)):   # ng for python3. but value should never be long anyway
         if isinstance(value, int):
@@ -242,15 +356,86 @@ class NRF24:
         else:
             raise Exception("Value must be int or list")
 
-        return self.spidev.xfer2(buf)[0]
-
+        if len(buf) == 2 and reg not in NRF24.volatile_registers:
+            self.shadow[reg] = buf[1]
+        return buf
+
+    def write_config(self, value):
+        # CONFIG is rewritten before every transfer: skip the SPI write when the
+        # shadow copy shows the chip already has this value
+        if self.shadow.get(NRF24.CONFIG) != value & 0xff:
+            self.write_register(NRF24.CONFIG, value)
+
+    def read_register_cached(self, reg):
+        # Configuration registers only change when we write them, so the shadow copy
+        # saves the read half of every read-modify-write. The chip is only read
+        # the first time a register is accessed (or after resync()).
+        if reg not in self.shadow:
+            return self.read_register(reg)
+        return self.shadow[reg]
+
+    def resync(self):
+        # Reload the shadow copy from the chip, eg after a brown-out may have reset it
+        self.shadow = {}
+        for reg in NRF24.config_registers:
+            self.read_register(reg)
+        self.channel = self.shadow[NRF24.RF_CH]
+
+
+    def transaction(self):
+        # Queue several SPI frames and send them in one go, see SpiTransaction
+        return SpiTransaction(self)
+
+    def spi_message(self, frames):
+        # Send frames (one CSN low..high each) and return their responses, with a
+        # single SPI_IOC_MESSAGE ioctl when the SPI device allows it
+        if len(frames) == 1:
+            return [self.spidev.xfer2(frames[0])]
+        if hasattr(self.spidev, "xfer_many"):
+            # Emulated SPI
+            return self.spidev.xfer_many(frames)
+        if self.spi_fd is not None:
+            return spi_ioc_message(self.spi_fd, frames, self.spidev.max_speed_hz)
+        return [self.spidev.xfer2(frame) for frame in frames]
+
+    def _open_spi_fd(self, bus, device):
+        # File descriptor of the spidev device, for ioctls of our own. Only the spidev
+        # module talks to /dev/spidev*: virtGPIO and others keep one xfer2 per frame.
+        # The C type of spidev.SpiDev has no module prefix, so __module__ would not
+        # tell it apart.
+        self.spi_fd = None
+        self.spi_fd_owned = False
+        if fcntl is None:
+            return
+        if hasattr(self.spidev, "fileno"):
+            self.spi_fd = self.spidev.fileno()
+            return
+        if spidev is None or not isinstance(self.spidev, spidev.SpiDev):
+            return
+        path = "/dev/spidev%d.%d" % (bus, device)
+        if os.path.exists(path):
+            self.spi_fd = os.open(path, os.O_RDWR)
+            self.spi_fd_owned = True
 
     def write_payload(self, buf):
+        return self.spidev.xfer2(self._payload_frame(buf))
+
+    def _payload_frame(self, buf):
+        # W_TX_PAYLOAD frame, padded to the payload size unless dynamic
         data_len = min(self.payload_size, len(buf))
         blank_len = 0
         if not self.dynamic_payloads_enabled:
             blank_len = self.payload_size - data_len
 
+        if isinstance(buf, (bytes, bytearray, memoryview)):
+            # Fast path: copy the bytes in the preallocated frame, no per-byte work
+            buf_len = min(len(buf), NRF24.MAX_PAYLOAD_SIZE)
+            txbuffer = self.tx_buffer
+            txbuffer[1:buf_len + 1] = buf[:buf_len]
+            if blank_len != 0:
+                txbuffer[buf_len + 1:buf_len + blank_len + 1] = NRF24.blank_payload[:blank_len]
+            return list(txbuffer[:buf_len + blank_len + 1])
+
         txbuffer = [NRF24.W_TX_PAYLOAD]
         for n in buf:
             t = type(n)
@@ -262,25 +447,35 @@ class NRF24:
                 raise Exception("Only ints and chars are supported: Found " + str(t))
 
         if blank_len != 0:
-            blank = [0x00 for i in range(blank_len)]
-            txbuffer.extend(blank)
+            txbuffer.extend(NRF24.blank_payload[:blank_len])
 
-        return self.spidev.xfer2(txbuffer)
+        return txbuffer
 
     def read_payload(self, buf, buf_len=-1):
+        # buf is either a list (emptied then extended) or a bytearray / writable
+        # memoryview, which is filled in place
+        frame, data_len = self._payload_request(buf_len)
+        return self._payload_copy(buf, self.spidev.xfer2(frame), data_len)
+
+    def _payload_request(self, buf_len):
+        # R_RX_PAYLOAD frame and the number of payload bytes it will bring
         if buf_len < 0:
             buf_len = self.payload_size
-        data_len = min(self.payload_size, buf_len)
         blank_len = 0
-        if not self.dynamic_payloads_enabled:
+        if self.dynamic_payloads_enabled:
+            # Payload width is the sender's, up to 32 bytes
+            data_len = min(NRF24.MAX_PAYLOAD_SIZE, buf_len)
+        else:
+            data_len = min(self.payload_size, buf_len)
             blank_len = self.payload_size - data_len
+        return self.rx_request[:blank_len + data_len + 1], data_len
 
-        txbuffer = [NRF24.NOP for i in range(0, blank_len + data_len + 1)]
-        txbuffer[0] = NRF24.R_RX_PAYLOAD
-
-        payload = self.spidev.xfer2(txbuffer)
-        del buf[:]
-        buf.extend(payload[1:data_len + 1])
+    def _payload_copy(self, buf, payload, data_len):
+        if isinstance(buf, list):
+            del buf[:]
+            buf.extend(payload[1:data_len + 1])
+        else:
+            buf[:data_len] = bytearray(payload[1:data_len + 1])
         return data_len
 
     def flush_rx(self):
@@ -337,7 +532,7 @@ class NRF24:
         self.write_register(NRF24.RF_CH, self.channel)
 
     def getChannel(self):
-        return self.read_register(NRF24.RF_CH)
+        return self.read_register_cached(NRF24.RF_CH)
 
     def setPayloadSize(self, size):
         self.payload_size = min(max(size, 1), NRF24.MAX_PAYLOAD_SIZE)
@@ -365,18 +560,31 @@ class NRF24:
         print ("CRC Length\t = %s" % NRF24.crclength_e_str_P[self.getCRCLength()])
         print ("PA Power\t = %s" % NRF24.pa_dbm_e_str_P[self.getPALevel()])
 
-    def begin(self, csn_pin, ce_pin=0):   # csn & ce are RF24 terminology. csn = SPI's CE!
+    def begin(self, csn_pin, ce_pin=0, irq_pin=0):   # csn & ce are RF24 terminology. csn = SPI's CE!
         # Initialize SPI bus..
         # ce_pin is for the rx=listen or tx=trigger pin on RF24 (they call that ce !!!)
         # CE optional (at least in some circumstances, eg fixed PTX PRX roles, no powerdown)
         # CE seems to hold itself as (sufficiently) HIGH, but tie HIGH is safer!
+        # irq_pin is optional too. When wired, waits sleep on the IRQ line (RPi.GPIO edge
+        # detection) instead of polling STATUS over SPI.
         self.spidev.open(0, csn_pin)
+        self._open_spi_fd(0, csn_pin)
+        self.load_spi_profile(0, csn_pin)
+        self.csn_pin = csn_pin
         self.ce_pin = ce_pin
+        self.irq_pin = irq_pin
+        # Whatever we knew about the registers is stale now
+        self.shadow = {}
 
         if ce_pin:
             self.GPIO.setup(self.ce_pin, self.GPIO.OUT)
 
-        time.sleep(5 / 1000000.0)
+        if irq_pin:
+            self.GPIO.setup(self.irq_pin, self.GPIO.IN, pull_up_down=self.GPIO.PUD_UP)
+
+        # Measure the scheduler's sleep overshoot once, delays then spin for what it can't do
+        self.timing.calibrate()
+        self.timing.delay(5 / 1000000.0)
 
         # Set 1500uS (minimum for 32B payload in ESB@250KBPS) timeouts, to make testing a little easier
         # WARNING: If this is ever lowered, either 250KBS mode with AA is broken or maximum packet
@@ -400,52 +608,70 @@ class NRF24:
         # Initialize CRC and request 2-byte (16bit) CRC
         self.setCRCLength(NRF24.CRC_16)
 
+        t = self.transaction()
         # Disable dynamic payloads, to match dynamic_payloads_enabled setting
-        self.write_register(NRF24.DYNPD, 0)
+        t.write_register(NRF24.DYNPD, 0)
 
         # Reset current status
         # Notice reset and flush is the last thing we do
-        self.write_register(NRF24.STATUS, _BV(NRF24.RX_DR) | _BV(NRF24.TX_DS) | _BV(NRF24.MAX_RT))
+        t.write_register(NRF24.STATUS, _BV(NRF24.RX_DR) | _BV(NRF24.TX_DS) | _BV(NRF24.MAX_RT))
 
         # Set up default configuration.  Callers can always change it later.
         # This channel should be universally safe and not bleed over into adjacent
         # spectrum.
-        self.setChannel(self.channel)
+        self.channel = min(max(0, self.channel), NRF24.MAX_CHANNEL)
+        t.write_register(NRF24.RF_CH, self.channel)
 
         # Flush buffers
-        self.flush_rx()
-        self.flush_tx()
+        t.command([NRF24.FLUSH_RX])
+        t.command([NRF24.FLUSH_TX])
+        t.submit()
+
+    def load_spi_profile(self, bus, device):
+        # Clock the SPI at the fastest rate spi_calibration.py found reliable for this
+        # device. Without a profile, spidev keeps the kernel default rate.
+        speed_hz = None
+        if self.spi_profile:
+            speed_hz = read_spi_profile(self.spi_profile, bus, device)
+        if speed_hz:
+            self.spidev.max_speed_hz = speed_hz
+        return speed_hz
 
     def end(self):
+        if self.spi_fd_owned:
+            os.close(self.spi_fd)
+        self.spi_fd = None
+        self.spi_fd_owned = False
         if self.spidev:
             self.spidev.close()
             self.spidev = None
 
     def startListening(self):
-        self.write_register(NRF24.CONFIG, self.read_register(NRF24.CONFIG) | _BV(NRF24.PWR_UP) | _BV(NRF24.PRIM_RX))
-        self.write_register(NRF24.STATUS, _BV(NRF24.RX_DR) | _BV(NRF24.TX_DS) | _BV(NRF24.MAX_RT))
+        t = self.transaction()
+        t.write_config(self.read_register_cached(NRF24.CONFIG) | _BV(NRF24.PWR_UP) | _BV(NRF24.PRIM_RX))
+        t.write_register(NRF24.STATUS, _BV(NRF24.RX_DR) | _BV(NRF24.TX_DS) | _BV(NRF24.MAX_RT))
 
         # Restore the pipe0 address, if exists
         if self.pipe0_reading_address:
-            self.write_register(self.RX_ADDR_P0, self.pipe0_reading_address, 5)
+            t.write_register(self.RX_ADDR_P0, self.pipe0_reading_address, 5)
+        t.submit()
 
         # Go!
         self.ce(NRF24.HIGH)
 
         # wait for the radio to come up (130us actually only needed)
-        time.sleep(130 / 1000000.0)
+        self.timing.delay(130 / 1000000.0, "rx_settle")
 
     def stopListening(self):
         self.ce(NRF24.LOW)
-        self.flush_tx()
-        self.flush_rx()
+        self.spi_message([[NRF24.FLUSH_TX], [NRF24.FLUSH_RX]])
 
     def powerDown(self):
-        self.write_register(NRF24.CONFIG, self.read_register(NRF24.CONFIG) & ~_BV(NRF24.PWR_UP))
+        self.write_config(self.read_register_cached(NRF24.CONFIG) & ~_BV(NRF24.PWR_UP))
 
     def powerUp(self):
-        self.write_register(NRF24.CONFIG, self.read_register(NRF24.CONFIG) | _BV(NRF24.PWR_UP))
-        time.sleep(150 / 1000000.0)
+        self.write_config(self.read_register_cached(NRF24.CONFIG) | _BV(NRF24.PWR_UP))
+        self.timing.delay(150 / 1000000.0, "power_up")
 
     def write(self, buf):
         # Begin the write
@@ -454,47 +680,167 @@ class NRF24:
         timeout = self.getMaxTimeout() #s to wait for timeout
         sent_at = time.time()
 
-        while True:
-            #status = self.read_register(NRF24.OBSERVE_TX, 1)
-            status = self.get_status()
-            if (status & (_BV(NRF24.TX_DS) | _BV(NRF24.MAX_RT))) or (time.time() - sent_at > timeout ):
-                break
-            time.sleep(10 / 1000000.0)
+        if self.irq_pin:
+            # TX_DS or MAX_RT will pull IRQ low, no need to poll
+            self.wait_for_event(timeout)
+        else:
+            while True:
+                #status = self.read_register(NRF24.OBSERVE_TX, 1)
+                status = self.get_status()
+                if (status & (_BV(NRF24.TX_DS) | _BV(NRF24.MAX_RT))) or (time.time() - sent_at > timeout ):
+                    break
+                self.timing.poll(10 / 1000000.0)
         #obs = self.read_register(NRF24.OBSERVE_TX)
         #self.print_observe_tx(obs)
         #self.print_status(status)
         # (for debugging)
 
-        what = self.whatHappened()
-
-        result = what['tx_ok']
-        if what['tx_fail']:
+        return self.write_result()
+
+    def write_result(self):
+        # Collect the outcome of the payload started by startWrite(), once TX_DS or
+        # MAX_RT is up or the wait timed out. Returns True if it was acknowledged.
+        # With ack payloads, clearing the flags and reading the width of a possible
+        # ack payload share one SPI message.
+        t = self.transaction()
+        t.write_register(NRF24.STATUS, _BV(NRF24.RX_DR) | _BV(NRF24.TX_DS) | _BV(NRF24.MAX_RT))
+        width = None
+        if self.shadow.get(NRF24.FEATURE, 0) & _BV(NRF24.EN_ACK_PAY):
+            width = t.command([NRF24.R_RX_PL_WID, NRF24.NOP])
+        responses = t.submit()
+        status = responses[0][0]
+
+        result = status & _BV(NRF24.TX_DS)
+        if status & _BV(NRF24.MAX_RT):
             self.flush_tx();    # bl  - dont jam up the fifo
         # Handle the ack packet
-        if what['rx_ready']:
-            self.ack_payload_length = self.getDynamicPayloadSize()
+        if status & _BV(NRF24.RX_DR):
+            if width is None:
+                self.ack_payload_length = self.getDynamicPayloadSize()
+            else:
+                self.ack_payload_length = responses[width][1]
             self.ack_payload_available = True              ## bl
 
         return result
 
     def startWrite(self, buf):
+        t = self.transaction()
         # Transmitter power-up
-        self.write_register(NRF24.CONFIG, (self.read_register(NRF24.CONFIG) | _BV(NRF24.PWR_UP) ) & ~_BV(NRF24.PRIM_RX))
+        t.write_config((self.read_register_cached(NRF24.CONFIG) | _BV(NRF24.PWR_UP) ) & ~_BV(NRF24.PRIM_RX))
 
         # Send the payload
-        self.write_payload(buf)
+        t.command(self._payload_frame(buf))
+        t.submit()
 
         # Allons!
         if self.ce_pin:
             if self.GPIO.RPI_REVISION > 0:
                 self.ce(self.GPIO.HIGH)
-                time.sleep(10 / 1000000.0)
+                self.timing.delay(10 / 1000000.0, "ce_pulse")
                 self.ce(self.GPIO.LOW)
             else:
                 # virtGPIO is slower. A 10 uSec pulse is better done with pulseOut():
                 self.GPIO.pulseOut(self.ce_pin, self.GPIO.HIGH, 10)
 
-
+    def write_fast(self, buf):
+        # Queue a payload in the 3-deep TX FIFO and return without waiting for its ACK.
+        # CE stays high so queued payloads go out back to back. Returns False if the
+        # FIFO was full: the payload was dropped, call tx_standby() to drain the FIFO.
+        self.write_config((self.read_register_cached(NRF24.CONFIG) | _BV(NRF24.PWR_UP) ) & ~_BV(NRF24.PRIM_RX))
+
+        # The STATUS clocked out with the command tells if the FIFO had room
+        if self.write_payload(buf)[0] & _BV(NRF24.TX_FULL):
+            return False
+        self.tx_queued += 1
+
+        if not self.tx_streaming:
+            self.ce(NRF24.HIGH)
+            self.tx_streaming = True
+        return True
+
+    def tx_standby(self, timeout=None):
+        # Wait until the payloads queued by write_fast() are sent, then leave CE low.
+        # Returns one boolean per queued payload, in order, True if it was acknowledged.
+        # The radio stops on the first payload reaching MAX_RT: it fails along with the
+        # ones queued behind it, which are flushed. On timeout (s, default is the worst
+        # case retry time of every queued payload) nothing can be confirmed, all fail.
+        queued = self.tx_queued
+        if timeout is None:
+            timeout = self.getMaxTimeout() * max(queued, 1)
+        deadline = time.time() + timeout
+
+        acked = self._tx_progress(queued, deadline)
+        while acked is None:
+            if self.irq_pin:
+                # TX_DS would hold IRQ low: clear it before sleeping on the line
+                self.write_register(NRF24.STATUS, _BV(NRF24.TX_DS))
+                self.wait_for_event(deadline - time.time())
+            else:
+                self.timing.poll(10 / 1000000.0)
+            acked = self._tx_progress(queued, deadline)
+        return self._tx_standby_end(queued, acked)
+
+    def _tx_progress(self, queued, deadline):
+        # Number of the queued payloads acknowledged once the radio is done with them,
+        # None while it is still sending.
+        if not queued:
+            return 0
+        # One transfer returns both STATUS and FIFO_STATUS
+        status, fifo = self.spidev.xfer2([NRF24.R_REGISTER | NRF24.FIFO_STATUS, NRF24.NOP])[0:2]
+        if fifo & _BV(NRF24.TX_EMPTY):
+            return queued
+        if status & _BV(NRF24.MAX_RT):
+            return queued - self._tx_fifo_depth(fifo)
+        if time.time() > deadline:
+            return 0
+        return None
+
+    def _tx_standby_end(self, queued, acked):
+        self.ce(NRF24.LOW)
+        self.tx_streaming = False
+        self.tx_queued = 0
+        if acked < queued:
+            # Flush before clearing MAX_RT, which would resume the transmission
+            self.flush_tx()
+        self.write_register(NRF24.STATUS, _BV(NRF24.TX_DS) | _BV(NRF24.MAX_RT))
+
+        return [True] * acked + [False] * (queued - acked)
+
+    def _tx_fifo_depth(self, fifo):
+        # Payloads left in the TX FIFO. FIFO_STATUS only flags empty and full, so
+        # between the two a dummy payload is queued: if it fills the FIFO, two were
+        # waiting. Only valid while MAX_RT is set, as the radio won't transmit then.
+        if fifo & _BV(NRF24.TX_EMPTY):
+            return 0
+        if fifo & _BV(NRF24.FIFO_FULL):
+            return 3
+        self.spidev.xfer2([NRF24.W_TX_PAYLOAD, 0x00])
+        if self.get_status() & _BV(NRF24.TX_FULL):
+            return 2
+        return 1
+
+    def wait_for_event(self, timeout):
+        # Block until the radio raises RX_DR, TX_DS or MAX_RT, or until timeout (s).
+        # Returns True if an event is pending. The STATUS flags are left untouched.
+        deadline = time.time() + timeout
+        if not self.irq_pin:
+            # No IRQ line, poll STATUS
+            while not self.get_status() & (_BV(NRF24.RX_DR) | _BV(NRF24.TX_DS) | _BV(NRF24.MAX_RT)):
+                if time.time() > deadline:
+                    return False
+                self.timing.poll(10 / 1000000.0)
+            return True
+
+        # IRQ is a level: it stays low as long as a flag is set
+        while self.GPIO.input(self.irq_pin) != self.GPIO.LOW:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return False
+            # An edge falling between input() and wait_for_edge() is missed, so wait in
+            # short slices and check the level again
+            self.GPIO.wait_for_edge(self.irq_pin, self.GPIO.FALLING,
+                                    timeout=max(1, int(min(remaining, 0.010) * 1000)))
+        return True
 
     def getDynamicPayloadSize(self):
         return self.spidev.xfer2([NRF24.R_RX_PL_WID, NRF24.NOP])[1]
@@ -503,7 +849,14 @@ class NRF24:
         if not pipe_num:
             pipe_num = []
 
+        # IRQ high means no new flag since the last call. If the RX FIFO was empty
+        # then, it still is: answer without touching the SPI bus.
+        if self.irq_pin and self.GPIO.input(self.irq_pin) == self.GPIO.HIGH and \
+           (self.last_status & 0b00001110) == 0b00001110:
+            return False
+
         status = self.get_status()
+        self.last_status = status
         result = False
 
         # Sometimes the radio specifies that there is data in one pipe but
@@ -520,20 +873,27 @@ class NRF24:
 
                 # ??? Should this REALLY be cleared now?  Or wait until we
                 # actually READ the payload?
-        self.write_register(NRF24.STATUS, _BV(NRF24.RX_DR))
-
-        # Handle ack payload receipt
-        if status & _BV(NRF24.TX_DS):
-            self.write_register(NRF24.STATUS, _BV(NRF24.TX_DS))
+        # Handle ack payload receipt: TX_DS is cleared by the same write
+        self.write_register(NRF24.STATUS, _BV(NRF24.RX_DR) | (status & _BV(NRF24.TX_DS)))
 
         return result
 
     def read(self, buf, buf_len=-1):
-        # Fetch the payload
-        self.read_payload(buf, buf_len)
+        # Fetch the payload, and FIFO_STATUS in the same SPI message
+        frame, data_len = self._payload_request(buf_len)
+        responses = self.spi_message([frame, [NRF24.R_REGISTER | NRF24.FIFO_STATUS, NRF24.NOP]])
+        self._payload_copy(buf, responses[0], data_len)
 
         # was this the last of the data available?
-        return self.read_register(NRF24.FIFO_STATUS) & _BV(NRF24.RX_EMPTY)
+        return responses[1][1] & _BV(NRF24.RX_EMPTY)
+
+    def read_into(self, buf, buf_len=-1):
+        # Fill a bytearray / writable memoryview with the next payload and return its
+        # length. Unlike read(), FIFO_STATUS is not fetched: available() tells whether
+        # more payloads are waiting.
+        if buf_len < 0:
+            buf_len = len(buf)
+        return self.read_payload(buf, buf_len)
 
     def whatHappened(self):
         # Read the status & reset the status in one easy call
@@ -550,10 +910,12 @@ class NRF24:
         # Note that the NRF24L01(+)
         # expects its LSB first.
 
-        self.write_register(NRF24.RX_ADDR_P0, value, 5)
-        self.write_register(NRF24.TX_ADDR, value, 5)
+        t = self.transaction()
+        t.write_register(NRF24.RX_ADDR_P0, value, 5)
+        t.write_register(NRF24.TX_ADDR, value, 5)
 
-        self.write_register(NRF24.RX_PW_P0, min(self.payload_size, NRF24.MAX_PAYLOAD_SIZE))
+        t.write_register(NRF24.RX_PW_P0, min(self.payload_size, NRF24.MAX_PAYLOAD_SIZE))
+        t.submit()
 
     def openReadingPipe(self, child, address):
         # If this is pipe 0, cache the address.  This is needed because
@@ -563,24 +925,26 @@ class NRF24:
             self.pipe0_reading_address = address
 
         if child <= 6:
+            t = self.transaction()
             # For pipes 2-5, only write the LSB
             if child < 2:
-                self.write_register(NRF24.child_pipe[child], address, 5)
+                t.write_register(NRF24.child_pipe[child], address, 5)
             else:
-                self.write_register(NRF24.child_pipe[child], address, 1)
+                t.write_register(NRF24.child_pipe[child], address, 1)
 
-            self.write_register(NRF24.child_payload_size[child], self.payload_size)
+            t.write_register(NRF24.child_payload_size[child], self.payload_size)
 
             # Note it would be more efficient to set all of the bits for all open
             # pipes at once.  However, I thought it would make the calling code
             # more simple to do it this way.
-            self.write_register(NRF24.EN_RXADDR,
-                                self.read_register(NRF24.EN_RXADDR) | _BV(NRF24.child_pipe_enable[child]))
+            t.write_register(NRF24.EN_RXADDR,
+                             self.read_register_cached(NRF24.EN_RXADDR) | _BV(NRF24.child_pipe_enable[child]))
+            t.submit()
 
 
     def closeReadingPipe(self, pipe):
         self.write_register(NRF24.EN_RXADDR,
-            self.read_register(EN_RXADDR) & ~_BV(NRF24.child_pipe_enable[pipe]))
+            self.read_register_cached(NRF24.EN_RXADDR) & ~_BV(NRF24.child_pipe_enable[pipe]))
 
 
     def toggle_features(self):
@@ -589,19 +953,19 @@ class NRF24:
 
     def enableDynamicPayloads(self):
         # Enable dynamic payload throughout the system
-        self.write_register(NRF24.FEATURE, self.read_register(NRF24.FEATURE) | _BV(NRF24.EN_DPL))
+        self.write_register(NRF24.FEATURE, self.read_register_cached(NRF24.FEATURE) | _BV(NRF24.EN_DPL))
 
         # If it didn't work, the features are not enabled
         if not self.read_register(NRF24.FEATURE):
             # So enable them and try again
             self.toggle_features()
-            self.write_register(NRF24.FEATURE, self.read_register(NRF24.FEATURE) | _BV(NRF24.EN_DPL))
+            self.write_register(NRF24.FEATURE, self.read_register_cached(NRF24.FEATURE) | _BV(NRF24.EN_DPL))
 
         # Enable dynamic payload on all pipes
 
         # Not sure the use case of only having dynamic payload on certain
         # pipes, so the library does not support it.
-        self.write_register(NRF24.DYNPD, self.read_register(NRF24.DYNPD) | _BV(NRF24.DPL_P5) | _BV(NRF24.DPL_P4) | _BV(
+        self.write_register(NRF24.DYNPD, self.read_register_cached(NRF24.DYNPD) | _BV(NRF24.DPL_P5) | _BV(NRF24.DPL_P4) | _BV(
             NRF24.DPL_P3) | _BV(NRF24.DPL_P2) | _BV(NRF24.DPL_P1) | _BV(NRF24.DPL_P0))
 
         self.dynamic_payloads_enabled = True
@@ -610,17 +974,17 @@ class NRF24:
     def enableAckPayload(self):
         # enable ack payload and dynamic payload features
         self.write_register(NRF24.FEATURE,
-                            self.read_register(NRF24.FEATURE) | _BV(NRF24.EN_ACK_PAY) | _BV(NRF24.EN_DPL))
+                            self.read_register_cached(NRF24.FEATURE) | _BV(NRF24.EN_ACK_PAY) | _BV(NRF24.EN_DPL))
 
         # If it didn't work, the features are not enabled
         if not self.read_register(NRF24.FEATURE):
             # So enable them and try again
             self.toggle_features()
             self.write_register(NRF24.FEATURE,
-                                self.read_register(NRF24.FEATURE) | _BV(NRF24.EN_ACK_PAY) | _BV(NRF24.EN_DPL))
+                                self.read_register_cached(NRF24.FEATURE) | _BV(NRF24.EN_ACK_PAY) | _BV(NRF24.EN_DPL))
 
         # Enable dynamic payload on pipes 0 & 1
-        self.write_register(NRF24.DYNPD, self.read_register(NRF24.DYNPD) | _BV(NRF24.DPL_P1) | _BV(NRF24.DPL_P0))
+        self.write_register(NRF24.DYNPD, self.read_register_cached(NRF24.DYNPD) | _BV(NRF24.DPL_P1) | _BV(NRF24.DPL_P0))
 
     def writeAckPayload(self, pipe, buf, buf_len):
         txbuffer = [NRF24.W_ACK_PAYLOAD | ( pipe & 0x7 )]
@@ -647,7 +1011,7 @@ class NRF24:
 
     def setAutoAckPipe(self, pipe, enable):
         if pipe <= 6:
-            en_aa = self.read_register(NRF24.EN_AA)
+            en_aa = self.read_register_cached(NRF24.EN_AA)
             if enable:
                 en_aa |= _BV(pipe)
             else:
@@ -662,7 +1026,7 @@ class NRF24:
         return self.read_register(NRF24.RPD) & 1
 
     def setPALevel(self, level):
-        setup = self.read_register(NRF24.RF_SETUP)
+        setup = self.read_register_cached(NRF24.RF_SETUP)
         setup &= ~( _BV(NRF24.RF_PWR_LOW) | _BV(NRF24.RF_PWR_HIGH))
         # switch uses RAM (evil!)
         if level == NRF24.PA_MAX:
@@ -681,7 +1045,7 @@ class NRF24:
 
 
     def getPALevel(self):
-        power = self.read_register(NRF24.RF_SETUP) & (_BV(NRF24.RF_PWR_LOW) | _BV(NRF24.RF_PWR_HIGH))
+        power = self.read_register_cached(NRF24.RF_SETUP) & (_BV(NRF24.RF_PWR_LOW) | _BV(NRF24.RF_PWR_HIGH))
 
         if power == (_BV(NRF24.RF_PWR_LOW) | _BV(NRF24.RF_PWR_HIGH)):
             return NRF24.PA_MAX
@@ -694,7 +1058,7 @@ class NRF24:
 
     def setDataRate(self, speed):
         result = False
-        setup = self.read_register(NRF24.RF_SETUP)
+        setup = self.read_register_cached(NRF24.RF_SETUP)
 
         # HIGH and LOW '00' is 1Mbs - our default
         self.wide_band = False
@@ -725,7 +1089,7 @@ class NRF24:
         return result
 
     def getDataRate(self):
-        dr = self.read_register(NRF24.RF_SETUP) & (_BV(NRF24.RF_DR_LOW) | _BV(NRF24.RF_DR_HIGH))
+        dr = self.read_register_cached(NRF24.RF_SETUP) & (_BV(NRF24.RF_DR_LOW) | _BV(NRF24.RF_DR_HIGH))
         # Order matters in our case below
         if dr == _BV(NRF24.RF_DR_LOW):
             # '10' = 250KBPS
@@ -739,7 +1103,7 @@ class NRF24:
 
 
     def setCRCLength(self, length):
-        config = self.read_register(NRF24.CONFIG) & ~( _BV(NRF24.CRC_16) | _BV(NRF24.CRC_ENABLED))
+        config = self.read_register_cached(NRF24.CONFIG) & ~( _BV(NRF24.CRC_16) | _BV(NRF24.CRC_ENABLED))
 
         if length == NRF24.CRC_DISABLED:
             # Do nothing, we turned it off above.
@@ -756,7 +1120,7 @@ class NRF24:
 
     def getCRCLength(self):
         result = NRF24.CRC_DISABLED
-        config = self.read_register(NRF24.CONFIG) & ( _BV(NRF24.CRCO) | _BV(NRF24.EN_CRC))
+        config = self.read_register_cached(NRF24.CONFIG) & ( _BV(NRF24.CRCO) | _BV(NRF24.EN_CRC))
 
         if config & _BV(NRF24.EN_CRC):
             if config & _BV(NRF24.CRCO):
@@ -767,7 +1131,7 @@ class NRF24:
         return result
 
     def disableCRC(self):
-        disable = self.read_register(NRF24.CONFIG) & ~_BV(NRF24.EN_CRC)
+        disable = self.read_register_cached(NRF24.CONFIG) & ~_BV(NRF24.EN_CRC)
         self.write_register(NRF24.CONFIG, disable)
 
     def setRetries(self, delay, count):
@@ -776,7 +1140,7 @@ class NRF24:
         self.write_register(NRF24.SETUP_RETR, (delay & 0xf) << NRF24.ARD | (count & 0xf))
 
     def getRetries(self):
-        return self.read_register(NRF24.SETUP_RETR)
+        return self.read_register_cached(NRF24.SETUP_RETR)
 
     def getMaxTimeout(self):        # seconds
         retries = self.getRetries()
@@ -784,3 +1148,56 @@ class NRF24:
         # Fudged up to about double Barraca's calculation
         # Was too short & was timeing out wrongly.    BL
         return tout
+
+
+class SpiTransaction:
+    # Several register operations sent to the radio in one SPI_IOC_MESSAGE ioctl, instead
+    # of one ioctl per xfer2. Each queuing method returns the index of its frame in the
+    # list of responses returned by submit(). The shadow copy is kept up to date.
+    #
+    #     t = radio.transaction()
+    #     t.write_register(NRF24.STATUS, _BV(NRF24.RX_DR))
+    #     fifo = t.read_register(NRF24.FIFO_STATUS)
+    #     responses = t.submit()
+    #     print (responses[fifo][1])
+
+    def __init__(self, radio):
+        self.radio = radio
+        self.frames = []
+        self.status_writes = []
+        self.reads = []
+
+    def command(self, frame):
+        self.frames.append(list(frame))
+        return len(self.frames) - 1
+
+    def read_register(self, reg, blen=1):
+        index = self.command([NRF24.R_REGISTER | ( NRF24.REGISTER_MASK & reg )] + [NRF24.NOP] * blen)
+        if blen == 1 and reg not in NRF24.volatile_registers:
+            self.reads.append((index, reg))
+        return index
+
+    def write_register(self, reg, value, length=-1):
+        index = self.command(self.radio._register_frame(reg, value, length))
+        if reg == NRF24.STATUS:
+            self.status_writes.append(index)
+        return index
+
+    def write_config(self, value):
+        # Like NRF24.write_config(): nothing queued if CONFIG already has this value
+        if self.radio.shadow.get(NRF24.CONFIG) != value & 0xff:
+            return self.write_register(NRF24.CONFIG, value)
+        return None
+
+    def submit(self):
+        if not self.frames:
+            return []
+        responses = self.radio.spi_message(self.frames)
+        for index, reg in self.reads:
+            self.radio.shadow[reg] = responses[index][1]
+        if self.status_writes:
+            self.radio.last_status = responses[self.status_writes[-1]][0]
+        self.frames = []
+        self.status_writes = []
+        self.reads = []
+        return responses
@@ -0,0 +1,680 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Register level emulation of the nRF24L01+, to run lib_nrf24 without hardware.
+#
+# EmulatedGPIO stands for both the RPi.GPIO module and the board wiring, and hands
+# out EmulatedSpiDev objects the same way virtGPIO does:
+#
+#     air = Air(loss=0.1)
+#     GPIO = EmulatedGPIO(air)
+#     GPIO.add_chip(csn_pin=0, ce_pin=25, irq_pin=24)
+#     radio = NRF24(GPIO, GPIO.SpiDev())
+#     radio.begin(0, 25, 24)
+#
+# Each chip emulates the register map, the 3-deep TX and RX FIFOs, STATUS flags and
+# the IRQ line, auto-ack with ack payloads, retransmits and MAX_RT. Chips sharing an
+# Air exchange packets when channel, data rate and address match, and every packet
+# or ACK is lost with the configured probability. Timing (PLL settling, airtime,
+# retransmit delay) follows the datasheet and runs on the wall clock, so driver
+# polling and timeouts behave as on a Pi.
+
+
+import heapq
+import random
+import time
+
+
+def _BV(x):
+    return 1 << x
+
+
+class Air():
+    """ Shared radio medium: event queue on the wall clock, loss model and counters."""
+    def __init__(self, loss=0.0, seed=None, clock=time.time):
+        self.loss = loss
+        self.random = random.Random(seed)
+        self.clock = clock
+        self.chips = []
+        self.events = []
+        self.num_events = 0
+        self.stats = {"packets": 0, "packets_lost": 0, "acks": 0, "acks_lost": 0}
+
+    def schedule(self, when, callback, *args):
+        self.num_events += 1
+        heapq.heappush(self.events, (when, self.num_events, callback, args))
+
+    def advance(self):
+        # Run every event due by now, in time order. Callbacks get the event time so
+        # that what they schedule does not drift with Python overhead.
+        now = self.clock()
+        while self.events and self.events[0][0] <= now:
+            when, num, callback, args = heapq.heappop(self.events)
+            callback(when, *args)
+
+    def lost(self):
+        return self.loss > 0 and self.random.random() < self.loss
+
+    def deliver(self, sender, when, payload, no_ack, pid):
+        # Offer a packet to every other chip. Returns the ACK payload (a list, empty
+        # for a plain ACK) from the receiver that acknowledged it, None if no ACK.
+        self.stats["packets"] += 1
+        if self.lost():
+            self.stats["packets_lost"] += 1
+            return None
+        ack = None
+        for chip in self.chips:
+            if chip is not sender:
+                reply = chip.receive(when, sender, payload, no_ack, pid)
+                if reply is not None and ack is None:
+                    ack = reply
+        if ack is not None:
+            self.stats["acks"] += 1
+            if self.lost():
+                self.stats["acks_lost"] += 1
+                return None
+        return ack
+
+
+class EmulatedChip():
+    """ One nRF24L01+: registers, FIFOs and the enhanced shockburst state machine."""
+    # Registers
+    CONFIG = 0x00
+    EN_AA = 0x01
+    EN_RXADDR = 0x02
+    SETUP_AW = 0x03
+    SETUP_RETR = 0x04
+    RF_CH = 0x05
+    RF_SETUP = 0x06
+    STATUS = 0x07
+    OBSERVE_TX = 0x08
+    RPD = 0x09
+    RX_ADDR_P0 = 0x0A
+    RX_ADDR_P1 = 0x0B
+    TX_ADDR = 0x10
+    RX_PW_P0 = 0x11
+    FIFO_STATUS = 0x17
+    DYNPD = 0x1C
+    FEATURE = 0x1D
+
+    # Instructions
+    R_RX_PL_WID = 0x60
+    R_RX_PAYLOAD = 0x61
+    W_TX_PAYLOAD = 0xA0
+    W_ACK_PAYLOAD = 0xA8
+    W_TX_PAYLOAD_NOACK = 0xB0
+    FLUSH_TX = 0xE1
+    FLUSH_RX = 0xE2
+    REUSE_TX_PL = 0xE3
+    ACTIVATE = 0x50
+    NOP = 0xFF
+
+    # Bits
+    PWR_UP = 1
+    PRIM_RX = 0
+    RX_DR = 6
+    TX_DS = 5
+    MAX_RT = 4
+    MASK_RX_DR = 6
+    MASK_TX_DS = 5
+    MASK_MAX_RT = 4
+    EN_CRC = 3
+    CRCO = 2
+    RF_DR_LOW = 5
+    RF_DR_HIGH = 3
+    EN_DPL = 2
+    EN_ACK_PAY = 1
+    EN_DYN_ACK = 0
+
+    # Timing (s)
+    T_SETTLE = 130e-6   # Standby to TX or RX
+    T_ARD_STEP = 250e-6 # Auto retransmit delay unit
+
+    FIFO_DEPTH = 3
+    address_registers = [RX_ADDR_P0, RX_ADDR_P1, TX_ADDR]
+
+    def __init__(self, air, name=""):
+        self.air = air
+        self.name = name
+        self.ce = 0
+        self.reset()
+        air.chips.append(self)
+
+    def reset(self):
+        # Power on reset values from the datasheet
+        self.regs = [0] * 0x20
+        self.regs[self.CONFIG] = 0x08
+        self.regs[self.EN_AA] = 0x3F
+        self.regs[self.EN_RXADDR] = 0x03
+        self.regs[self.SETUP_AW] = 0x03
+        self.regs[self.SETUP_RETR] = 0x03
+        self.regs[self.RF_CH] = 0x02
+        self.regs[self.RF_SETUP] = 0x0E
+        for pipe in range(2, 6):
+            self.regs[self.RX_ADDR_P0 + pipe] = 0xC1 + pipe
+        self.addresses = {self.RX_ADDR_P0: [0xE7] * 5,
+                          self.RX_ADDR_P1: [0xC2] * 5,
+                          self.TX_ADDR: [0xE7] * 5}
+        self.flags = 0
+        self.arc_cnt = 0
+        self.plos_cnt = 0
+        self.tx_fifo = []   # [payload, no_ack, ack_pipe]
+        self.rx_fifo = []   # [pipe, payload]
+        self.tx_reuse = False
+        self.transmitting = False
+        self.tx_generation = 0
+        self.rx_since = None
+        self.pid = 0
+        self.last_received = {}
+        self.spi_transfers = 0
+
+    # Derived state
+    def powered(self):
+        return self.regs[self.CONFIG] & _BV(self.PWR_UP)
+
+    def primary_rx(self):
+        return self.regs[self.CONFIG] & _BV(self.PRIM_RX)
+
+    def address_width(self):
+        return max(1, self.regs[self.SETUP_AW] & 0x03) + 2
+
+    def data_rate(self):
+        setup = self.regs[self.RF_SETUP]
+        if setup & _BV(self.RF_DR_LOW):
+            return 250000
+        if setup & _BV(self.RF_DR_HIGH):
+            return 2000000
+        return 1000000
+
+    def crc_length(self):
+        config = self.regs[self.CONFIG]
+        if not config & _BV(self.EN_CRC):
+            return 0
+        return 2 if config & _BV(self.CRCO) else 1
+
+    def dynamic_payload(self, pipe):
+        return self.regs[self.FEATURE] & _BV(self.EN_DPL) and self.regs[self.DYNPD] & _BV(pipe)
+
+    def airtime(self, payload_len):
+        # Preamble, address, 9 bit packet control field, payload and CRC
+        bits = 8 * (1 + self.address_width() + payload_len + self.crc_length()) + 9
+        return bits / float(self.data_rate())
+
+    def retransmit_delay(self):
+        return ((self.regs[self.SETUP_RETR] >> 4) + 1) * self.T_ARD_STEP
+
+    def pipe_address(self, pipe):
+        width = self.address_width()
+        if pipe < 2:
+            return self.addresses[self.RX_ADDR_P0 + pipe][:width]
+        # Pipes 2-5 only differ from pipe 1 by their LSB
+        return [self.regs[self.RX_ADDR_P0 + pipe]] + self.addresses[self.RX_ADDR_P1][1:width]
+
+    def status(self):
+        status = self.flags
+        if self.rx_fifo:
+            status |= self.rx_fifo[0][0] << 1
+        else:
+            status |= 0x0E
+        if len(self.tx_fifo) >= self.FIFO_DEPTH:
+            status |= 1
+        return status
+
+    def fifo_status(self):
+        value = 0
+        if self.tx_reuse:
+            value |= _BV(6)
+        if len(self.tx_fifo) >= self.FIFO_DEPTH:
+            value |= _BV(5)
+        if not self.tx_fifo:
+            value |= _BV(4)
+        if len(self.rx_fifo) >= self.FIFO_DEPTH:
+            value |= _BV(1)
+        if not self.rx_fifo:
+            value |= _BV(0)
+        return value
+
+    def irq(self):
+        # Active low, asserted by any unmasked flag
+        pending = self.flags & ~self.regs[self.CONFIG] & (_BV(self.RX_DR) | _BV(self.TX_DS) | _BV(self.MAX_RT))
+        return 0 if pending else 1
+
+    # SPI
+    def xfer(self, buf):
+        # One CSN low..high frame: command byte then data, returns what MISO clocked out
+        self.air.advance()
+        self.spi_transfers += 1
+        cmd = buf[0]
+        data = list(buf[1:])
+        resp = [self.status()]
+
+        if cmd < 0x20:
+            resp.extend(self.read_register(cmd & 0x1F, len(data)))
+        elif cmd < 0x40:
+            self.write_register(cmd & 0x1F, data)
+            resp.extend([0] * len(data))
+        elif cmd == self.R_RX_PAYLOAD:
+            payload = []
+            if self.rx_fifo:
+                payload = self.rx_fifo.pop(0)[1]
+            resp.extend((payload + [0] * len(data))[:len(data)])
+        elif cmd == self.R_RX_PL_WID:
+            width = len(self.rx_fifo[0][1]) if self.rx_fifo else 0
+            resp.extend([width] + [0] * (len(data) - 1))
+        elif cmd in (self.W_TX_PAYLOAD, self.W_TX_PAYLOAD_NOACK):
+            no_ack = cmd == self.W_TX_PAYLOAD_NOACK and self.regs[self.FEATURE] & _BV(self.EN_DYN_ACK)
+            self.queue_tx([payload & 0xFF for payload in data[:32]], no_ack, None)
+            resp.extend([0] * len(data))
+        elif cmd & 0xF8 == self.W_ACK_PAYLOAD:
+            if self.regs[self.FEATURE] & _BV(self.EN_ACK_PAY):
+                self.queue_tx([payload & 0xFF for payload in data[:32]], False, cmd & 0x07)
+            resp.extend([0] * len(data))
+        elif cmd == self.FLUSH_TX:
+            self.tx_fifo = []
+            self.tx_reuse = False
+            self.stop_tx()
+        elif cmd == self.FLUSH_RX:
+            self.rx_fifo = []
+        elif cmd == self.REUSE_TX_PL:
+            self.tx_reuse = True
+        else:
+            # ACTIVATE is a no-op on the + variant, NOP only returns STATUS
+            resp.extend([0] * len(data))
+        return resp
+
+    def read_register(self, reg, length):
+        if reg in self.address_registers:
+            values = list(self.addresses[reg])
+        elif reg == self.STATUS:
+            values = [self.status()]
+        elif reg == self.OBSERVE_TX:
+            values = [(self.plos_cnt << 4) | self.arc_cnt]
+        elif reg == self.FIFO_STATUS:
+            values = [self.fifo_status()]
+        else:
+            values = [self.regs[reg]]
+        return (values + [0] * length)[:length]
+
+    def write_register(self, reg, data):
+        if not data:
+            return
+        if reg in self.address_registers:
+            self.addresses[reg] = (data + self.addresses[reg][len(data):])[:5]
+        elif reg == self.STATUS:
+            # Write 1 to clear
+            cleared = data[0] & (_BV(self.RX_DR) | _BV(self.TX_DS) | _BV(self.MAX_RT))
+            resume = cleared & self.flags & _BV(self.MAX_RT)
+            self.flags &= ~cleared
+            if resume:
+                self.update_mode()
+        elif reg in (self.OBSERVE_TX, self.RPD, self.FIFO_STATUS):
+            pass
+        elif reg == self.RF_CH:
+            self.regs[reg] = data[0] & 0x7F
+            self.plos_cnt = 0
+        else:
+            self.regs[reg] = data[0] & 0xFF
+            if reg == self.CONFIG:
+                if not self.powered():
+                    self.stop_tx()
+                self.update_mode()
+
+    # Pins
+    def set_ce(self, level):
+        self.air.advance()
+        self.ce = level
+        self.update_mode()
+
+    def update_mode(self):
+        now = self.air.clock()
+        if self.powered() and self.primary_rx() and self.ce:
+            if self.rx_since is None:
+                self.rx_since = now + self.T_SETTLE
+        else:
+            self.rx_since = None
+        if self.powered() and not self.primary_rx() and self.ce:
+            self.start_tx(now + self.T_SETTLE)
+
+    # Transmitter
+    def queue_tx(self, payload, no_ack, ack_pipe):
+        if len(self.tx_fifo) >= self.FIFO_DEPTH:
+            return
+        self.tx_fifo.append([payload, no_ack, ack_pipe])
+        self.tx_reuse = False
+        if ack_pipe is None and self.powered() and not self.primary_rx() and self.ce:
+            self.start_tx(self.air.clock() + self.T_SETTLE)
+
+    def stop_tx(self):
+        # Pending events of the current transmission become stale
+        self.transmitting = False
+        self.tx_generation += 1
+
+    def start_tx(self, when):
+        if self.transmitting or self.flags & _BV(self.MAX_RT):
+            return
+        if not self.tx_fifo or self.tx_fifo[0][2] is not None:
+            return
+        self.transmitting = True
+        self.arc_cnt = 0
+        self.pid = (self.pid + 1) & 0x03
+        self.air.schedule(when + self.airtime(len(self.tx_fifo[0][0])),
+                          self.tx_done, self.tx_generation)
+
+    def tx_done(self, when, generation):
+        if generation != self.tx_generation or not self.tx_fifo:
+            return
+        payload, no_ack, ack_pipe = self.tx_fifo[0]
+        ack = self.air.deliver(self, when, payload, no_ack, self.pid)
+
+        if no_ack or not self.regs[self.EN_AA] & 1:
+            # No ACK expected
+            self.air.schedule(when, self.tx_acked, generation, None)
+            return
+        if ack is not None and self.addresses[self.RX_ADDR_P0] == self.addresses[self.TX_ADDR]:
+            ack_time = when + self.T_SETTLE + self.airtime(len(ack))
+            self.air.schedule(ack_time, self.tx_acked, generation, ack)
+        else:
+            self.air.schedule(when + self.retransmit_delay(), self.tx_retry, generation)
+
+    def tx_acked(self, when, generation, ack):
+        if generation != self.tx_generation:
+            return
+        self.flags |= _BV(self.TX_DS)
+        if not self.tx_reuse:
+            self.tx_fifo.pop(0)
+        if ack:
+            if len(self.rx_fifo) < self.FIFO_DEPTH:
+                self.rx_fifo.append([0, ack])
+                self.flags |= _BV(self.RX_DR)
+        self.transmitting = False
+        # Standby-II: keep sending while CE is high
+        if self.ce and self.powered() and not self.primary_rx():
+            self.start_tx(when + self.T_SETTLE)
+
+    def tx_retry(self, when, generation):
+        if generation != self.tx_generation:
+            return
+        self.arc_cnt += 1
+        if self.arc_cnt > self.regs[self.SETUP_RETR] & 0x0F:
+            # Give up: the payload stays at the head of the FIFO until flushed
+            self.flags |= _BV(self.MAX_RT)
+            self.plos_cnt = min(15, self.plos_cnt + 1)
+            self.transmitting = False
+            return
+        self.air.schedule(when + self.airtime(len(self.tx_fifo[0][0])),
+                          self.tx_done, generation)
+
+    # Receiver
+    def receive(self, when, sender, payload, no_ack, pid):
+        # Returns the ACK payload (empty list for a plain ACK), None if not acknowledged
+        if self.rx_since is None or when < self.rx_since:
+            return None
+        if self.regs[self.RF_CH] != sender.regs[self.RF_CH] or \
+           self.data_rate() != sender.data_rate() or \
+           self.address_width() != sender.address_width():
+            return None
+        address = sender.addresses[self.TX_ADDR][:sender.address_width()]
+        pipe = None
+        for num in range(6):
+            if self.regs[self.EN_RXADDR] & _BV(num) and self.pipe_address(num) == address:
+                pipe = num
+                break
+        if pipe is None:
+            return None
+
+        if self.dynamic_payload(pipe):
+            data = list(payload)
+        else:
+            width = self.regs[self.RX_PW_P0 + pipe]
+            if width == 0:
+                return None
+            data = (list(payload) + [0] * width)[:width]
+
+        # A retransmit of a packet already received is acknowledged, not stored again
+        duplicate = self.last_received.get(id(sender)) == (pid, payload)
+        if not duplicate:
+            if len(self.rx_fifo) >= self.FIFO_DEPTH:
+                # No room: discarded, and not acknowledged
+                return None
+            self.rx_fifo.append([pipe, data])
+            self.flags |= _BV(self.RX_DR)
+            self.last_received[id(sender)] = (pid, payload)
+
+        if no_ack or not self.regs[self.EN_AA] & _BV(pipe):
+            return None
+        for entry in self.tx_fifo:
+            if entry[2] == pipe:
+                self.tx_fifo.remove(entry)
+                return entry[0]
+        return []
+
+
+class EmulatedSpiDev():
+    """ Stand-in for spidev.SpiDev, talking to the chip on the chosen chip select."""
+    def __init__(self, gpio):
+        self.gpio = gpio
+        self.chip = None
+        self.max_speed_hz = 500000
+        self.mode = 0
+        self.messages = 0   # ioctls a real spidev would have made
+        self.max_reliable_hz = None # Above this clock, received bits get corrupted
+        self.random = random.Random(0)
+
+    def open(self, bus, device):
+        self.chip = self.gpio.chips[device]
+
+    def close(self):
+        self.chip = None
+
+    def corrupt(self, resp):
+        # Emulate a clock too fast for the wiring: flip a bit now and then
+        if self.max_reliable_hz and self.max_speed_hz > self.max_reliable_hz and \
+           self.random.random() < 0.2:
+            resp[self.random.randrange(len(resp))] ^= 1 << self.random.randrange(8)
+        return resp
+
+    def xfer2(self, buf):
+        self.messages += 1
+        return self.corrupt(self.chip.xfer(buf))
+
+    xfer = xfer2
+
+    def xfer_many(self, frames):
+        # Counterpart of a SPI_IOC_MESSAGE ioctl: frames sent back to back, CSN going
+        # high between them
+        self.messages += 1
+        return [self.corrupt(self.chip.xfer(frame)) for frame in frames]
+
+
+class EmulatedGPIO():
+    """ Stand-in for the RPi.GPIO module, wired to emulated chips."""
+    BCM = 11
+    BOARD = 10
+    OUT = 0
+    IN = 1
+    LOW = 0
+    HIGH = 1
+    PUD_OFF = 20
+    PUD_DOWN = 21
+    PUD_UP = 22
+    RISING = 31
+    FALLING = 32
+    BOTH = 33
+    RPI_REVISION = 3
+
+    def __init__(self, air):
+        self.air = air
+        self.chips = {}
+        self.ce_pins = {}
+        self.irq_pins = {}
+        self.levels = {}
+
+    def add_chip(self, csn_pin, ce_pin=0, irq_pin=0, name=""):
+        chip = EmulatedChip(self.air, name)
+        self.chips[csn_pin] = chip
+        if ce_pin:
+            self.ce_pins[ce_pin] = chip
+        else:
+            # CE tied high
+            chip.ce = 1
+        if irq_pin:
+            self.irq_pins[irq_pin] = chip
+        return chip
+
+    def SpiDev(self):
+        return EmulatedSpiDev(self)
+
+    def setmode(self, mode):
+        pass
+
+    def setwarnings(self, flag):
+        pass
+
+    def setup(self, pin, direction, pull_up_down=None, initial=None):
+        pass
+
+    def cleanup(self):
+        pass
+
+    def output(self, pin, level):
+        self.levels[pin] = level
+        if pin in self.ce_pins:
+            self.ce_pins[pin].set_ce(level)
+
+    def input(self, pin):
+        if pin in self.irq_pins:
+            self.air.advance()
+            return self.irq_pins[pin].irq()
+        return self.levels.get(pin, self.LOW)
+
+    def wait_for_edge(self, pin, edge, timeout=None):
+        # Returns the pin when the level goes low, None on timeout (ms)
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout / 1000.0
+        while self.input(pin) != self.LOW:
+            if deadline is not None and time.time() > deadline:
+                return None
+            time.sleep(20 / 1000000.0)
+        return pin
+
+
+# SELF TEST (if script is executed directly)
+if __name__ == '__main__':
+    import sys
+    from lib_nrf24 import NRF24
+
+    loss = 0.1
+    if len(sys.argv) > 1:
+        loss = float(sys.argv[1])
+    num_packets = 200
+
+    air = Air(loss=loss, seed=1)
+    GPIO = EmulatedGPIO(air)
+    GPIO.add_chip(0, 25, 24, "server")
+    GPIO.add_chip(1, 22, 23, "commutator")
+    pipes = [[0xF0, 0xF0, 0xF0, 0xF0, 0xE1], [0xF0, 0xF0, 0xF0, 0xF0, 0xD2]]
+
+    radios = []
+    for csn_pin, ce_pin, irq_pin in [(0, 25, 24), (1, 22, 23)]:
+        radio = NRF24(GPIO, GPIO.SpiDev())
+        radio.begin(csn_pin, ce_pin, irq_pin)
+        radio.setRetries(4, 15)
+        radio.setPayloadSize(12)
+        radio.setChannel(0x4C)
+        radio.setAutoAck(True)
+        radio.enableDynamicPayloads()
+        radios.append(radio)
+    server, commutator = radios
+    server.openWritingPipe(pipes[0])
+    server.openReadingPipe(1, pipes[1])
+    commutator.openWritingPipe(pipes[1])
+    commutator.openReadingPipe(1, pipes[0])
+    commutator.startListening()
+
+    print("Sending %d packets with %d%% loss." % (num_packets, loss * 100))
+    num_ok = 0
+    num_received = 0
+    write_time = 0.0
+    spi_start = GPIO.chips[0].spi_transfers
+    messages_start = server.spidev.messages
+    for n in range(num_packets):
+        start = time.time()
+        if server.write(bytearray([0xA9, n & 0xFF])):
+            num_ok += 1
+        write_time += time.time() - start
+        rx_buf = []
+        while commutator.available([0]):
+            commutator.read(rx_buf, 2)
+            num_received += 1
+
+    print("Acknowledged: %d, received: %d" % (num_ok, num_received))
+    print("Mean write() time: %.3f ms, %.1f SPI transfers in %.1f ioctls per write()" %
+          (write_time / num_packets * 1000.0,
+           (GPIO.chips[0].spi_transfers - spi_start) / float(num_packets),
+           (server.spidev.messages - messages_start) / float(num_packets)))
+    print(air.stats)
+    for name, stats in sorted(server.timing.overshoot_stats().items()):
+        print("%s delay overshoot: mean %.1f us, max %.1f us" % (name, stats["mean_us"], stats["max_us"]))
+
+    # The same writes through the SPI_IOC_MESSAGE ioctl of a real spidev, played on
+    # the emulated chip by a stubbed fcntl.ioctl
+    import ctypes
+    import struct
+    import lib_nrf24
+
+    class FileSpiDev():
+        """ EmulatedSpiDev behind a file descriptor, as spidev.SpiDev."""
+        def __init__(self, spi):
+            self.spi = spi
+            self.max_speed_hz = spi.max_speed_hz
+            self.mode = 0
+
+        def open(self, bus, device):
+            self.spi.open(bus, device)
+
+        def close(self):
+            self.spi.close()
+
+        def fileno(self):
+            return 99
+
+        def xfer2(self, buf):
+            return self.spi.xfer2(buf)
+
+    class StubFcntl():
+        def __init__(self, spi):
+            self.spi = spi
+            self.ioctls = 0
+
+        def ioctl(self, fd, request, arg):
+            size = struct.calcsize(lib_nrf24.SPI_IOC_TRANSFER)
+            assert fd == 99 and request == lib_nrf24.SPI_IOC_MESSAGE(len(arg) // size)
+            self.ioctls += 1
+            for offset in range(0, len(arg), size):
+                tx, rx, length = struct.unpack(lib_nrf24.SPI_IOC_TRANSFER,
+                                               arg[offset:offset + size])[:3]
+                resp = self.spi.chip.xfer(list(bytearray(ctypes.string_at(tx, length))))
+                ctypes.memmove(rx, bytes(bytearray(resp)), length)
+
+    spi = FileSpiDev(GPIO.SpiDev())
+    stub = StubFcntl(spi.spi)
+    lib_nrf24.fcntl = stub
+    server = NRF24(GPIO, spi)
+    server.begin(0, 25, 24)
+    server.setRetries(4, 15)
+    server.setPayloadSize(12)
+    server.setChannel(0x4C)
+    server.setAutoAck(True)
+    server.enableDynamicPayloads()
+    # write() then clears STATUS and reads the ack payload width in one message
+    server.enableAckPayload()
+    server.openWritingPipe(pipes[0])
+    server.openReadingPipe(1, pipes[1])
+    num_ok = 0
+    for n in range(20):
+        if server.write(bytearray([0xA9, n & 0xFF])):
+            num_ok += 1
+        while commutator.available([0]):
+            commutator.read([], 2)
+    print("Through SPI_IOC_MESSAGE: acknowledged %d of 20, %d ioctls" % (num_ok, stub.ioctls))
@@ -0,0 +1,148 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Microsecond delays for lib_nrf24.
+#
+# time.sleep() of a few microseconds really sleeps for the scheduler's granularity,
+# typically 60-100+ us on a Pi, so the CE pulse, the settling delays and the polling
+# loops of the driver took far longer than the datasheet minimums. Timing spins on a
+# monotonic clock for short delays, and for longer ones sleeps for the part the
+# scheduler can be trusted with then spins for the rest. Only the CE pulse and the
+# settling delays spin: the polling loops use poll(), which always sleeps so that
+# other threads (another radio, the GIL on Python 2) get the CPU. The overshoot past
+# each requested delay is recorded per delay name.
+#
+#     timing = Timing()
+#     timing.calibrate()
+#     timing.delay(10e-6, "ce_pulse")
+#     print (timing.overshoot_stats())
+
+
+import time
+
+CLOCK_MONOTONIC = 1 # <time.h> on Linux
+
+
+def monotonic_clock():
+    # Monotonic high resolution clock: time.perf_counter() on Python 3, on Python 2
+    # clock_gettime(CLOCK_MONOTONIC) through ctypes. An NTP step of the wall clock
+    # would turn a spin into seconds. Returns the clock and whether it is monotonic.
+    if hasattr(time, "perf_counter"):
+        return time.perf_counter, True
+    try:
+        import ctypes
+        import ctypes.util
+
+        class timespec(ctypes.Structure):
+            _fields_ = [("tv_sec", ctypes.c_long), ("tv_nsec", ctypes.c_long)]
+
+        librt = ctypes.CDLL(ctypes.util.find_library("rt") or "librt.so.1")
+        clock_gettime = librt.clock_gettime
+        clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+
+        def clock():
+            now = timespec()
+            clock_gettime(CLOCK_MONOTONIC, ctypes.byref(now))
+            return now.tv_sec + now.tv_nsec * 1e-9
+
+        if clock_gettime(CLOCK_MONOTONIC, ctypes.byref(timespec())) == 0:
+            return clock, True
+    except (ImportError, OSError, AttributeError):
+        pass
+    return time.time, False
+
+clock, clock_is_monotonic = monotonic_clock()
+
+
+class Timing:
+    def __init__(self):
+        # Usual worst time.sleep() overshoot, measured by calibrate() (s). Delays up to
+        # 3 times this are spun entirely.
+        self.sleep_overshoot = 200e-6
+        self.stats = {} # name -> [count, total overshoot, max overshoot]
+
+    def calibrate(self, samples=20, sleep_len=100e-6):
+        # Measure how late time.sleep() wakes up on this host
+        overshoots = []
+        for n in range(samples):
+            start = clock()
+            time.sleep(sleep_len)
+            overshoots.append(clock() - start - sleep_len)
+        overshoots.sort()
+        # Ignore the worst 10%: a late wake-up only means spinning less
+        self.sleep_overshoot = max(0.0, overshoots[int(samples * 0.9) - 1])
+        return self.sleep_overshoot
+
+    def delay(self, seconds, name=None):
+        # Wait at least seconds, as close to it as possible
+        start = clock()
+        deadline = start + seconds
+        if seconds > 3 * self.sleep_overshoot:
+            # Leave the CPU for the part the scheduler gets right, with a margin as
+            # wake-ups are later under load
+            time.sleep(seconds - 2 * self.sleep_overshoot)
+        while True:
+            now = clock()
+            if now >= deadline:
+                break
+            if now < start:
+                # Wall clock stepped back (no monotonic clock): wait the requested
+                # duration with a plain sleep rather than spin until it catches up
+                time.sleep(seconds)
+                deadline = now
+                break
+        if name is not None:
+            self.record(name, clock() - deadline)
+
+    def poll(self, seconds, name=None):
+        # Wait between two polls of the radio STATUS or RX FIFO. Always sleeps, for
+        # the scheduler granularity at least, as a polling loop may last as long as
+        # a reply timeout
+        start = clock()
+        time.sleep(seconds)
+        if name is not None:
+            self.record(name, clock() - start - seconds)
+
+    def record(self, name, overshoot):
+        stats = self.stats.get(name)
+        if stats is None:
+            self.stats[name] = [1, overshoot, overshoot]
+        else:
+            stats[0] += 1
+            stats[1] += overshoot
+            if overshoot > stats[2]:
+                stats[2] = overshoot
+
+    def overshoot_stats(self):
+        # Number of delays, mean and max overshoot (us) for each delay name
+        result = {}
+        for name, (count, total, worst) in self.stats.items():
+            result[name] = {"count": count,
+                            "mean_us": total / count * 1e6,
+                            "max_us": worst * 1e6}
+        return result
+
+    def reset_stats(self):
+        self.stats = {}
+
+
+if __name__ == '__main__':
+    timing = Timing()
+    print ("clock: %s" % ("monotonic" if clock_is_monotonic else "wall clock"))
+    print ("time.sleep() overshoot: %.1f us" % (timing.calibrate() * 1e6))
+    for seconds, name in [(10e-6, "10 us"), (130e-6, "130 us"), (1.5e-3, "1.5 ms")]:
+        for n in range(200):
+            start = clock()
+            time.sleep(seconds)
+            timing.record("time.sleep " + name, clock() - start - seconds)
+            timing.delay(seconds, "delay " + name)
+    for name, stats in sorted(timing.overshoot_stats().items()):
+        print ("%-18s mean %8.1f us, max %8.1f us" % (name, stats["mean_us"], stats["max_us"]))
+
+    # A wall clock stepped back an hour during a delay must not stall it
+    monotonic = clock
+    offsets = [0.0, -3600.0]
+    clock = lambda: monotonic() + (offsets.pop(0) if len(offsets) > 1 else offsets[0])
+    start = monotonic()
+    timing.delay(10e-6)
+    print ("delay 10 us, clock stepped back: %.1f us" % ((monotonic() - start) * 1e6))
@@ -0,0 +1,190 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# SPI clock calibration and benchmark for the nRF24L01(+).
+#
+# spidev runs at the kernel default clock unless told otherwise. The chip accepts up to
+# 10 MHz, but what the wiring tolerates depends on the board and cables. calibrate_spi()
+# steps through the clock rates, checks register write/readback and payload transfers
+# at each one, and records the fastest reliable rate in the profile file NRF24.begin()
+# loads (NRF24.SPI_PROFILE).
+#
+#     python spi_calibration.py calibrate --csn 0 --ce 25
+#     python spi_calibration.py benchmark --csn 0 --ce 25
+#
+# --emulate runs both on the emulated radio of nrf24_emulator.py, without hardware.
+
+
+import random
+import time
+
+from lib_nrf24 import NRF24, _BV, write_spi_profile
+
+# nRF24L01(+) SPI clock is 10 MHz at most
+SPI_RATES = [250000, 500000, 1000000, 2000000, 4000000, 6000000, 8000000, 10000000]
+
+
+def check_spi_rate(radio, speed_hz, rounds=50):
+    # Exercise the SPI at speed_hz with random patterns. Returns True if every byte read
+    # back matched and the STATUS byte clocked out with each command stayed plausible.
+    # The chip can't give a TX payload back, so payload transfers are checked by the
+    # TX FIFO accepting exactly as many full size payloads as were sent.
+    # Radio registers are modified: call restore_radio() afterwards.
+    radio.spidev.max_speed_hz = speed_hz
+    xfer2 = radio.spidev.xfer2
+    pattern = random.Random(speed_hz)
+    for n in range(rounds):
+        # Single byte registers
+        for reg, mask in [(NRF24.RF_CH, 0x7F), (NRF24.SETUP_RETR, 0xFF)]:
+            value = pattern.randrange(256) & mask
+            status = xfer2([NRF24.W_REGISTER | reg, value])[0]
+            resp = xfer2([NRF24.R_REGISTER | reg, NRF24.NOP])
+            # STATUS bit 7 always reads 0
+            if resp[1] != value or status & 0x80 or resp[0] & 0x80:
+                return False
+
+        # 5 byte address register
+        address = [pattern.randrange(256) for i in range(5)]
+        xfer2([NRF24.W_REGISTER | NRF24.RX_ADDR_P1] + address)
+        if xfer2([NRF24.R_REGISTER | NRF24.RX_ADDR_P1] + [NRF24.NOP] * 5)[1:6] != address:
+            return False
+
+        # Full size payloads: the FIFO holds 3
+        xfer2([NRF24.FLUSH_TX])
+        for num_payloads in range(1, 4):
+            payload = [pattern.randrange(256) for i in range(NRF24.MAX_PAYLOAD_SIZE)]
+            xfer2([NRF24.W_TX_PAYLOAD] + payload)
+            fifo = xfer2([NRF24.R_REGISTER | NRF24.FIFO_STATUS, NRF24.NOP])[1]
+            if bool(fifo & _BV(NRF24.FIFO_FULL)) != (num_payloads == 3) or \
+               fifo & _BV(NRF24.TX_EMPTY):
+                return False
+        xfer2([NRF24.FLUSH_TX])
+        if not xfer2([NRF24.R_REGISTER | NRF24.FIFO_STATUS, NRF24.NOP])[1] & _BV(NRF24.TX_EMPTY):
+            return False
+    return True
+
+
+def prepare_radio(radio):
+    # Power down with CE low, so that test payloads are never transmitted. Returns what
+    # restore_radio() needs.
+    radio.ce(NRF24.LOW)
+    saved = {"speed_hz": radio.spidev.max_speed_hz,
+             "config": radio.read_register(NRF24.CONFIG),
+             "rx_addr_p1": radio.read_register(NRF24.RX_ADDR_P1, 5)}
+    radio.write_register(NRF24.CONFIG, saved["config"] & ~_BV(NRF24.PWR_UP))
+    return saved
+
+
+def restore_radio(radio, saved, speed_hz=None):
+    # Restore the registers modified by the checks, at speed_hz (default: the rate in use
+    # before prepare_radio())
+    if speed_hz is None:
+        speed_hz = saved["speed_hz"]
+    radio.spidev.max_speed_hz = speed_hz
+    radio.spidev.xfer2([NRF24.FLUSH_TX])
+    radio.spidev.xfer2([NRF24.W_REGISTER | NRF24.RX_ADDR_P1] + saved["rx_addr_p1"])
+    radio.spidev.xfer2([NRF24.W_REGISTER | NRF24.RF_CH, radio.shadow.get(NRF24.RF_CH, radio.channel)])
+    radio.spidev.xfer2([NRF24.W_REGISTER | NRF24.SETUP_RETR, radio.shadow.get(NRF24.SETUP_RETR, 0x4F)])
+    radio.spidev.xfer2([NRF24.W_REGISTER | NRF24.CONFIG, saved["config"]])
+    radio.resync()
+
+
+def calibrate_spi(radio, rates=SPI_RATES, rounds=50, profile=None):
+    # Check each rate, slowest first, and stop at the first failure: faster rates are not
+    # trusted even if they happen to pass. Records the fastest reliable rate in profile
+    # (default: radio.spi_profile) and returns it with the result of each rate checked.
+    saved = prepare_radio(radio)
+    results = []
+    best = None
+    try:
+        for speed_hz in sorted(rates):
+            ok = check_spi_rate(radio, speed_hz, rounds)
+            results.append((speed_hz, ok))
+            if not ok:
+                break
+            best = speed_hz
+    finally:
+        restore_radio(radio, saved, min(rates))
+
+    if profile is None:
+        profile = radio.spi_profile
+    if best and profile:
+        write_spi_profile(profile, 0, radio.csn_pin, best,
+                          {"calibrated": time.strftime("%Y-%m-%d %H:%M:%S"),
+                           "rounds": rounds})
+    if best:
+        radio.spidev.max_speed_hz = best
+    return best, results
+
+
+def benchmark_spi(radio, rates=SPI_RATES, duration=0.5):
+    # Transfers per second at each rate: 2 byte register reads and 33 byte payload
+    # frames. Returns a list of (speed_hz, register reads/s, payload frames/s).
+    saved = prepare_radio(radio)
+    xfer2 = radio.spidev.xfer2
+    register_read = [NRF24.R_REGISTER | NRF24.FIFO_STATUS, NRF24.NOP]
+    payload_frame = [NRF24.W_TX_PAYLOAD] + [0x55] * NRF24.MAX_PAYLOAD_SIZE
+    results = []
+    try:
+        for speed_hz in rates:
+            radio.spidev.max_speed_hz = speed_hz
+            rates_measured = []
+            for frame in [register_read, payload_frame]:
+                count = 0
+                start = time.time()
+                while time.time() - start < duration:
+                    for n in range(10):
+                        xfer2(frame)
+                        if frame is payload_frame:
+                            # Keep the TX FIFO from filling up
+                            xfer2([NRF24.FLUSH_TX])
+                    count += 10
+                rates_measured.append(count / (time.time() - start))
+            results.append((speed_hz, rates_measured[0], rates_measured[1]))
+    finally:
+        restore_radio(radio, saved)
+    return results
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Calibrate or benchmark the nRF24 SPI clock.")
+    parser.add_argument("command", choices=["calibrate", "benchmark"])
+    parser.add_argument("--csn", type=int, default=0, help="SPI chip select (0 for CE0, 1 for CE1)")
+    parser.add_argument("--ce", type=int, default=25, help="GPIO (BCM) wired to the nRF24 CE input")
+    parser.add_argument("--profile", default=NRF24.SPI_PROFILE, help="SPI clock profile file")
+    parser.add_argument("--rounds", type=int, default=50, help="Checks at each rate")
+    parser.add_argument("--emulate", action="store_true",
+                        help="Use an emulated radio, unreliable above 4 MHz")
+    args = parser.parse_args()
+
+    if args.emulate:
+        from nrf24_emulator import Air, EmulatedGPIO
+        GPIO = EmulatedGPIO(Air())
+        GPIO.add_chip(args.csn, args.ce)
+        spi = GPIO.SpiDev()
+        spi.max_reliable_hz = 4000000
+    else:
+        import RPi.GPIO as GPIO
+        import spidev
+        GPIO.setmode(GPIO.BCM)
+        GPIO.setwarnings(False)
+        spi = spidev.SpiDev()
+
+    radio = NRF24(GPIO, spi)
+    radio.spi_profile = None
+    radio.begin(args.csn, args.ce)
+
+    if args.command == "calibrate":
+        best, results = calibrate_spi(radio, rounds=args.rounds, profile=args.profile)
+        for speed_hz, ok in results:
+            print ("%8.3f MHz: %s" % (speed_hz / 1e6, "ok" if ok else "FAILED"))
+        if best:
+            print ("Fastest reliable rate: %.3f MHz, recorded in %s" % (best / 1e6, args.profile))
+        else:
+            print ("No reliable rate found, check the wiring.")
+    else:
+        print ("   Clock    Register reads/s   Payload frames/s")
+        for speed_hz, reg_rate, payload_rate in benchmark_spi(radio):
+            print ("%8.3f MHz %14.0f %18.0f" % (speed_hz / 1e6, reg_rate, payload_rate))
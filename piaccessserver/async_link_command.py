@@ -0,0 +1,513 @@
+import asyncio
+import random
+import time
+import logging
+
+from link_command import LinkCommand, DummyRadio
+
+class AsyncLinkCommand(LinkCommand):
+    """ LinkCommand whose commands are coroutines (Python 3 only), for a
+    radio whose write() and wait_available() are coroutines, such as
+    lib_nrf24's AsyncNRF24. While a commutator is being polled, the event
+    loop runs other tasks (database fetches, file writes, other radios).
+    Links sharing a radio take turns on it.
+        outarg = await link.check()
+        outarg = await link.update_table(table)
+    """
+    # Lock of each radio, shared by all its links
+    radio_locks = {}
+
+    def radio_lock(self):
+        """ Lock held while a command is using the radio."""
+        if self.radio not in AsyncLinkCommand.radio_locks:
+            AsyncLinkCommand.radio_locks[self.radio] = asyncio.Lock()
+        return AsyncLinkCommand.radio_locks[self.radio]
+
+    async def send_command(self, command, rx_len = 1):
+        """ Used to send any command and check for ACK """
+        async with self.radio_lock():
+            # Initialise outputs
+            outarg = self.command_outarg()
+            if not self.link_allowed(command):
+                return outarg
+            num_attempts = self.command_attempts()
+
+            # Initialise radio
+            self.init_radio()
+
+            read_buf = bytearray(rx_len)
+            read_len = 0
+            read_check = False
+            check_iter = 0
+            policy = self.retry_policy()
+            while not read_check and check_iter < num_attempts:
+                if check_iter > 0:
+                    # Only wait after a failure, longer after each one
+                    await asyncio.sleep(policy.backoff(check_iter))
+                if await self.radio.write(command):
+                    # Write successful
+                    outarg["link_ok"] = True
+                    reply_len = await self.receive_reply(read_buf, rx_len,
+                                                         attempt = check_iter)
+                    if reply_len is not None:
+                        read_len = reply_len
+                    read_check = self.check_reply(outarg, command, read_buf,
+                                                  reply_len, rx_len)
+                else:
+                    policy.record_loss()
+                check_iter += 1
+
+            return self.end_command(outarg, read_buf, read_len)
+
+    async def dump_logging(self):
+        """ Send the dump logging command."""
+        if self.bulk_log:
+            return await self.dump_logging_bulk()
+
+        # Initialise outputs
+        outarg = self.log_outarg()
+
+        # Ask for remaining entries one by one
+        while True:
+            # Send command and validate commutator state
+            outarg.update(await self.send_command([0xA3], 12))
+            if not self.log_entry_received(outarg):
+                return outarg
+
+            # Command commutator to erase this entry
+            outarg.update(await self.send_command([0xB0]))
+            if not self.log_entry_erased(outarg):
+                return outarg
+
+    async def dump_logging_bulk(self):
+        """ Retrieve the log entries by bursts of frames, see
+            LinkCommand.dump_logging_bulk.
+        """
+        # Initialise outputs
+        outarg = self.log_outarg(True)
+
+        last_seq = None
+        num_failures = 0
+        more = True
+        while more:
+            async with self.radio_lock():
+                frames = await self.log_burst()
+            burst = self.log_burst_received(outarg, frames, last_seq)
+            if burst is None:
+                return outarg
+            seq, more = burst
+            if seq != last_seq:
+                # Command commutator to erase the entries received
+                outarg.update(await self.send_command([0xB2, seq & 0xFF, seq >> 8]))
+                if not self.log_entry_erased(outarg):
+                    return outarg
+                last_seq = seq
+            elif more:
+                # Entries are waiting but none came through
+                num_failures += 1
+                if self.log_stalled(num_failures):
+                    return outarg
+
+        # Everything went fine
+        outarg["read_ok"] = True
+        return outarg
+
+    async def retrieve_log(self, stored_seq):
+        """ Retrieve the log entries following stored_seq without erasing
+            them, see LinkCommand.retrieve_log.
+        """
+        # Initialise outputs
+        outarg = self.log_outarg(True)
+        outarg["last_seq"] = stored_seq
+
+        num_failures = 0
+        more = True
+        while more:
+            last_seq = outarg["last_seq"]
+            async with self.radio_lock():
+                frames = await self.log_burst(last_seq)
+            if frames:
+                last_seq = self.log_start(frames, last_seq)
+            burst = self.log_burst_received(outarg, frames, last_seq)
+            if burst is None:
+                return outarg
+            seq, more = burst
+            outarg["last_seq"] = seq
+            if seq == last_seq and more:
+                # Entries are waiting but none came through
+                num_failures += 1
+                if self.log_stalled(num_failures):
+                    return outarg
+
+        # Everything went fine
+        outarg["read_ok"] = True
+        return outarg
+
+    async def erase_log_to(self, seq):
+        """ Have the commutator erase its log entries up to seq, once they
+            are stored.
+        """
+        outarg = await self.send_command([0xB2, seq & 0xFF, seq >> 8])
+        self.log_entry_erased(outarg)
+        return outarg
+
+    async def log_burst(self, last_seq = None):
+        """ Send the bulk dump command and collect the burst of frames that
+            follows, see LinkCommand.log_burst.
+        """
+        if not self.link_allowed([0xB1]):
+            return None
+        self.init_radio()
+        command = self.log_command(last_seq)
+        num_retries = 0
+        while not await self.radio.write(command):
+            num_retries += 1
+            delay = self.write_retry(command, num_retries, self.num_retries)
+            if delay is None:
+                return None
+            await asyncio.sleep(delay)
+        self.circuit_breaker().record_success()
+
+        frames = []
+        while len(frames) < self.log_burst_frames:
+            read_buf = bytearray(32)
+            read_len = await self.receive_reply(read_buf, 32, True)
+            if not read_len:
+                break
+            frames.append(read_buf[:read_len])
+            if self.last_log_frame(frames[-1]):
+                break
+        return frames
+
+    async def update_table(self, table):
+        """ Send each access table entry, see LinkCommand.update_table."""
+        if self.table_window:
+            return await self.update_table_window(table)
+        if self.table_frame_entries:
+            return await self.update_table_frames(table)
+
+        # Initialise outputs
+        outarg = self.table_outarg(table)
+        if not self.link_allowed([0xA4]):
+            return outarg
+
+        async with self.radio_lock():
+            # Initialise radio
+            self.init_radio()
+
+            for i in range(len(table[0])):
+                # Prepare data to be sent
+                command = self.table_command(table, i)
+                num_retries = 0
+                while not await self.radio.write(command):
+                    num_retries = num_retries + 1
+                    delay = self.write_retry(command, num_retries)
+                    if delay is None:
+                        return outarg
+                    await asyncio.sleep(delay)
+                # Wait for answer
+                read_buf = bytearray(3)
+                read_len = await self.receive_reply(read_buf, 3)
+                if not self.check_table_reply(outarg, read_buf, read_len, table, i):
+                    return outarg
+                outarg["num_acked"] = i + 1
+                if not self.ack_payload:
+                    self.radio.stopListening()
+
+        return self.table_updated(outarg)
+
+    async def update_table_window(self, table):
+        """ Send the access table entries by windows of entries in flight,
+            see LinkCommand.update_table_window.
+        """
+        # Initialise outputs
+        outarg = self.table_outarg(table)
+        if not self.link_allowed([0xB5]):
+            return outarg
+
+        # A new session number tells the commutator a new update starts
+        session = random.randrange(0x100)
+        acked = [False] * len(table[0])
+        base = 0
+        num_stalls = 0
+        while base < len(acked):
+            # Send the entries of the window not acknowledged yet, back to back
+            async with self.radio_lock():
+                self.init_radio()
+                entries = self.window_entries(acked, base)
+                unacked = await self.write_window(table, entries, session)
+                if 0 < len(unacked) < len(entries):
+                    await self.write_window(table, unacked, session)
+
+            # Cumulative and selective acknowledgement
+            status = await self.send_command([0xB6, session], 11)
+            progress = self.window_progress(outarg, status, acked, num_stalls)
+            if progress is None:
+                return outarg
+            base, num_stalls = progress
+
+        return self.table_updated(outarg)
+
+    async def write_window(self, table, entries, session):
+        """ Queue the numbered entries in the radio TX FIFO, see
+            LinkCommand.write_window.
+        """
+        unacked = []
+        queued = []
+        for i in entries:
+            command = self.window_command(table, i, session)
+            if not self.radio.write_fast(command):
+                unacked += [j for j, ok in zip(queued, await self.radio.tx_standby()) if not ok]
+                queued = []
+                self.radio.write_fast(command)
+            queued.append(i)
+        unacked += [j for j, ok in zip(queued, await self.radio.tx_standby()) if not ok]
+        return unacked
+
+    async def update_table_frames(self, table):
+        """ Send the access table entries by frames of several entries, see
+            LinkCommand.update_table_frames.
+        """
+        # Initialise outputs
+        outarg = self.table_outarg(table)
+        if not self.link_allowed([0xB4]):
+            return outarg
+
+        async with self.radio_lock():
+            # Initialise radio
+            self.init_radio()
+
+            i = 0
+            while i < len(table[0]):
+                # Prepare data to be sent
+                command = self.table_frame(table, i)
+                num_retries = 0
+                while not await self.radio.write(command):
+                    num_retries = num_retries + 1
+                    delay = self.write_retry(command, num_retries)
+                    if delay is None:
+                        return outarg
+                    await asyncio.sleep(delay)
+                # Wait for answer
+                read_buf = bytearray(5)
+                read_len = await self.receive_reply(read_buf, 5)
+                num_entries = self.check_frame_reply(outarg, read_buf, read_len,
+                                                     table, i, (len(command) - 4) // 4)
+                if num_entries is None:
+                    return outarg
+                i += num_entries
+                outarg["num_acked"] = i
+                if not self.ack_payload:
+                    self.radio.stopListening()
+
+        return self.table_updated(outarg)
+
+    async def sync_table(self, table, shadow, journal = None):
+        """ Send only the entries of table that differ from shadow, see
+            LinkCommand.sync_table.
+        """
+        memory = await self.table_memory()
+        if self.table_digest and memory["read_ok"] and \
+           self.digest_matches(table, shadow, memory):
+            return self.table_skipped(table, shadow, memory)
+
+        delta, num_new = self.shadow_delta(table, shadow, memory, journal)
+        if delta is not None:
+            outarg = await self.resume_table(delta, journal, memory)
+            if outarg["update_ok"] and not self.delta_applied(outarg, delta, num_new):
+                delta = None
+        if delta is None:
+            outarg = await self.resume_table(table, journal, memory)
+        cards = self.table_synced(outarg, table, delta, shadow)
+        if cards is not None:
+            outarg["shadow"] = self.new_shadow(cards, await self.table_memory())
+        return outarg
+
+    async def table_memory(self):
+        """ Commutator memory state for sync_table, see
+            LinkCommand.table_memory.
+        """
+        if self.table_digest:
+            return await self.check_digest()
+        return await self.check_memory()
+
+    async def resume_table(self, table, journal, memory):
+        """ update_table, resuming an interrupted update, see
+            LinkCommand.resume_table.
+        """
+        start, journal = self.resume_start(table, journal, memory)
+        if start is None:
+            return self.table_deferred(journal)
+        outarg = await self.update_table([table[0][start:], table[1][start:]])
+        return self.table_checkpoint(outarg, start, journal, memory)
+
+    async def check_memory(self):
+        outarg = {"read_ok": False}
+        # Send command and validate commutator state
+        outarg.update(await self.send_command([0xA5], 6))
+        if self.command_ok(outarg, "get memory size"):
+            # Read the remainder of the packet
+            outarg["read_ok"] = self.read_memory_state(outarg)
+        return outarg
+
+    async def check_digest(self):
+        outarg = {"read_ok": False}
+        # Send command and validate commutator state
+        start = time.time()
+        outarg.update(await self.send_command([0xB3], 8))
+        outarg["command_time"] = time.time() - start
+        if self.command_ok(outarg, "get table digest"):
+            # Read the remainder of the packet
+            outarg["read_ok"] = self.read_digest_state(outarg)
+        return outarg
+
+    async def receive_reply(self, read_buf, rx_len, frame = False, attempt = 0):
+        """ Read the reply to the command just written into read_buf, see
+            LinkCommand.receive_reply.
+        """
+        start = time.time()
+        read_len = await self.read_reply(read_buf, rx_len, frame,
+                                         self.retry_policy().reply_timeout(attempt))
+        self.reply_timed(read_len, start)
+        return read_len
+
+    async def read_reply(self, read_buf, rx_len, frame, timeout):
+        """ receive_reply, waiting timeout at most."""
+        if not self.ack_payload:
+            # The commutator sends its reply in a packet of its own
+            self.radio.startListening()
+            if not await self.wait_rx(timeout):
+                return None
+            return self.read_rx(read_buf, rx_len, frame)
+
+        # The ACK to the command itself can only carry a stale reply
+        self.read_ack_payload(bytearray(32), 32)
+        # Fetch the reply (0xAA) until the commutator has loaded it in its ACK
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if not await self.radio.write([0xAA]):
+                return None
+            read_len = self.read_ack_payload(read_buf, rx_len)
+            if read_len is not None:
+                return read_len
+        return None
+
+    async def wait_rx(self, timeout):
+        return await self.radio.wait_available([0], timeout)
+
+class AsyncDummyRadio(DummyRadio):
+    """ DummyRadio with the coroutines of AsyncNRF24."""
+    def __init__(self):
+        DummyRadio.__init__(self)
+        self.write_time = 0
+
+    async def write(self, buf):
+        # Wait 10 ms without blocking the event loop
+        await asyncio.sleep(0.010)
+        return DummyRadio.write(self, buf)
+
+    async def tx_standby(self, timeout = None):
+        # 10 ms per queued payload, as write
+        await asyncio.sleep(0.010 * len(self.tx_results))
+        return DummyRadio.tx_standby(self)
+
+    async def wait_available(self, pipe_num = None, timeout = 0.5):
+        return self.available(pipe_num)
+
+# UNIT TEST (if script is executed directly)
+if __name__ == '__main__':
+    logging.basicConfig(filename='test_async_link_command.log',
+                        format='%(asctime)s:%(levelname)s:%(funcName)s:%(message)s',
+                        level=logging.DEBUG)
+    # Two radios, the first one shared by two commutators
+    radios = [AsyncDummyRadio(), AsyncDummyRadio()]
+    links = [AsyncLinkCommand(radios[0], 32, 0xA, 'Tour'),
+             AsyncLinkCommand(radios[0], 33, 0xB, 'Toupie'),
+             AsyncLinkCommand(radios[1], 34, 0xC, 'Banc de scie')]
+    for radio in radios:
+        radio.log_code = [0x30, 0x31]
+        radio.log_age  = [300, 60]
+        radio.log_user = [[0x70, 0x40, 0x84, 0x0B], [0x45, 0x55, 0x55, 0x55]]
+        radio.mem_size = 6
+    table = [['7040840B', '45555555', '67892311'], [True, False, True]]
+
+    async def ticks(task):
+        # Runs while the links wait on their radios
+        num_ticks = 0
+        while not task.done():
+            num_ticks += 1
+            await asyncio.sleep(0.001)
+        return num_ticks
+
+    async def main():
+        print("\nChecking the three commutators at once.")
+        start = time.time()
+        print(await asyncio.gather(*[link.check() for link in links]))
+        print("Took %.3f s." % (time.time() - start))
+
+        print("\nDumping logs while updating a table.")
+        start = time.time()
+        update = asyncio.ensure_future(links[2].update_table(table))
+        results = await asyncio.gather(links[0].dump_logging(), update,
+                                       ticks(update))
+        print(results[0]["log_codes"])
+        print(results[1])
+        print("Took %.3f s, other task ran %d times meanwhile." %
+              (time.time() - start, results[2]))
+
+        print("\nExpecting 3 used, 6 total entries in memory.")
+        print(await links[2].check_memory())
+
+        print("\nDumping logs by bursts of frames.")
+        radios[1].log_code = [0x30, 0x31, 0x32, 0x33]
+        radios[1].log_age  = [300, 200, 100, 50]
+        radios[1].log_user = [[0x70, 0x40, 0x84, 0x0B]] * 4
+        links[2].bulk_log = True
+        print((await links[2].dump_logging())["log_codes"])
+
+        print("\nRetrieving log entries, then erasing them once stored.")
+        radios[1].log_code = [0x30, 0x31]
+        radios[1].log_age  = [200, 100]
+        radios[1].log_user = [[0x70, 0x40, 0x84, 0x0B]] * 2
+        status = await links[2].retrieve_log(None)
+        stored_seq = status["last_seq"]
+        status = await links[2].retrieve_log(stored_seq)
+        print((status["log_count"], len(radios[1].log_code)))
+        await links[2].erase_log_to(stored_seq)
+        print(len(radios[1].log_code))
+
+        print("\nSkipping the table already sent, then sending only a change.")
+        links[2].table_digest = True
+        status = await links[2].sync_table(table, None)
+        print((status["update_ok"], status["skipped"], status["num_entries"]))
+        table[1][1] = True
+        links[2].table_frame_entries = 7
+        status = await links[2].sync_table(table, status["shadow"])
+        print((status["update_ok"], status["skipped"], status["num_entries"]))
+        status = await links[2].sync_table(table, status["shadow"])
+        print((status["update_ok"], status["skipped"], status["num_entries"]))
+
+        print("\nSending the table by windows of 8 entries in flight.")
+        links[2].table_frame_entries = 0
+        links[2].table_window = 8
+        radios[1].access_table = [[], []]
+        status = await links[2].update_table(table)
+        print((status["update_ok"], status["num_newcard"]))
+
+        print("\nResuming a table update interrupted after 2 entries.")
+        links[2].table_window = 0
+        radios[1].access_table = [[], []]
+        radios[1].writes_left = 3
+        status = await links[2].sync_table(table, None)
+        radios[1].writes_left = None
+        links[2].circuit_breaker().record_success()
+        status = await links[2].sync_table(table, None, status["journal"])
+        print((status["update_ok"], status["resumed"], status["num_entries"],
+               status["num_newcard"]))
+
+        print("\nExpecting a non-powered commutator to be skipped after its first failure.")
+        radios[0].link_err(32)
+        print([(await links[0].check())["link_ok"] for n in range(2)])
+        print(links[0].circuit_breaker().state)
+
+    asyncio.run(main())
@@ -0,0 +1,87 @@
+import json
+import os
+import time
+import logging
+
+class CircuitBreaker():
+    """ Stops sending commands to a commutator that does not answer.
+    closed:    commands are sent; failure_threshold commands failing in a
+               row (no ACK after all retries) open the breaker.
+    open:      commands fail at once until open_until.
+    half_open: the cool-down is over, the next command is a single try:
+               closes the breaker if acknowledged, opens it again for twice
+               as long otherwise.
+    The state is kept between runs, see write_circuit_breakers.
+    """
+    def __init__(self):
+        self.failure_threshold = 1
+        self.min_cooldown  = 600.0        # First open period (s)
+        self.max_cooldown  = 6 * 3600.0   # Nightly runs still probe once
+        self.state         = 'closed'
+        self.num_failures  = 0
+        self.cooldown      = self.min_cooldown
+        self.open_until    = 0.0
+        self.num_skipped   = 0            # Commands not sent during this run
+
+    def allow(self):
+        """ Check a command can be sent, moving to half_open once the
+            cool-down is over.
+        """
+        if self.state == 'open':
+            if time.time() < self.open_until:
+                self.num_skipped += 1
+                return False
+            self.state = 'half_open'
+        return True
+
+    def probing(self):
+        return self.state == 'half_open'
+
+    def record_success(self):
+        self.state = 'closed'
+        self.num_failures = 0
+        self.cooldown = self.min_cooldown
+
+    def record_failure(self):
+        self.num_failures += 1
+        if self.state == 'half_open':
+            # Still down, wait longer before the next probe
+            self.cooldown = min(self.max_cooldown, self.cooldown * 2)
+        elif self.num_failures < self.failure_threshold:
+            return
+        self.state = 'open'
+        self.open_until = time.time() + self.cooldown
+
+def read_circuit_breakers(filename):
+    """ Circuit breakers saved by write_circuit_breakers, in a dictionary
+        indexed by commutator name.
+    """
+    breakers = {}
+    if not os.path.exists(filename):
+        return breakers
+    try:
+        with open(filename, 'r') as breaker_file:
+            states = json.load(breaker_file)
+        for commutator_name, state in states.items():
+            breaker = CircuitBreaker()
+            breaker.state = str(state["state"])
+            breaker.num_failures = int(state["num_failures"])
+            breaker.cooldown = float(state["cooldown"])
+            breaker.open_until = float(state["open_until"])
+            breakers[str(commutator_name)] = breaker
+    except (ValueError, KeyError, TypeError, AttributeError, IOError):
+        logging.warning("Circuit breaker states %s are unreadable, ignoring them.", filename)
+        return {}
+    return breakers
+
+def write_circuit_breakers(filename, breakers):
+    states = {}
+    for commutator_name, breaker in breakers.items():
+        states[commutator_name] = {"state": breaker.state,
+                                   "num_failures": breaker.num_failures,
+                                   "cooldown": breaker.cooldown,
+                                   "open_until": breaker.open_until}
+    temp_filename = filename + '.tmp'
+    with open(temp_filename, 'w') as breaker_file:
+        json.dump(states, breaker_file, sort_keys=True)
+    os.rename(temp_filename, filename)
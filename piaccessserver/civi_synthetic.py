@@ -0,0 +1,309 @@
+# coding: utf-8
+#
+# Synthetic CiviCRM data, to run the database retrieval and what follows
+# without the production database: contacts, memberships, access cards and
+# tags (the commutator names under the 'Accès' tag) at any scale, loaded in
+# an SQLite file standing in for the CiviCRM MySQL database.
+#
+#     python civi_synthetic.py generate -n 10000 -o civi_synthetic.sqlite
+#     python civi_synthetic.py benchmark -n 1000,10000,100000
+#
+# db_connect.read_db uses the SQLite file given by civi_sqlite in the
+# DATABASE section of its configuration file. The benchmark times the
+# pipeline of commutator_update: read_db, member_access_write,
+# member_access_read and update_table on a simulated commutator.
+
+import argparse
+import datetime
+import json
+import logging
+import os
+import random
+import sqlite3
+import time
+
+# Name the queries give the CiviCRM database
+CIVI_SCHEMA = 'sherbro3_civicrm'
+
+SCHEMA = """
+CREATE TABLE civicrm_contact (
+    id INTEGER PRIMARY KEY,
+    contact_type TEXT DEFAULT 'Individual',
+    first_name TEXT,
+    last_name TEXT,
+    sort_name TEXT,
+    display_name TEXT,
+    is_deleted INTEGER DEFAULT 0);
+CREATE TABLE civicrm_membership (
+    id INTEGER PRIMARY KEY,
+    contact_id INTEGER,
+    membership_type_id INTEGER,
+    join_date TEXT,
+    start_date TEXT,
+    end_date TEXT,
+    source TEXT,
+    status_id INTEGER,
+    is_test INTEGER DEFAULT 0);
+CREATE INDEX index_membership_contact ON civicrm_membership (contact_id);
+CREATE TABLE civicrm_value_carte_d_acc_s_4 (
+    id INTEGER PRIMARY KEY,
+    entity_id INTEGER,
+    num_ro_22 TEXT,
+    code_hexad_cimal_23 TEXT);
+CREATE INDEX index_card_entity ON civicrm_value_carte_d_acc_s_4 (entity_id);
+CREATE TABLE civicrm_tag (
+    id INTEGER PRIMARY KEY,
+    name TEXT,
+    description TEXT,
+    parent_id INTEGER);
+CREATE INDEX index_tag_parent ON civicrm_tag (parent_id);
+CREATE TABLE civicrm_entity_tag (
+    id INTEGER PRIMARY KEY,
+    entity_table TEXT DEFAULT 'civicrm_contact',
+    entity_id INTEGER,
+    tag_id INTEGER);
+CREATE INDEX index_entity_tag_tag ON civicrm_entity_tag (tag_id);
+CREATE INDEX index_entity_tag_entity ON civicrm_entity_tag (entity_id);
+"""
+
+COMMUTATOR_NAMES = [u'Tour', u'Toupie', u'Banc de scie', u'Degauchisseuse',
+                    u'Planeur', u'Tour - Fraiseuse', u'Scie à ruban',
+                    u'Perceuse à colonne', u'Découpe laser', u'Imprimante 3D',
+                    u'Fraiseuse CNC', u'Sableuse']
+OTHER_TAGS = [u'Bénévole', u'Donateur', u'Infolettre', u'Formateur']
+FIRST_NAMES = [u'Francis', u'David', u'Gabriel', u'Marie', u'Julie', u'Sophie',
+               u'Louis', u'Mathieu', u'Catherine', u'Étienne', u'Geneviève',
+               u'Olivier', u'Isabelle', u'Simon', u'Émilie', u'Jean', u'Nadia',
+               u'Pierre', u'Amélie', u'Karim', u'Chloé', u'Benoît', u'Léa', u'Samuel']
+LAST_NAMES = [u'Tremblay', u'Gagnon', u'Roy', u'Côté', u'Bouchard', u'Gauthier',
+              u'Morin', u'Lavoie', u'Fortin', u'Gagné', u'Ouellet', u'Pelletier',
+              u'Bélanger', u'Lévesque', u'Bergeron', u'Leblanc', u'Paquette',
+              u'Girard', u'Simard', u'Boucher', u'Caron', u'Beaulieu', u'Poisson',
+              u'Beaudette', u'Moreau', u'Rebêlo', u'Ferrer', u'Nguyen']
+
+# Membership types giving access (see db_connect.read_db) and others
+ACCESS_MEMBERSHIP_TYPES = [11, 12, 13, 16, 17, 18, 19, 20, 21, 22, 23, 24]
+OTHER_MEMBERSHIP_TYPES  = [1, 2, 3]
+
+def generate_dataset(num_members, seed = None, num_commutators = 12,
+                     today = None):
+    """ Rows of each table for num_members contacts. Most have an access
+        card (a few have two, or a code that is not a valid card) and a
+        membership, three in four of them still valid; card holders are
+        tagged with the commutators they may use.
+    """
+    rng = random.Random(seed)
+    if today is None:
+        today = datetime.date.today()
+    def day(offset):
+        return (today + datetime.timedelta(days = offset)).isoformat()
+
+    dataset = {"civicrm_contact": [], "civicrm_membership": [],
+               "civicrm_value_carte_d_acc_s_4": [], "civicrm_tag": [],
+               "civicrm_entity_tag": []}
+
+    # Access tags under 'Accès', other tags at the top level
+    tags = dataset["civicrm_tag"]
+    tags.append((1, u'Accès', u'Machines the member may use', None))
+    commutator_tags = []
+    for name in (COMMUTATOR_NAMES * (num_commutators // len(COMMUTATOR_NAMES) + 1))[:num_commutators]:
+        if name in [tag[1] for tag in tags]:
+            name = u'%s %d' % (name, len(tags))
+        tags.append((len(tags) + 1, name, None, 1))
+        commutator_tags.append(len(tags))
+    other_tags = []
+    for name in OTHER_TAGS:
+        tags.append((len(tags) + 1, name, None, None))
+        other_tags.append(len(tags))
+
+    codes = set()
+    num_cards = 0
+    for contact_id in range(1, num_members + 1):
+        first_name = rng.choice(FIRST_NAMES)
+        last_name = rng.choice(LAST_NAMES)
+        dataset["civicrm_contact"].append(
+            (contact_id, u'Individual', first_name, last_name,
+             u'%s, %s' % (last_name, first_name), u'%s %s' % (first_name, last_name),
+             int(rng.random() < 0.01)))
+
+        # Memberships, with the expired one of a renewal now and then
+        if rng.random() < 0.85:
+            memberships = [rng.randrange(-400, 365)]
+            if rng.random() < 0.2:
+                memberships.insert(0, memberships[0] - 365)
+            for end_offset in memberships:
+                if rng.random() < 0.9:
+                    membership_type = rng.choice(ACCESS_MEMBERSHIP_TYPES)
+                else:
+                    membership_type = rng.choice(OTHER_MEMBERSHIP_TYPES)
+                status = 2 if end_offset >= 0 else 4   # Current or expired
+                dataset["civicrm_membership"].append(
+                    (len(dataset["civicrm_membership"]) + 1, contact_id,
+                     membership_type, day(end_offset - 365 - rng.randrange(1000)),
+                     day(end_offset - 365), day(end_offset), u'Synthetic',
+                     status, 0))
+
+        # Access card
+        if rng.random() < 0.9:
+            num_member_cards = 2 if rng.random() < 0.01 else 1
+            for n in range(num_member_cards):
+                num_cards += 1
+                if rng.random() < 0.01:
+                    # Entered by hand, not a card code
+                    code = rng.choice([u'', u'N/A', u'%07X' % rng.randrange(1 << 28)])
+                else:
+                    code = u'%08X' % rng.randrange(1 << 32)
+                    while code in codes:
+                        code = u'%08X' % rng.randrange(1 << 32)
+                    codes.add(code)
+                dataset["civicrm_value_carte_d_acc_s_4"].append(
+                    (num_cards, contact_id, u'F%d' % num_cards, code))
+
+            # Machines the card holder was trained on
+            num_access = min(len(commutator_tags), int(rng.expovariate(0.5)))
+            for tag_id in rng.sample(commutator_tags, num_access):
+                dataset["civicrm_entity_tag"].append(
+                    (len(dataset["civicrm_entity_tag"]) + 1, u'civicrm_contact',
+                     contact_id, tag_id))
+
+        if rng.random() < 0.1:
+            dataset["civicrm_entity_tag"].append(
+                (len(dataset["civicrm_entity_tag"]) + 1, u'civicrm_contact',
+                 contact_id, rng.choice(other_tags)))
+    return dataset
+
+def create_database(filename, dataset):
+    """ Write dataset to a new SQLite file."""
+    if os.path.exists(filename):
+        os.remove(filename)
+    db = sqlite3.connect(filename)
+    try:
+        db.executescript(SCHEMA)
+        for table, rows in dataset.items():
+            if rows:
+                db.executemany("INSERT INTO %s VALUES (%s)" %
+                               (table, ','.join(['?'] * len(rows[0]))), rows)
+        db.commit()
+    finally:
+        db.close()
+
+def connect(filename):
+    """ Connection to the SQLite file, as to the CiviCRM database: tables
+        can be named with or without the database name, and CURDATE()
+        gives the current date.
+    """
+    if not os.path.exists(filename):
+        raise sqlite3.OperationalError("No database file %s" % filename)
+    db = sqlite3.connect(':memory:')
+    db.execute("ATTACH DATABASE ? AS %s" % CIVI_SCHEMA, (filename,))
+    db.create_function("CURDATE", 0, lambda: datetime.date.today().isoformat())
+    return db
+
+def write_db_config(filename, database_filename):
+    """ Configuration file for db_connect.read_db, using the SQLite file."""
+    with open(filename, 'w') as config_file:
+        config_file.write("[DATABASE]\ncivi_sqlite = %s\n" % database_filename)
+
+def benchmark_pipeline(num_members, seed, workdir = '.'):
+    """ Time each step from the database to a commutator table update,
+        for num_members contacts. Returns the durations (s) and sizes.
+    """
+    # Python 2 modules of the server
+    import db_connect
+    import csv_rw
+    from link_command import LinkCommand
+    from commutator_sim import Fleet
+
+    result = {"num_members": num_members}
+    database_filename = os.path.join(workdir, 'civi_synthetic_%d.sqlite' % num_members)
+    config_filename = os.path.join(workdir, 'civi_synthetic_%d.ignored' % num_members)
+    csv_filename = os.path.join(workdir, 'civi_synthetic_%d.csv' % num_members)
+
+    start = time.time()
+    create_database(database_filename, generate_dataset(num_members, seed))
+    write_db_config(config_filename, database_filename)
+    result["generate_s"] = time.time() - start
+
+    commutators = []
+    members = []
+    memberships = []
+    cards = []
+    tags = []
+    start = time.time()
+    db_connect.read_db(commutators, members, memberships, cards, tags, config_filename)
+    result["read_db_s"] = time.time() - start
+
+    start = time.time()
+    csv_rw.member_access_write(csv_filename, commutators, members, memberships, cards, tags)
+    result["member_access_write_s"] = time.time() - start
+
+    commutators = []
+    members = []
+    memberships = []
+    cards = []
+    authorisations = []
+    start = time.time()
+    csv_rw.member_access_read(csv_filename, commutators, members, memberships,
+                              cards, authorisations)
+    result["member_access_read_s"] = time.time() - start
+    result["num_cards"] = len(cards)
+
+    # Table of the first commutator, sent to a simulated commutator
+    # already holding it: the radio time, not the EEPROM writes
+    table = [cards, authorisations[0]]
+    fleet = Fleet(seed)
+    commutator = fleet.add_commutator(commutators[0], 10, mem_size = len(cards))
+    for card, auth in zip(cards, table[1]):
+        commutator.firmware.table_entry(bytearray.fromhex(card), auth)
+    link = LinkCommand(fleet.radio(), commutator.channel,
+                       commutator.commutator_id, commutators[0])
+    link.table_frame_entries = 7
+    start = time.time()
+    status = link.update_table(table)
+    result["update_table_s"] = time.time() - start
+    result["update_ok"] = status["update_ok"]
+
+    for filename in [database_filename, config_filename, csv_filename]:
+        os.remove(filename)
+    return result
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Synthetic CiviCRM database for tests and benchmarks.')
+    parser.add_argument('command', choices=['generate', 'benchmark'])
+    parser.add_argument('-n', '--num_members', default='1000',
+                        help='Number of contacts, comma separated for several benchmark runs.')
+    parser.add_argument('-o', '--output', help='SQLite file (generate) or JSON results (benchmark).')
+    parser.add_argument('--commutators', type=int, default=12, help='Number of commutator tags.')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    logging.basicConfig(filename='civi_synthetic.log',
+                        format='%(asctime)s:%(levelname)s:%(funcName)s:%(message)s',
+                        level=logging.INFO)
+    sizes = [int(value) for value in args.num_members.split(',')]
+
+    if args.command == 'generate':
+        filename = args.output or 'civi_synthetic.sqlite'
+        dataset = generate_dataset(sizes[0], args.seed, args.commutators)
+        create_database(filename, dataset)
+        for table in sorted(dataset):
+            print("%s: %d rows" % (table, len(dataset[table])))
+        print("Written to %s, use civi_sqlite = %s in the DATABASE section." %
+              (filename, filename))
+    else:
+        results = []
+        for num_members in sizes:
+            result = benchmark_pipeline(num_members, args.seed)
+            results.append(result)
+            print("%d members, %d cards: generate %.2f s, read_db %.2f s, "
+                  "member_access_write %.2f s, member_access_read %.2f s, "
+                  "update_table %.2f s%s." %
+                  (num_members, result["num_cards"], result["generate_s"],
+                   result["read_db_s"], result["member_access_write_s"],
+                   result["member_access_read_s"], result["update_table_s"],
+                   "" if result["update_ok"] else " (failed)"))
+        if args.output:
+            with open(args.output, 'w') as output_file:
+                json.dump({"created": time.strftime("%Y-%m-%d %H:%M:%S"),
+                           "seed": args.seed, "results": results},
+                          output_file, indent=1, sort_keys=True)
@@ -0,0 +1,9 @@
+# coding: utf-8
+#
+# Simulated commutators and radios, to run LinkCommand and piaccessserver.py
+# against a whole fleet without hardware: see fleet.py. The coroutine radio
+# for async_link_command.py is in async_radio.py (Python 3 only).
+
+from .firmware import CommutatorFirmware
+from .fleet import Fleet, Commutator, LinkModel
+from .radio import SimulatedRadio
@@ -0,0 +1,99 @@
+# coding: utf-8
+#
+# Run LinkCommand against a simulated fleet, from the piaccessserver
+# directory:
+#     python -m commutator_sim [num_commutators] [loss]
+# Each commutator gets the access table and has its log retrieved, two
+# radios serving the fleet; the first commutator replies in ACK payloads.
+
+import logging
+import sys
+import time
+
+from link_command import LinkCommand
+from radio_pool import RadioPool
+
+from .fleet import Fleet
+
+def card_id(card):
+    return ''.join('%02X' % byte for byte in card)
+
+def serve(link, table):
+    """ Check, table update and log retrieval of one commutator."""
+    start = time.time()
+    status = link.check()
+    update = link.update_table(table)
+    log = link.retrieve_log(None)
+    if log["read_ok"] and log["last_seq"] is not None:
+        link.erase_log_to(log["last_seq"])
+    return {"check_ok": status["commutator_ok"],
+            "update_ok": update["update_ok"],
+            "num_newcard": update["num_newcard"],
+            "read_ok": log["read_ok"],
+            "log_count": log["log_count"],
+            "duration": time.time() - start}
+
+if __name__ == '__main__':
+    logging.basicConfig(filename='test_commutator_sim.log',
+                        format='%(asctime)s:%(levelname)s:%(funcName)s:%(message)s',
+                        level=logging.DEBUG)
+    num_commutators = 10
+    loss = 0.05
+    if len(sys.argv) > 1:
+        num_commutators = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        loss = float(sys.argv[2])
+
+    fleet = Fleet(seed=1)
+    fleet.add_commutators(num_commutators, loss=loss)
+    fleet.commutators[0].ack_payload = True
+    cards = [[fleet.random.randrange(0x100) for n in range(4)] for k in range(24)]
+    table = [[card_id(card) for card in cards],
+             [fleet.random.random() < 0.8 for card in cards]]
+    # Cards of the table presented before the run, to commutators whose
+    # memory is then cleared
+    for commutator in fleet.commutators:
+        for card, auth in zip(cards, table[1]):
+            commutator.firmware.table_entry(card, auth)
+    fleet.add_past_events(12, 3600)
+    for commutator in fleet.commutators:
+        commutator.firmware.table = {}
+        commutator.firmware.digest = 0
+    fleet.stats = {}
+
+    pool = RadioPool([fleet.radio(), fleet.radio()])
+    links = {}
+    for commutator in fleet.commutators:
+        link = LinkCommand(pool.radio_for(commutator.name), commutator.channel,
+                           commutator.commutator_id, commutator.name,
+                           commutator.ack_payload)
+        link.bulk_log = True
+        links[commutator.name] = link
+
+    print("\n%d commutators, %.0f %% packets lost." % (num_commutators, 100 * loss))
+    start = time.time()
+    results = pool.run([commutator.name for commutator in fleet.commutators],
+                       lambda name: serve(links[name], table))
+    duration = time.time() - start
+
+    num_failed = 0
+    for commutator in fleet.commutators:
+        result = results[commutator.name]
+        if isinstance(result, Exception):
+            num_failed += 1
+            print("%s (channel %d): failed, %s." % (commutator.name, commutator.channel, result))
+            continue
+        # The commutator must end up with the table and an empty log
+        synced = sorted(commutator.firmware.table) == sorted(tuple(card) for card in cards)
+        if not (result["update_ok"] and result["read_ok"] and synced and
+                len(commutator.firmware.log) == 0):
+            num_failed += 1
+        print("%s (channel %d): check %s, table %s (%d new cards), log %s (%d entries) in %.3f s." %
+              (commutator.name, commutator.channel, result["check_ok"],
+               result["update_ok"] and synced, result["num_newcard"],
+               result["read_ok"], result["log_count"], result["duration"]))
+    print("\n%d commutators served in %.3f s, %d failed." %
+          (num_commutators, duration, num_failed))
+    stats = fleet.stats_summary()
+    for name in sorted(stats):
+        print("%s: %s" % (name, stats[name]))
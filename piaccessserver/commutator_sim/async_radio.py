@@ -0,0 +1,34 @@
+# coding: utf-8
+#
+# SimulatedRadio with the coroutines of lib_nrf24's AsyncNRF24, for
+# async_link_command.py (Python 3 only).
+
+import asyncio
+import time
+
+from .radio import SimulatedRadio
+
+class AsyncSimulatedRadio(SimulatedRadio):
+    """ SimulatedRadio whose write(), tx_standby() and wait_available()
+    let the event loop run while the radio is busy.
+    """
+    def __init__(self, fleet, poll_time = 0.0002):
+        SimulatedRadio.__init__(self, fleet)
+        self.poll_time = poll_time
+
+    async def write(self, buf):
+        acked, duration = self.send(buf)
+        await asyncio.sleep(duration)
+        return acked
+
+    async def tx_standby(self, timeout = None):
+        await asyncio.sleep(self.tx_time_left())
+        return self.tx_done()
+
+    async def wait_available(self, pipe_num = None, timeout = 0.5):
+        deadline = time.time() + timeout
+        while not self.available(pipe_num):
+            if time.time() > deadline:
+                return False
+            await asyncio.sleep(self.poll_time)
+        return True
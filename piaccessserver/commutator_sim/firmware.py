@@ -0,0 +1,305 @@
+# coding: utf-8
+#
+# Model of the commutator firmware: access table in EEPROM, event log in
+# RAM and the radio commands of link_command.py, with the time each one
+# keeps the microcontroller busy.
+#
+#     firmware = CommutatorFirmware(mem_size=200)
+#     frames, busy_time = firmware.command([0xA5], time.time())
+
+import struct
+
+# Reply states
+STATE_OK      = 0xAF
+STATE_PROBLEM = 0xA0
+
+# Event codes
+EVENT_FIRST   = 0x30   # First authorised member, double activation mode
+EVENT_ON      = 0x31   # Authorised member activated the commutator
+EVENT_OFF     = 0x32   # Authorised member deactivated the commutator
+EVENT_DENIED  = 0x33   # Member without authorisation
+EVENT_UNKNOWN = 0x34   # Card not in the table
+
+# Table entry codes
+ENTRY_UNCHANGED = 0xD1
+ENTRY_MODIFIED  = 0xD2
+ENTRY_ADDED     = 0xD3
+ENTRY_FULL      = 0xDF
+
+def entry_hash(card_bytes, auth):
+    """ 32 bits FNV-1a hash of a table entry, as computed by the firmware
+        (see link_command.entry_hash).
+    """
+    entry_hash = 0x811C9DC5
+    for byte in list(card_bytes) + [int(auth)]:
+        entry_hash = ((entry_hash ^ byte) * 0x01000193) & 0xFFFFFFFF
+    return entry_hash
+
+class CommutatorFirmware():
+    """ State and command handling of one commutator.
+    The table lives in EEPROM: mem_size entries at most, each written entry
+    or authorisation costing eeprom_byte_time per byte. Cards are looked up
+    by hash, as the firmware indexes its table. The log keeps log_size
+    entries in RAM, the oldest ones dropped when it overflows; entries are
+    numbered from log_seq, the sequence number of the oldest one.
+    """
+    def __init__(self, mem_size = 200, log_size = 100):
+        self.mem_size      = mem_size
+        self.log_size      = log_size
+        self.command_time  = 0.0005      # Decoding a command and preparing its reply (s)
+        self.eeprom_byte_time = 0.0033   # EEPROM write of one byte (s)
+        self.entry_bytes   = 5           # 4 card ID bytes and the authorisation
+        self.frame_entries = 7           # Table entries managed per 0xB4 frame
+        self.table         = {}          # Card ID bytes (tuple) -> authorisation
+        self.digest        = 0           # Sum of the entry hashes
+        self.log           = []          # [code, card ID bytes, time], oldest first
+        self.log_seq       = 0
+        self.num_dropped   = 0           # Log entries lost to overflows
+        self.mode          = 0xA0        # 0xA0 auto, 0xA1 always on, 0xA2 always off
+        self.double_activation = False
+        self.active        = False       # Commutator output
+        self.first_card    = None        # First member, double activation mode
+        self.window        = [None, 0, set(), 0, 0, False]
+        self.fault         = False       # Replies with the problem state
+        self.eeprom_writes = 0           # Bytes written to EEPROM
+        self.busy_time     = 0.0         # Time spent on the last command (s)
+
+    def state(self):
+        if self.fault:
+            return STATE_PROBLEM
+        return STATE_OK
+
+    def command(self, payload, now):
+        """ Handle a command received at time now. Returns the reply frames
+            (none, one, or several for a burst) and the time the
+            microcontroller spent on it.
+        """
+        self.busy_time = self.command_time
+        code = payload[0]
+        handler = self.handlers.get(code)
+        if handler is None:
+            # Unknown commands are ignored
+            return [], self.busy_time
+        frames = handler(self, list(payload), now)
+        return frames, self.busy_time
+
+    # Commands answering their state only
+    def set_mode(self, payload, now):
+        self.mode = payload[0]
+        return [[self.state()]]
+
+    def set_activation(self, payload, now):
+        self.double_activation = payload[0] == 0xA7
+        self.first_card = None
+        return [[self.state()]]
+
+    def check(self, payload, now):
+        return [[self.state()]]
+
+    def erase_entry(self, payload, now):
+        # 0xB0: erase the oldest log entry
+        if self.log:
+            del self.log[0]
+            self.log_seq = (self.log_seq + 1) & 0xFFFF
+        return [[self.state()]]
+
+    # Log
+    def dump_entry(self, payload, now):
+        # 0xA3: oldest entry and the number of entries, itself included
+        reply = [self.state(), 0xA3, min(len(self.log), 0xFF)]
+        if self.log:
+            reply.extend(self.log_bytes(self.log[0], now))
+        else:
+            reply.extend([0] * 9)
+        return [reply]
+
+    def log_bytes(self, entry, now):
+        """ 9 bytes of a log entry: code, card ID, age in seconds (LSB first)."""
+        age = max(0, int(now - entry[2]))
+        return [entry[0]] + list(entry[1]) + \
+               list(struct.unpack("4B", struct.pack("<I", age & 0xFFFFFFFF)))
+
+    def dump_burst(self, payload, now):
+        # 0xB1: frames of up to 3 entries, from the oldest entry or from the
+        # given sequence number if still held
+        num_entries = len(self.log)
+        start = 0
+        if len(payload) >= 4:
+            offset = (payload[2] + 0x100 * payload[3] - self.log_seq) & 0xFFFF
+            if offset <= num_entries:
+                start = offset
+        frames = []
+        for first in range(start, max(num_entries, start + 1), 3)[:payload[1]]:
+            count = min(3, num_entries - first)
+            seq = (self.log_seq + first) & 0xFFFF
+            frame = [self.state(), 0xB1, seq & 0xFF, seq >> 8, count]
+            if first + count < num_entries:
+                # More entries follow
+                frame[4] |= 0x80
+            for entry in self.log[first:first + count]:
+                frame.extend(self.log_bytes(entry, now))
+            frames.append(frame)
+        return frames
+
+    def erase_to(self, payload, now):
+        # 0xB2: erase the entries up to the given sequence number
+        num_erased = (payload[1] + 0x100 * payload[2] - self.log_seq + 1) & 0xFFFF
+        if num_erased >= 0x8000:
+            # Older than the oldest entry, already erased
+            num_erased = 0
+        num_erased = min(num_erased, len(self.log))
+        del self.log[:num_erased]
+        self.log_seq = (self.log_seq + num_erased) & 0xFFFF
+        return [[self.state()]]
+
+    def add_event(self, code, card, when):
+        self.log.append([code, list(card), when])
+        if len(self.log) > self.log_size:
+            # RAM is full, the oldest entry is lost
+            del self.log[0]
+            self.log_seq = (self.log_seq + 1) & 0xFFFF
+            self.num_dropped += 1
+
+    def card_presented(self, card, when):
+        """ Log what the commutator does when a card is presented."""
+        card = list(card)
+        auth = self.table.get(tuple(card))
+        if auth is None:
+            code = EVENT_UNKNOWN
+        elif not auth or self.mode == 0xA2:
+            code = EVENT_DENIED
+        elif self.active:
+            self.active = False
+            code = EVENT_OFF
+        elif self.double_activation and self.first_card in (None, card):
+            self.first_card = card
+            code = EVENT_FIRST
+        else:
+            self.active = True
+            self.first_card = None
+            code = EVENT_ON
+        self.add_event(code, card, when)
+        return code
+
+    # Table
+    def table_entry(self, card, auth):
+        """ Add or update a card, returns the entry code (0xD1 to 0xDF)."""
+        key = tuple(card)
+        auth = bool(auth)
+        old_auth = self.table.get(key)
+        if old_auth is not None:
+            if old_auth == auth:
+                return ENTRY_UNCHANGED
+            self.table[key] = auth
+            self.digest += entry_hash(key, auth) - entry_hash(key, old_auth)
+            self.write_eeprom(1)
+            return ENTRY_MODIFIED
+        if len(self.table) >= self.mem_size:
+            return ENTRY_FULL
+        self.table[key] = auth
+        self.digest += entry_hash(key, auth)
+        # Entry and table size
+        self.write_eeprom(self.entry_bytes + 2)
+        return ENTRY_ADDED
+
+    def write_eeprom(self, num_bytes):
+        self.eeprom_writes += num_bytes
+        self.busy_time += num_bytes * self.eeprom_byte_time
+
+    def update_entry(self, payload, now):
+        # 0xA4: [0xA4, remaining, authorisation, 4 card ID bytes]
+        return [[self.state(), 0xA4, self.table_entry(payload[3:7], payload[2])]]
+
+    def update_frame(self, payload, now):
+        # 0xB4: [0xB4, remaining (2 bytes), authorisation bits, 4 bytes per entry]
+        num_entries = min((len(payload) - 4) // 4, self.frame_entries)
+        status_bits = 0
+        for k in range(num_entries):
+            code = self.table_entry(payload[4+4*k:8+4*k], (payload[3] >> k) & 1)
+            status_bits |= [ENTRY_UNCHANGED, ENTRY_MODIFIED,
+                            ENTRY_ADDED, ENTRY_FULL].index(code) << 2*k
+            if code == ENTRY_FULL:
+                # The remaining entries are not managed
+                num_entries = k + 1
+                break
+        return [[self.state(), 0xB4, num_entries, status_bits & 0xFF, status_bits >> 8]]
+
+    def window_entry(self, payload, now):
+        # 0xB5: [0xB5, session, seq (2 bytes), authorisation, 4 card ID bytes], no reply
+        window = self.window
+        if payload[1] != window[0]:
+            # New session
+            self.window = window = [payload[1], 0, set(), 0, 0, False]
+        seq = payload[2] + payload[3] * 0x100
+        if seq < window[1] or seq in window[2]:
+            # Duplicate, already managed
+            return []
+        code = self.table_entry(payload[5:9], payload[4])
+        if code == ENTRY_MODIFIED:
+            window[4] += 1
+        elif code == ENTRY_ADDED:
+            window[3] += 1
+        elif code == ENTRY_FULL:
+            window[5] = True
+        window[2].add(seq)
+        while window[1] in window[2]:
+            window[2].remove(window[1])
+            window[1] += 1
+        return []
+
+    def window_status(self, payload, now):
+        # 0xB6: next expected entry, entries received after it, counts, flags
+        window = self.window
+        if payload[1] != window[0]:
+            window = [payload[1], 0, set(), 0, 0, False]
+        received_bits = 0
+        for seq in window[2]:
+            if window[1] < seq <= window[1] + 16:
+                received_bits |= 1 << (seq - window[1] - 1)
+        reply = [self.state(), 0xB6]
+        for value in [window[1], received_bits, window[3], window[4]]:
+            reply.extend([value & 0xFF, (value >> 8) & 0xFF])
+        reply.append(int(window[5]))
+        return [reply]
+
+    def memory_state(self, payload, now):
+        # 0xA5: table size and entries used, MSB first
+        mem_used = len(self.table)
+        return [[self.state(), 0xA5, self.mem_size >> 8, self.mem_size & 0xFF,
+                 mem_used >> 8, mem_used & 0xFF]]
+
+    def table_digest(self, payload, now):
+        # 0xB3: number of cards and digest of the table, MSB first
+        num_cards = len(self.table)
+        return [[self.state(), 0xB3, num_cards >> 8, num_cards & 0xFF] +
+                list(struct.unpack("4B", struct.pack(">I", self.digest & 0xFFFFFFFF)))]
+
+    def clear_table(self, payload, now):
+        # 0xA6: only the table size is written
+        self.table = {}
+        self.digest = 0
+        self.write_eeprom(2)
+        return [[self.state()]]
+
+    def fetch(self, payload, now):
+        # 0xAA: only carries the reply loaded in the ACK payload
+        return []
+
+    handlers = {0xA0: set_mode,
+                0xA1: set_mode,
+                0xA2: set_mode,
+                0xA3: dump_entry,
+                0xA4: update_entry,
+                0xA5: memory_state,
+                0xA6: clear_table,
+                0xA7: set_activation,
+                0xA8: set_activation,
+                0xA9: check,
+                0xAA: fetch,
+                0xB0: erase_entry,
+                0xB1: dump_burst,
+                0xB2: erase_to,
+                0xB3: table_digest,
+                0xB4: update_frame,
+                0xB5: window_entry,
+                0xB6: window_status}
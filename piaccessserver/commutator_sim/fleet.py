@@ -0,0 +1,223 @@
+# coding: utf-8
+#
+# Fleet of simulated commutators, each with its firmware, radio channel and
+# address, link quality and card activity. The server radios are
+# SimulatedRadio objects (see radio.py) taking the place of NRF24:
+#
+#     fleet = Fleet(seed=1)
+#     fleet.add_commutators(20, loss=0.05, latency=0.002)
+#     radio = fleet.radio()
+#     link = LinkCommand(radio, fleet.commutators[0].channel, ...)
+
+import random
+import threading
+import time
+
+from .firmware import CommutatorFirmware
+from .radio import SimulatedRadio
+
+# Addresses of the radio pipes (see piaccessserver.py)
+SERVER_ADDRESS     = [0xF0, 0xF0, 0xF0, 0xF0, 0xD2]
+COMMUTATOR_ADDRESS = [0xF0, 0xF0, 0xF0, 0xF0, 0xE1]
+
+class LinkModel():
+    """ Radio link between the server and a commutator: every packet or ACK
+    is lost with probability loss, and the firmware picks a command up
+    latency plus up to jitter seconds after it arrived (main loop period).
+    """
+    def __init__(self, loss = 0.0, latency = 0.001, jitter = 0.001):
+        self.loss    = loss
+        self.latency = latency
+        self.jitter  = jitter
+
+class Commutator():
+    """ A simulated commutator on the air: its firmware and the radio side
+    of the exchanges (duplicate packets, ACK payloads, reply retransmits).
+    """
+    def __init__(self, fleet, name, channel, address, commutator_id,
+                 link, firmware):
+        self.fleet         = fleet
+        self.name          = name
+        self.channel       = channel
+        self.address       = list(address)
+        self.commutator_id = commutator_id
+        self.link          = link
+        self.firmware      = firmware
+        self.powered       = True
+        self.ack_payload   = False       # Replies in the ACK payload (reply_mode)
+        self.retry_delay   = 15          # Own auto retransmit delay and count
+        self.retry_count   = 15
+        self.event_rate    = 0.0         # Cards presented per second
+        self.unknown_rate  = 0.1         # Fraction of unknown cards presented
+        self.events_until  = None        # Events generated up to this time
+        self.last_packet   = None        # PID and payload, to spot retransmits
+        self.last_ack      = []
+        self.ack_frames    = []          # [ready time, reply] loaded in the ACK payload
+        self.busy_until    = 0.0         # Firmware busy with earlier commands until then
+        self.queued        = []          # Times the commands in the RX FIFO are picked up
+
+    def lost(self):
+        return self.fleet.lost(self.link.loss)
+
+    def receive(self, radio, payload, pid, when):
+        """ Packet received at time when. Returns the ACK payload (empty for
+            a plain ACK), None if the RX FIFO is full and the packet is not
+            acknowledged; a retransmit is acknowledged again, not handled.
+        """
+        if self.last_packet == (pid, tuple(payload)):
+            self.fleet.count("duplicates")
+            return self.last_ack
+        # Commands wait in the RX FIFO while the firmware is busy
+        self.queued = [start for start in self.queued if start > when]
+        if len(self.queued) >= 3:
+            self.fleet.count("fifo_full")
+            return None
+        self.last_packet = (pid, tuple(payload))
+
+        # The ACK carries the reply loaded so far, if any
+        ack = []
+        if self.ack_frames and self.ack_frames[0][0] <= when:
+            ack = self.ack_frames.pop(0)[1]
+
+        if payload[0] != 0xAA:
+            start = max(when, self.busy_until) + self.link.latency + \
+                    self.fleet.uniform(0, self.link.jitter)
+            self.queued.append(start)
+            self.generate_events(start)
+            with self.fleet.lock:
+                frames, busy_time = self.firmware.command(payload, start)
+            ready = self.busy_until = start + busy_time
+            self.fleet.count("commands")
+            # A new command ends any reply in progress
+            radio.cancel(self)
+            self.ack_frames = []
+            if self.ack_payload:
+                for frame in frames:
+                    self.ack_frames.append([ready, frame])
+            elif frames:
+                radio.transmit(self, frames, ready)
+        self.last_ack = ack
+        return ack
+
+    def generate_events(self, until):
+        """ Cards presented up to time until, at event_rate on average."""
+        if self.events_until is None or self.event_rate <= 0:
+            self.events_until = until
+            return
+        when = self.events_until
+        while True:
+            when += self.fleet.expovariate(self.event_rate)
+            if when > until:
+                break
+            self.firmware.card_presented(self.fleet.card_for(self), when)
+            self.fleet.count("events")
+        self.events_until = until
+
+class Fleet():
+    """ Commutators sharing the air with the server radios. Random draws
+    come from a single generator, so that a seed reproduces a run.
+    """
+    def __init__(self, seed = None, clock = time.time):
+        self.random      = random.Random(seed)
+        self.clock       = clock
+        self.commutators = []
+        self.lock        = threading.RLock()
+        self.stats       = {}
+
+    def add_commutator(self, name, channel, address = COMMUTATOR_ADDRESS,
+                       commutator_id = None, mem_size = 200, log_size = 100,
+                       loss = 0.0, latency = 0.001, jitter = 0.001):
+        if commutator_id is None:
+            commutator_id = len(self.commutators) + 1
+        commutator = Commutator(self, name, channel, address, commutator_id,
+                                LinkModel(loss, latency, jitter),
+                                CommutatorFirmware(mem_size, log_size))
+        self.commutators.append(commutator)
+        return commutator
+
+    def add_commutators(self, num_commutators, first_channel = 10,
+                        addressed = False, **settings):
+        """ num_commutators on channels first_channel, first_channel+1...
+            or, addressed, all on first_channel with an address each.
+        """
+        commutators = []
+        for num in range(len(self.commutators), len(self.commutators) + num_commutators):
+            channel = first_channel + num
+            address = COMMUTATOR_ADDRESS
+            if addressed:
+                channel = first_channel
+                address = COMMUTATOR_ADDRESS[:4] + [num & 0xFF]
+            commutators.append(self.add_commutator('Commutator%d' % num,
+                                                   channel, address, **settings))
+        return commutators
+
+    def commutator(self, name):
+        for commutator in self.commutators:
+            if commutator.name == name:
+                return commutator
+        return None
+
+    def commutator_at(self, channel, address):
+        """ Commutator listening on channel at address, None if none."""
+        for commutator in self.commutators:
+            if commutator.channel == channel and commutator.address == list(address):
+                return commutator
+        return None
+
+    def radio(self):
+        return SimulatedRadio(self)
+
+    def card_for(self, commutator):
+        """ Card presented to a commutator: mostly one of its table."""
+        cards = list(commutator.firmware.table)
+        if not cards or self.random.random() < commutator.unknown_rate:
+            return [self.random.randrange(0x100) for n in range(4)]
+        return list(self.random.choice(cards))
+
+    def start_events(self, rate, unknown_rate = 0.1):
+        """ From now on, cards are presented to every commutator at rate
+            per second on average.
+        """
+        now = self.clock()
+        for commutator in self.commutators:
+            commutator.event_rate = rate
+            commutator.unknown_rate = unknown_rate
+            commutator.events_until = now
+
+    def add_past_events(self, num_events, period):
+        """ num_events cards presented to every commutator during the last
+            period seconds.
+        """
+        now = self.clock()
+        for commutator in self.commutators:
+            times = sorted(now - self.uniform(0, period) for n in range(num_events))
+            for when in times:
+                commutator.firmware.card_presented(self.card_for(commutator), when)
+            self.count("events", num_events)
+
+    def lost(self, loss):
+        with self.lock:
+            return loss > 0 and self.random.random() < loss
+
+    def uniform(self, low, high):
+        with self.lock:
+            return self.random.uniform(low, high)
+
+    def expovariate(self, rate):
+        with self.lock:
+            return self.random.expovariate(rate)
+
+    def count(self, name, num = 1):
+        with self.lock:
+            self.stats[name] = self.stats.get(name, 0) + num
+
+    def stats_summary(self):
+        """ Counters of the fleet and its commutators."""
+        summary = dict(self.stats)
+        summary["log_dropped"] = sum(commutator.firmware.num_dropped
+                                     for commutator in self.commutators)
+        summary["eeprom_writes"] = sum(commutator.firmware.eeprom_writes
+                                       for commutator in self.commutators)
+        if summary.get("packets"):
+            summary["packet_loss"] = summary.get("packets_lost", 0) / float(summary["packets"])
+        return summary
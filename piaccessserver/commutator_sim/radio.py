@@ -0,0 +1,319 @@
+# coding: utf-8
+#
+# Stand-in for lib_nrf24's NRF24 on the simulated air of a Fleet: the
+# methods LinkCommand and piaccessserver.py call, with the timing of the
+# datasheet (settling, airtime, auto retransmit delay and count) on the
+# wall clock. write() blocks for as long as the exchange takes on air,
+# write_fast() queues payloads sent back to back and tx_standby() blocks
+# until they are.
+#
+# The replies of the commutators are played lazily: each call first plays
+# the packets sent since the previous one, received only if the radio was
+# listening on the right channel with room in its RX FIFO.
+
+import time
+
+class SimulatedRadio():
+    """ NRF24 talking to the commutators of a Fleet."""
+    # Data rates, as in lib_nrf24
+    BR_1MBPS   = 0
+    BR_2MBPS   = 1
+    BR_250KBPS = 2
+
+    # Timing (s)
+    T_SETTLE   = 130e-6   # Standby to TX or RX
+    T_ARD_STEP = 250e-6   # Auto retransmit delay unit
+
+    FIFO_DEPTH = 3
+    MAX_PAYLOAD_SIZE = 32
+
+    def __init__(self, fleet):
+        self.fleet        = fleet
+        self.channel      = 76
+        self.data_rate    = 1000000
+        self.retry_delay  = 15
+        self.retry_count  = 15
+        self.payload_size = 32
+        self.tx_address   = [0xF0, 0xF0, 0xF0, 0xF0, 0xE1]
+        self.rx_addresses = {}
+        self.powered      = False
+        self.listen_since = None   # Time the radio entered RX mode, None in TX
+        self.rx_fifo      = []
+        self.pid          = 0
+        # Commutator replies on air: [commutator, frames, attempt, time, received]
+        self.transmissions = []
+        self.ack_payload_available = False
+        self.ack_payload_length = 0
+        # Payloads queued by write_fast: results, and times the ones sent end
+        self.tx_results = []
+        self.tx_ends    = []
+
+    # Configuration, as lib_nrf24
+    def begin(self, csn_pin, ce_pin = 0, irq_pin = 0):
+        self.powered = True
+
+    def setChannel(self, channel):
+        self.update()
+        self.channel = channel
+
+    def getChannel(self):
+        return self.channel
+
+    def setRetries(self, delay, count):
+        self.retry_delay = delay & 0x0F
+        self.retry_count = count & 0x0F
+
+    def setDataRate(self, speed):
+        self.data_rate = {self.BR_1MBPS: 1000000,
+                          self.BR_2MBPS: 2000000,
+                          self.BR_250KBPS: 250000}[speed]
+        return True
+
+    def setPayloadSize(self, size):
+        self.payload_size = min(size, self.MAX_PAYLOAD_SIZE)
+
+    def setPALevel(self, level): pass
+    def setAutoAck(self, enable): pass
+    def enableDynamicPayloads(self): pass
+    def enableAckPayload(self): pass
+
+    def openWritingPipe(self, value):
+        self.tx_address = list(value)
+
+    def openReadingPipe(self, child, address):
+        self.rx_addresses[child] = list(address)
+
+    def powerUp(self):
+        self.powered = True
+
+    def powerDown(self):
+        self.update()
+        self.powered = False
+        self.listen_since = None
+
+    def getMaxTimeout(self):
+        return (self.retry_count + 1) * ((self.retry_delay + 1) * self.T_ARD_STEP +
+                                         self.airtime(self.MAX_PAYLOAD_SIZE))
+
+    # Timing
+    def airtime(self, payload_len):
+        # Preamble, address, 9 bits packet control field, payload and CRC
+        bits = 8 * (1 + 5 + payload_len + 2) + 9
+        return bits / float(self.data_rate)
+
+    def ack_delay(self, retry_delay):
+        return (retry_delay + 1) * self.T_ARD_STEP
+
+    # Transmitter
+    def write(self, buf):
+        acked, duration = self.send(buf)
+        time.sleep(duration)
+        return acked
+
+    def send(self, buf):
+        """ Play the transmission of buf with its retransmits. Returns
+            whether it was acknowledged and the time it takes.
+        """
+        now = self.fleet.clock()
+        self.update(now)
+        acked, end = self.play_send(buf, now + self.T_SETTLE)
+        return acked, end - now
+
+    def play_send(self, buf, when):
+        """ Play buf on air from time when, in TX mode. Returns whether it
+            was acknowledged and the time its transmission ends.
+        """
+        # TX mode
+        self.listen_since = None
+        payload = list(bytearray(buf))[:self.MAX_PAYLOAD_SIZE]
+        commutator = self.fleet.commutator_at(self.channel, self.tx_address)
+        self.pid = (self.pid + 1) & 0x03
+        self.ack_payload_available = False
+
+        ack = None
+        for attempt in range(self.retry_count + 1):
+            if attempt > 0:
+                self.fleet.count("retransmits")
+            when += self.airtime(len(payload))
+            self.fleet.count("packets")
+            if commutator is None or not commutator.powered or not self.powered or \
+               commutator.lost():
+                self.fleet.count("packets_lost")
+            else:
+                reply = commutator.receive(self, payload, self.pid, when)
+                if reply is None:
+                    # No room left in the commutator RX FIFO
+                    pass
+                elif commutator.lost():
+                    self.fleet.count("acks_lost")
+                else:
+                    ack = reply
+                    when += self.T_SETTLE + self.airtime(len(reply))
+                    break
+            when += self.ack_delay(self.retry_delay)
+
+        if ack is None:
+            self.fleet.count("writes_failed")
+        elif len(ack) > 0:
+            # The ACK payload lands in the RX FIFO
+            if len(self.rx_fifo) < self.FIFO_DEPTH:
+                self.rx_fifo.append(list(ack))
+                self.ack_payload_available = True
+                self.ack_payload_length = len(ack)
+        return ack is not None, when
+
+    def write_fast(self, buf):
+        """ Queue buf in the TX FIFO, sent right after the payloads queued
+            before it. Returns False if the FIFO is full.
+        """
+        now = self.fleet.clock()
+        if False in self.tx_results:
+            # Stopped on MAX_RT: the payload that failed and the ones queued
+            # behind it stay in the FIFO
+            if len(self.tx_results) - self.tx_results.index(False) >= self.FIFO_DEPTH:
+                return False
+            self.tx_results.append(False)
+            return True
+        if len([end for end in self.tx_ends if end > now]) >= self.FIFO_DEPTH:
+            return False
+        self.update(now)
+        when = now + self.T_SETTLE
+        if self.tx_ends and self.tx_ends[-1] > now:
+            when = self.tx_ends[-1]
+        acked, end = self.play_send(buf, when)
+        self.tx_results.append(acked)
+        self.tx_ends.append(end)
+        return True
+
+    def tx_standby(self, timeout = None):
+        """ Results of the payloads queued by write_fast, once sent."""
+        time.sleep(self.tx_time_left())
+        return self.tx_done()
+
+    def tx_time_left(self):
+        if not self.tx_ends:
+            return 0.0
+        return max(0.0, self.tx_ends[-1] - self.fleet.clock())
+
+    def tx_done(self):
+        # The payloads left in the FIFO are flushed
+        results = self.tx_results
+        self.tx_results = []
+        self.tx_ends    = []
+        return results
+
+    def isAckPayloadAvailable(self):
+        result = self.ack_payload_available
+        self.ack_payload_available = False
+        return result
+
+    # Commutator replies
+    def transmit(self, commutator, frames, when):
+        """ commutator starts sending frames to this radio at time when."""
+        self.transmissions.append([commutator, list(frames), 0, when, False])
+
+    def cancel(self, commutator):
+        """ commutator drops the frames it did not send yet."""
+        self.transmissions = [transmission for transmission in self.transmissions
+                              if transmission[0] is not commutator]
+
+    def listening(self, when, commutator):
+        return self.powered and self.listen_since is not None and \
+               when >= self.listen_since + self.T_SETTLE and \
+               self.channel == commutator.channel
+
+    def update(self, now = None):
+        """ Play the attempts of the commutator replies due by now, in
+            time order.
+        """
+        if now is None:
+            now = self.fleet.clock()
+        while True:
+            due = [transmission for transmission in self.transmissions
+                   if transmission[3] <= now]
+            if not due:
+                return
+            self.play_attempt(min(due, key=lambda transmission: transmission[3]))
+
+    def play_attempt(self, transmission):
+        commutator, frames, attempt, when, received = transmission
+        frame = frames[0]
+        end = when + self.airtime(len(frame))
+        self.fleet.count("packets")
+        if attempt > 0:
+            self.fleet.count("retransmits")
+        acked = False
+        if not self.listening(when, commutator):
+            self.fleet.count("packets_missed")
+        elif commutator.lost():
+            self.fleet.count("packets_lost")
+        elif received or len(self.rx_fifo) < self.FIFO_DEPTH:
+            if not received:
+                self.rx_fifo.append(list(frame))
+                transmission[4] = received = True
+            if commutator.lost():
+                self.fleet.count("acks_lost")
+            else:
+                acked = True
+
+        if acked or attempt >= commutator.retry_count:
+            # Frame done, the next one follows
+            if not received:
+                self.fleet.count("replies_lost")
+            frames.pop(0)
+            if not frames:
+                self.transmissions.remove(transmission)
+                return
+            transmission[2] = 0
+            transmission[3] = end + 2 * self.T_SETTLE + commutator.firmware.command_time
+            transmission[4] = False
+        else:
+            transmission[2] = attempt + 1
+            transmission[3] = end + self.ack_delay(commutator.retry_delay)
+
+    # Receiver
+    def startListening(self):
+        self.update()
+        self.powered = True
+        if self.listen_since is None:
+            self.listen_since = self.fleet.clock()
+
+    def stopListening(self):
+        self.update()
+        self.listen_since = None
+        # As lib_nrf24, both FIFOs are flushed
+        self.rx_fifo = []
+
+    def available(self, pipe_num = None):
+        self.update()
+        return len(self.rx_fifo) > 0
+
+    def getDynamicPayloadSize(self):
+        self.update()
+        if not self.rx_fifo:
+            return 0
+        return len(self.rx_fifo[0])
+
+    def read(self, buf, buf_len = -1):
+        del buf[:]
+        if self.rx_fifo:
+            payload = self.rx_fifo.pop(0)
+            if buf_len < 0:
+                buf_len = len(payload)
+            buf.extend(payload[:buf_len])
+        return len(buf)
+
+    def read_into(self, buf, buf_len = -1):
+        if buf_len < 0:
+            buf_len = len(buf)
+        if not self.rx_fifo:
+            return 0
+        data = self.rx_fifo.pop(0)[:buf_len]
+        buf[:len(data)] = bytearray(data)
+        return len(data)
+
+    def flush_rx(self):
+        self.rx_fifo = []
+
+    def flush_tx(self):
+        pass
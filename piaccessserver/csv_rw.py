@@ -2,6 +2,12 @@
 import string
 import csv
 
+def csv_field(value):
+    # The database returns unicode text, the file is written in UTF-8
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
+
 def member_access_write(filename,
                         machine_req,
                         member_req,
@@ -16,45 +22,37 @@ def member_access_write(filename,
                   'Adhésion valide']
     # Add machine names
     for machine in machine_req:
-        csv_header.append(machine[1])
+        csv_header.append(csv_field(machine[1]))
+
+    # Cards, membership type and machine tags of each member id
+    member_cards = {}
+    for card in card_req:
+        member_cards.setdefault(card[0], []).append([card[1], card[2]])
+    member_types = {}
+    for membership in membership_req:
+        # The last membership found is kept
+        member_types[membership[1]] = membership[2]
+    member_tags = {}
+    for tag in tag_req:
+        member_tags.setdefault(tag[0], set()).add(tag[1])
 
     # Write CSV file with returned results
     with open(filename, 'wb') as csvfile:
         infowriter = csv.writer(csvfile, delimiter=';')
         infowriter.writerow(csv_header)
         for member in member_req:
-            # Id and name
-            csv_member = [member[1], member[0]]
-            # Card number and code
-            for card in card_req:
-                if card[0] == member[1]:
-                    #print("Le membre: %s a la carte #: %s" % (member[0], card[1]))
-                    csv_member.append(card[1])
-                    csv_member.append(card[2])
-            # Membership validity     
-            membership_type = 0;
-            for membership in membership_req:
-                if membership[1] == member[1]:
-                    membership_type = membership[2]
-            csv_member.append(membership_type)
-            # Access to each machine
-            member_machines = []
-            for tag in tag_req:
-                if tag[0] == member[1]:
-                    member_machines.append(tag[1])
-            #print("Le membre %s, machines #: %s" % (member[0], str(member_machines)))
-            for i in range(len(machine_req)):
-                b_machine_found = False
-                for m in member_machines:
-                    if m == machine_req[i][0]:
-                        #print("Le membre %s a accès à %s" % (member[0], machine_req[i][1]))
-                        b_machine_found = True
-                if b_machine_found:
-                    csv_member.append('1')
+            # Membership validity and access to each machine
+            member_access = [member_types.get(member[1], 0)]
+            member_machines = member_tags.get(member[1], set())
+            for machine in machine_req:
+                if machine[0] in member_machines:
+                    member_access.append('1')
                 else:
-                    csv_member.append('0')
-                        
-            infowriter.writerow(csv_member)
+                    member_access.append('0')
+            # One row per card: id, name, card number and code
+            for card in member_cards.get(member[1], [['', '']]):
+                csv_member = [member[1], member[0]] + card + member_access
+                infowriter.writerow([csv_field(field) for field in csv_member])
 
 
 
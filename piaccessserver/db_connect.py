@@ -3,24 +3,53 @@ import ConfigParser
 import logging
 import csv
 import string
-import MySQLdb
+import sqlite3
+try:
+    import MySQLdb
+    db_errors = (MySQLdb.Error, sqlite3.Error)
+except ImportError:
+    # Only a local database (civi_sqlite) can be read
+    MySQLdb = None
+    db_errors = (sqlite3.Error,)
+
+import civi_synthetic
+
+def connect_db(config):
+    """ Connection to the CiviCRM database, or to the local SQLite file
+        standing in for it when civi_sqlite is set.
+    """
+    if config.has_option('DATABASE', 'civi_sqlite') and \
+       config.get('DATABASE', 'civi_sqlite'):
+        # Local SQLite file standing in for CiviCRM (see civi_synthetic.py)
+        return civi_synthetic.connect(config.get('DATABASE', 'civi_sqlite'))
 
-def read_db(commutators, members, memberships, cards, tags, config_filename):
-    # Read parameter file
-    config = ConfigParser.RawConfigParser()
-    config.read(config_filename)
     civi_host = config.get('DATABASE', 'civi_host')
     civi_db   = config.get('DATABASE', 'civi_db')
     civi_user = config.get('DATABASE', 'civi_user')
     civi_pw   = config.get('DATABASE', 'civi_pw')
 
     # Connect to CiviCRM database to retrieve contact parameters
-    db = MySQLdb.connect(host=civi_host, # your host, usually localhost
-                         user=civi_user, # your username
-                         passwd=civi_pw, # your password
-                         db=civi_db,     # name of the data base
-                         charset='utf8',
-                         use_unicode=True) 
+    return MySQLdb.connect(host=civi_host, # your host, usually localhost
+                           user=civi_user, # your username
+                           passwd=civi_pw, # your password
+                           db=civi_db,     # name of the data base
+                           charset='utf8',
+                           use_unicode=True) 
+
+def read_db(commutators, members, memberships, cards, tags, config_filename):
+    # Read parameter file
+    config = ConfigParser.RawConfigParser()
+    config.read(config_filename)
+
+    if MySQLdb is None and not (config.has_option('DATABASE', 'civi_sqlite') and
+                                config.get('DATABASE', 'civi_sqlite')):
+        logging.error("Impossible to retrieve data: MySQLdb is not installed.")
+        return False
+    try:
+        db = connect_db(config)
+    except db_errors as e:
+        logging.error("Impossible to connect to the database: error received: %s" % e)
+        return False
 
     cur = db.cursor()
 
@@ -100,7 +129,7 @@ def read_db(commutators, members, memberships, cards, tags, config_filename):
         tags.extend(tag_req)
         return True
         
-    except MySQLdb.Error as e:
+    except db_errors as e:
         logging.error("Impossible to retrieve data: error received: %s" % e)
         return False
         
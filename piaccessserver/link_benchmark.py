@@ -0,0 +1,396 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Benchmark of the LinkCommand operations over the radio: latency
+# percentiles and packets per second of check, check_memory, update_table
+# and the log retrieval, on a simulated commutator (see commutator_sim) or
+# on a commutator of piaccessserver.ini.
+#
+#     python link_benchmark.py -o bench.json
+#     python link_benchmark.py --full -o bench.json --baseline baseline.json
+#     python link_benchmark.py --hardware Tour -o tour.json
+#
+# The simulated runs vary the table size, log backlog, loss rate and payload
+# format. Results are written as JSON; with --baseline, each result is
+# compared to the one of the same scenario of a previous run, and the exit
+# status is 1 if any got slower than the tolerance allows.
+
+import argparse
+import json
+import logging
+import platform
+import random
+import sys
+import time
+
+from link_command import LinkCommand
+from commutator_sim import Fleet
+
+# Payload formats: one entry per command, frames of entries and log bursts,
+# numbered entries by windows and log bursts, replies in the ACK payload
+PAYLOAD_FORMATS = ["single", "frames", "window", "ack_payload"]
+
+class CountingRadio():
+    """ Radio counting the packets sent and received through it."""
+    def __init__(self, radio):
+        self.radio            = radio
+        self.packets_sent     = 0
+        self.packets_received = 0
+
+    def __getattr__(self, name):
+        return getattr(self.radio, name)
+
+    def write(self, buf):
+        self.packets_sent += 1
+        return self.radio.write(buf)
+
+    def write_fast(self, buf):
+        queued = self.radio.write_fast(buf)
+        if queued:
+            self.packets_sent += 1
+        return queued
+
+    def read_into(self, buf, buf_len = -1):
+        num_bytes = self.radio.read_into(buf, buf_len)
+        if num_bytes:
+            self.packets_received += 1
+        return num_bytes
+
+    def packets(self):
+        return self.packets_sent + self.packets_received
+
+def configure_link(link, payload):
+    if payload == "frames":
+        link.table_frame_entries = 7
+        link.bulk_log = True
+    elif payload == "window":
+        link.table_window = 16
+        link.bulk_log = True
+    elif payload == "ack_payload":
+        link.ack_payload = True
+
+class SimulatedTarget():
+    """ A simulated commutator, alone on its channel."""
+    def __init__(self, name, table_size, log_backlog, loss, payload, seed):
+        self.fleet = Fleet(seed)
+        self.commutator = self.fleet.add_commutator(name, 10,
+                                                    mem_size = max(200, table_size),
+                                                    log_size = max(100, log_backlog),
+                                                    loss = loss)
+        self.commutator.ack_payload = payload == "ack_payload"
+        self.radio = CountingRadio(self.fleet.radio())
+        self.link = LinkCommand(self.radio, self.commutator.channel,
+                                self.commutator.commutator_id, name)
+        configure_link(self.link, payload)
+        self.allow_writes = True
+
+    def clear_table(self):
+        self.commutator.firmware.clear_table([0xA6], 0)
+
+    def add_log_backlog(self, num_entries):
+        self.fleet.add_past_events(num_entries, 3600)
+
+    def air_stats(self):
+        return self.fleet.stats_summary()
+
+class HardwareTarget():
+    """ A commutator of piaccessserver.ini, set up as piaccessserver.py
+    does. Its table and log are left alone unless allow_writes is set.
+    """
+    def __init__(self, commutator_name, allow_writes = False):
+        # Sets the radios up, as when the server runs
+        import piaccessserver
+        self.link = piaccessserver.get_link(commutator_name)
+        self.radio = CountingRadio(self.link.radio)
+        self.link.radio = self.radio
+        self.allow_writes = allow_writes
+
+    def clear_table(self):
+        self.link.clear_memory()
+
+    def add_log_backlog(self, num_entries):
+        # The commutator has its own log
+        pass
+
+    def air_stats(self):
+        return {}
+
+def random_table(table_size, seed):
+    """ Access table of table_size distinct cards, 4 in 5 authorised."""
+    rng = random.Random(seed)
+    cards = set()
+    while len(cards) < table_size:
+        cards.add(rng.randrange(1 << 32))
+    cards = sorted(cards)
+    return [['%08X' % card for card in cards],
+            [rng.random() < 0.8 for card in cards]]
+
+# Operations: prepare the target (not timed) and run once, True if it went fine
+def prepare_none(target, table):
+    pass
+
+def prepare_cleared(target, table):
+    target.clear_table()
+
+def prepare_loaded(target, table):
+    if not getattr(target, "table_loaded", False):
+        target.clear_table()
+        target.link.update_table(table)
+        target.table_loaded = True
+
+def prepare_log(target, table):
+    target.add_log_backlog(target.log_backlog)
+
+def run_check(target, table):
+    return target.link.check()["commutator_ok"]
+
+def run_check_memory(target, table):
+    return target.link.check_memory()["read_ok"]
+
+def run_update_table(target, table):
+    return target.link.update_table(table)["update_ok"]
+
+def run_dump_logging(target, table):
+    link = target.link
+    if not link.bulk_log:
+        return link.dump_logging()["read_ok"]
+    outarg = link.retrieve_log(None)
+    if not outarg["read_ok"]:
+        return False
+    if target.allow_writes and outarg["last_seq"] is not None:
+        return link.erase_log_to(outarg["last_seq"])["commutator_ok"]
+    return True
+
+def dump_logging_writes(target):
+    # Without bulk_log, dump_logging erases each entry once read (0xB0)
+    return not target.link.bulk_log
+
+# Name: preparation, run, whether it writes to the commutator (or a function
+# of the target telling it)
+OPERATIONS = {"check":                  (prepare_none, run_check, False),
+              "check_memory":           (prepare_none, run_check_memory, False),
+              "update_table":           (prepare_cleared, run_update_table, True),
+              "update_table_unchanged": (prepare_loaded, run_update_table, True),
+              "dump_logging":           (prepare_log, run_dump_logging, dump_logging_writes)}
+
+def percentile(values, fraction):
+    """ Percentile of values, None if there are none."""
+    if len(values) == 0:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+def summarize(durations, num_failed, num_packets, elapsed):
+    """ Latencies in ms of the runs that went fine, and packet rate."""
+    summary = {"runs": len(durations) + num_failed,
+               "failed": num_failed,
+               "packets": num_packets,
+               "packets_per_s": num_packets / elapsed if elapsed > 0 else 0.0}
+    for name, fraction in [("p50_ms", 0.50), ("p90_ms", 0.90), ("p99_ms", 0.99),
+                           ("max_ms", 1.0)]:
+        value = percentile(durations, fraction)
+        summary[name] = 1000 * value if value is not None else None
+    summary["mean_ms"] = None
+    if durations:
+        summary["mean_ms"] = 1000 * sum(durations) / len(durations)
+    return summary
+
+def run_benchmark(target, operation, table, runs):
+    """ Run operation runs times on target. Returns the summary."""
+    prepare, run, writes = OPERATIONS[operation]
+    durations = []
+    num_failed = 0
+    num_packets = 0
+    elapsed = 0.0
+    for n in range(runs):
+        prepare(target, table)
+        packets = target.radio.packets()
+        start = time.time()
+        ok = run(target, table)
+        duration = time.time() - start
+        elapsed += duration
+        num_packets += target.radio.packets() - packets
+        if ok:
+            durations.append(duration)
+        else:
+            num_failed += 1
+    return summarize(durations, num_failed, num_packets, elapsed)
+
+def scenario_key(scenario):
+    return "%(operation)s table=%(table_size)d log=%(log_backlog)d " \
+           "loss=%(loss)g payload=%(payload)s" % scenario
+
+def simulated_scenarios(table_sizes, log_backlogs, losses, payloads):
+    """ Operations and conditions to measure: the check commands do not
+        depend on the table or log, nor on the format of their entries.
+    """
+    scenarios = []
+    for payload in payloads:
+        for loss in losses:
+            def add(operation, table_size = 0, log_backlog = 0):
+                scenarios.append({"operation": operation, "table_size": table_size,
+                                  "log_backlog": log_backlog, "loss": loss,
+                                  "payload": payload})
+            if payload in ["single", "ack_payload"]:
+                add("check")
+                add("check_memory")
+            for table_size in table_sizes:
+                add("update_table", table_size)
+                add("update_table_unchanged", table_size)
+            for log_backlog in log_backlogs:
+                add("dump_logging", log_backlog = log_backlog)
+    return scenarios
+
+def compare(results, baseline, tolerance):
+    """ Add the baseline figures to each result of the same scenario.
+        Returns the results whose p90 latency grew by more than tolerance
+        or with more failed runs.
+    """
+    previous = dict((result["key"], result) for result in baseline.get("results", []))
+    regressions = []
+    for result in results:
+        old = previous.get(result["key"])
+        if old is None:
+            continue
+        result["baseline"] = dict((name, old.get(name)) for name in
+                                  ["p50_ms", "p90_ms", "failed", "packets_per_s"])
+        result["p90_ratio"] = None
+        if result["p90_ms"] is not None and old.get("p90_ms"):
+            result["p90_ratio"] = result["p90_ms"] / old["p90_ms"]
+        result["regression"] = result["failed"] > old.get("failed", 0) or \
+                               (result["p90_ratio"] is not None and
+                                result["p90_ratio"] > 1 + tolerance)
+        if result["regression"]:
+            regressions.append(result)
+    return regressions
+
+def print_result(result):
+    def ms(value):
+        if value is None:
+            return "     -"
+        return "%8.1f" % value
+    line = "%-58s p50 %s p90 %s ms %8.0f packets/s" % \
+           (result["key"], ms(result["p50_ms"]), ms(result["p90_ms"]),
+            result["packets_per_s"])
+    if result["failed"]:
+        line += ", %d/%d failed" % (result["failed"], result["runs"])
+    if result.get("p90_ratio") is not None:
+        line += ", x%.2f" % result["p90_ratio"]
+    if result.get("regression"):
+        line += " REGRESSION"
+    print(line)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark of the commutator radio link operations.')
+    parser.add_argument('-o', '--output', help='JSON file the results are written to.')
+    parser.add_argument('-b', '--baseline', help='JSON results of a previous run to compare with.')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='p90 latency growth over the baseline taken as a regression (default 0.2).')
+    parser.add_argument('--full', action='store_true',
+                        help='Tables of 100 to 20000 cards, larger log backlogs and loss rates.')
+    parser.add_argument('--table-sizes', help='Comma separated table sizes.')
+    parser.add_argument('--log-backlogs', help='Comma separated log backlogs.')
+    parser.add_argument('--losses', help='Comma separated packet loss rates.')
+    parser.add_argument('--payloads', help='Comma separated payload formats among %s.' %
+                        ', '.join(PAYLOAD_FORMATS))
+    parser.add_argument('--operations', help='Comma separated operations among %s.' %
+                        ', '.join(sorted(OPERATIONS)))
+    parser.add_argument('--repeat', type=int, default=50, help='Runs of the check commands.')
+    parser.add_argument('--runs', type=int, default=3, help='Runs of the table and log operations.')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--hardware', metavar='COMMUTATOR_NAME',
+                        help='Benchmark this commutator of piaccessserver.ini instead.')
+    parser.add_argument('--allow-writes', action='store_true',
+                        help='On hardware, replace the commutator table with a test table and erase its log.')
+    args = parser.parse_args()
+
+    logging.basicConfig(filename='link_benchmark.log',
+                        format='%(asctime)s:%(levelname)s:%(funcName)s:%(message)s',
+                        level=logging.INFO)
+
+    table_sizes  = [100, 1000]
+    log_backlogs = [0, 100]
+    losses       = [0.0, 0.05]
+    if args.full:
+        table_sizes  = [100, 1000, 5000, 20000]
+        log_backlogs = [0, 100, 1000]
+        losses       = [0.0, 0.02, 0.1, 0.2]
+    payloads   = PAYLOAD_FORMATS
+    operations = sorted(OPERATIONS)
+    if args.table_sizes:
+        table_sizes = [int(value) for value in args.table_sizes.split(',')]
+    if args.log_backlogs:
+        log_backlogs = [int(value) for value in args.log_backlogs.split(',')]
+    if args.losses:
+        losses = [float(value) for value in args.losses.split(',')]
+    if args.payloads:
+        payloads = args.payloads.split(',')
+    if args.operations:
+        operations = args.operations.split(',')
+
+    if args.hardware:
+        try:
+            hardware = HardwareTarget(args.hardware, args.allow_writes)
+        except (ImportError, SyntaxError) as e:
+            print("No radio hardware available (%s)." % e)
+            sys.exit(2)
+        # Loss and payload format are those of the commutator
+        scenarios = [{"operation": operation, "table_size": 0, "log_backlog": 0,
+                      "loss": 0, "payload": "configured"}
+                     for operation in ["check", "check_memory", "dump_logging"]]
+        for table_size in table_sizes:
+            scenarios.extend({"operation": operation, "table_size": table_size,
+                              "log_backlog": 0, "loss": 0, "payload": "configured"}
+                             for operation in ["update_table", "update_table_unchanged"])
+    else:
+        scenarios = simulated_scenarios(table_sizes, log_backlogs, losses, payloads)
+    scenarios = [scenario for scenario in scenarios if scenario["operation"] in operations]
+
+    results = []
+    for scenario in scenarios:
+        prepare, run, writes = OPERATIONS[scenario["operation"]]
+        key = scenario_key(scenario)
+        table = random_table(scenario["table_size"], args.seed)
+        if args.hardware:
+            target = hardware
+            if callable(writes):
+                writes = writes(target)
+            if writes and not args.allow_writes:
+                continue
+            target.table_loaded = False
+        else:
+            target = SimulatedTarget(key, scenario["table_size"], scenario["log_backlog"],
+                                     scenario["loss"], scenario["payload"], args.seed)
+        target.log_backlog = scenario["log_backlog"]
+        runs = args.runs
+        if scenario["operation"] in ["check", "check_memory"]:
+            runs = args.repeat
+        result = dict(scenario)
+        result["key"] = key
+        result.update(run_benchmark(target, scenario["operation"], table, runs))
+        result["air"] = target.air_stats()
+        results.append(result)
+        print_result(result)
+
+    regressions = []
+    if args.baseline:
+        with open(args.baseline, 'r') as baseline_file:
+            baseline = json.load(baseline_file)
+        regressions = compare(results, baseline, args.tolerance)
+        print("\n%d results compared with %s, %d regressions." %
+              (len([result for result in results if "baseline" in result]),
+               args.baseline, len(regressions)))
+        for result in regressions:
+            print_result(result)
+
+    if args.output:
+        report = {"created": time.strftime("%Y-%m-%d %H:%M:%S"),
+                  "target": args.hardware or "simulated",
+                  "python": platform.python_version(),
+                  "seed": args.seed,
+                  "results": results}
+        with open(args.output, 'w') as output_file:
+            json.dump(report, output_file, indent=1, sort_keys=True)
+
+    if regressions:
+        sys.exit(1)
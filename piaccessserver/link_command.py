@@ -1,85 +1,256 @@
 import time
 from datetime import timedelta, datetime
 import logging
+import struct
+import random
+import hashlib
+
+from retry_policy import RetryPolicy
+from circuit_breaker import CircuitBreaker
+
+def entry_hash(card_bytes, auth):
+    """ 32 bits FNV-1a hash of a table entry: 4 card ID bytes then the
+        authorisation byte.
+    """
+    entry_hash = 0x811C9DC5
+    for byte in list(card_bytes) + [int(auth)]:
+        entry_hash = ((entry_hash ^ byte) * 0x01000193) & 0xFFFFFFFF
+    return entry_hash
 
 class LinkCommand():
     """ A single radio is shared between several LinkCommand instances,
     each with its own RF channel.
+    With ack_payload set, the commutator returns its replies in the
+    auto-ACK payload instead of a separate reply packet.
+    With bulk_log set, log entries are retrieved by bursts of frames
+    holding several entries each, instead of one entry per command. Each
+    frame carries the sequence number of its first entry, see
+    read_log_burst.
+    With table_digest set, sync_table first asks the commutator for the
+    digest of its table and skips the update when it is up to date.
+    With table_frame_entries set, update_table packs that many entries in
+    each frame; the commutator may accept fewer per frame.
+    With table_window set, update_table keeps that many entries in flight
+    and the commutator acknowledges them together.
+    With log_handler set, each log entry is passed to it as soon as it is
+    received, log_handler(code, user, time, seq), instead of being kept in
+    the outputs of dump_logging and retrieve_log.
+    Reply timeouts and retry delays adapt to each commutator link, see
+    retry_policy.py. Commands to a commutator that stopped answering fail
+    at once for a while, see circuit_breaker.py. An interrupted table
+    update resumes where it stopped, see table_journal.py.
     """
-    def __init__(self, radio, channel, commutator_id, commutator_name):
+    # Channel and power state of each radio, shared by all its links
+    radio_states = {}
+    # Retry policy of each commutator, shared by all its links
+    retry_policies = {}
+    # Circuit breaker of each commutator, shared by all its links
+    circuit_breakers = {}
+
+    def __init__(self, radio, channel, commutator_id, commutator_name,
+                 ack_payload = False):
         self.radio         = radio
         self.channel       = channel
         self.commutator_id    = commutator_id
         self.commutator_name  = commutator_name
+        self.ack_payload   = ack_payload
         self.wait_rx_sleep = 0.000001
-        self.wait_rx_retry = 10000
+        self.wait_rx_timeout = 0.5
         self.num_retries   = 10
-        self.retry_len     = 0.05
+        self.bulk_log      = False
+        self.log_burst_frames = 8
+        self.table_digest  = False
+        self.table_frame_entries = 0
+        self.table_window  = 0
+        self.log_handler   = None
         
+    def radio_state(self):
+        """ Channel, power state and retune counters of the radio."""
+        if self.radio not in LinkCommand.radio_states:
+            LinkCommand.radio_states[self.radio] = {"channel": None,
+                                                    "powered": False,
+                                                    "retunes": 0,
+                                                    "retunes_avoided": 0}
+        return LinkCommand.radio_states[self.radio]
+
+    def retry_policy(self):
+        """ Reply times and losses of the commutator, and what is derived
+            from them.
+        """
+        if self.commutator_name not in LinkCommand.retry_policies:
+            LinkCommand.retry_policies[self.commutator_name] = \
+                RetryPolicy(self.wait_rx_timeout)
+        return LinkCommand.retry_policies[self.commutator_name]
+
+    def retry_delay(self, num_failures):
+        """ Record a write that got no ACK, the num_failures-th in a row.
+            Returns the delay before writing again.
+        """
+        policy = self.retry_policy()
+        policy.record_loss()
+        return policy.backoff(num_failures)
+
+    def circuit_breaker(self):
+        """ Whether the commutator answered its last commands."""
+        if self.commutator_name not in LinkCommand.circuit_breakers:
+            LinkCommand.circuit_breakers[self.commutator_name] = CircuitBreaker()
+        return LinkCommand.circuit_breakers[self.commutator_name]
+
+    def link_allowed(self, command):
+        """ Check command can be sent to the commutator, see
+            CircuitBreaker.allow.
+        """
+        if self.circuit_breaker().allow():
+            return True
+        logging.warning("%s is not answering, %s command not sent.",
+                        self.commutator_name, hex(command[0]))
+        return False
+
+    def link_failed(self):
+        """ The commutator did not acknowledge a command despite retries."""
+        self.forget_radio_state()
+        self.circuit_breaker().record_failure()
+
+    def forget_radio_state(self):
+        """ Force the next init_radio to reconfigure the radio, for
+            example after a link failure that may come from a radio reset.
+        """
+        state = self.radio_state()
+        state["channel"] = None
+        state["powered"] = False
+
     def init_radio(self):
         """ Used to send any command and check for ACK """
-        # Configure the radio on the right RF channel for the commutator
+        # Leave RX mode and drop any late reply from a previous command
         self.radio.stopListening()
+
+        state = self.radio_state()
+        if state["channel"] == self.channel and state["powered"]:
+            # Already tuned and powered for this commutator
+            state["retunes_avoided"] += 1
+            return
+
+        # Configure the radio on the right RF channel for the commutator
         self.radio.powerDown()
         self.radio.setChannel(self.channel)
         self.radio.powerUp()
+        state["channel"] = self.channel
+        state["powered"] = True
+        state["retunes"] += 1
 
         logging.debug("LinkCommand-init_radio: Radio initialised for %s on channel %d.",
                       self.commutator_name, self.channel)
         
     def send_command(self, command, rx_len = 1):
         """ Used to send any command and check for ACK """
-        
+        # Initialise outputs
+        outarg = self.command_outarg()
+        if not self.link_allowed(command):
+            return outarg
+        num_attempts = self.command_attempts()
+
         # Initialise radio
         self.init_radio()
-
-        # Initialise outputs
-        outarg = {"link_ok":    False,
-                  "commutator_ok": False,
-                  "reply_ok":   False,
-                  "reply_buf":  []}
         
-        read_buf = []
+        read_buf = bytearray(rx_len)
+        read_len = 0
         read_check = False
         check_iter = 0
-        while not read_check and check_iter < self.num_retries:
+        policy = self.retry_policy()
+        while not read_check and check_iter < num_attempts:
+            if check_iter > 0:
+                # Only wait after a failure, longer after each one
+                time.sleep(policy.backoff(check_iter))
             if self.radio.write(command):
                 # Write successful
                 outarg["link_ok"] = True
-                self.radio.startListening()
-                if self.wait_rx():
-                    logging.debug("Transmission of %s command acknowledged.",
-                                  hex(command[0]))
-                    self.radio.read(read_buf, rx_len)
-                    if len(read_buf) == rx_len:
-                        # Check received state
-                        if   read_buf[0] == 0xA0:
-                            outarg["reply_ok"]   = True
-                            logging.error("Machine %s has a problem. Please verify.",
-                                          self.commutator_name)
-                            read_check = True
-                        elif read_buf[0] == 0xAF:
-                            outarg["commutator_ok"] = True
-                            outarg["reply_ok"]   = True
-                            read_check = True
-                        else:
-                            # The value is not expected
-                            logging.warning("Machine %s reply state (%d) is unexpected (expecting 0 or 175).",
-                                            self.commutator_name, read_buf[0])
-                    else:
-                        logging.warning("Machine %s reply data length (%d) should be %d.",
-                                        self.commutator_name, len(read_buf), rx_len)
-
-                else:
-                    logging.warning("No response from %s.",
-                                    self.commutator_name)
+                reply_len = self.receive_reply(read_buf, rx_len,
+                                               attempt = check_iter)
+                if reply_len is not None:
+                    read_len = reply_len
+                read_check = self.check_reply(outarg, command, read_buf,
+                                              reply_len, rx_len)
+            else:
+                policy.record_loss()
             check_iter += 1
-            time.sleep(self.retry_len)
             
-        for byte in read_buf:
+        return self.end_command(outarg, read_buf, read_len)
+
+    def command_outarg(self):
+        """ Outputs of send_command before anything was sent."""
+        return {"link_ok":    False,
+                "commutator_ok": False,
+                "reply_ok":   False,
+                "reply_buf":  []}
+
+    def command_attempts(self):
+        """ Number of times send_command may write a command."""
+        if self.circuit_breaker().probing():
+            # A single try tells whether the commutator is back
+            return 1
+        return self.num_retries
+
+    def check_reply(self, outarg, command, read_buf, reply_len, rx_len):
+        """ Check the commutator state in a command reply, None if no reply
+            came. Returns True if the command needs no retry.
+        """
+        if reply_len is None:
+            logging.warning("No response from %s.",
+                            self.commutator_name)
+            return False
+        logging.debug("Transmission of %s command acknowledged.",
+                      hex(command[0]))
+        if reply_len != rx_len:
+            logging.warning("Machine %s reply data length (%d) should be %d.",
+                            self.commutator_name, reply_len, rx_len)
+            return False
+
+        # Check received state
+        if   read_buf[0] == 0xA0:
+            outarg["reply_ok"]   = True
+            logging.error("Machine %s has a problem. Please verify.",
+                          self.commutator_name)
+            return True
+        elif read_buf[0] == 0xAF:
+            outarg["commutator_ok"] = True
+            outarg["reply_ok"]   = True
+            return True
+        # The value is not expected
+        logging.warning("Machine %s reply state (%d) is unexpected (expecting 0 or 175).",
+                        self.commutator_name, read_buf[0])
+        return False
+
+    def end_command(self, outarg, read_buf, read_len):
+        """ Copy the reply to outarg once the command is over."""
+        if not outarg["link_ok"]:
+            self.link_failed()
+        else:
+            self.circuit_breaker().record_success()
+        for byte in read_buf[:read_len]:
             outarg["reply_buf"].append(byte)
         return outarg    
     
+    def command_ok(self, outarg, action):
+        """ Check the command in outarg was executed, logging the action
+            that could not be done otherwise.
+        """
+        if outarg["link_ok"] and outarg["reply_ok"] and outarg["commutator_ok"]:
+            return True
+        logging.warning("Unable to %s from %s", action, self.commutator_name)
+        return False
+
+    def write_retry(self, command, num_failures, max_failures = 11):
+        """ Delay before writing command again once num_failures writes of
+            it failed, None when the link is taken as down after
+            max_failures.
+        """
+        if num_failures >= max_failures:
+            logging.warning("Unable to write %s command to %s. Radio link is down.",
+                            hex(command[0]), self.commutator_name)
+            self.link_failed()
+            return None
+        return self.retry_delay(num_failures)
+
     def check(self):
         """ Send the check command."""
         return self.send_command([0xA9])
@@ -110,180 +281,1015 @@ class LinkCommand():
 
     def dump_logging(self):
         """ Send the dump logging command."""
+        if self.bulk_log:
+            return self.dump_logging_bulk()
+
         # Initialise outputs
+        outarg = self.log_outarg()
+
+        # Ask for remaining entries one by one
+        while True:
+            # Send command and validate commutator state
+            outarg.update(self.send_command([0xA3], 12))
+            if not self.log_entry_received(outarg):
+                return outarg
+
+            # Command commutator to erase this entry
+            outarg.update(self.send_command([0xB0]))
+            if not self.log_entry_erased(outarg):
+                return outarg
+
+    def log_outarg(self, seqs = False):
+        """ Outputs of a log retrieval before any entry was received, with
+            a list of their sequence numbers if seqs is set.
+        """
         outarg = {"read_ok": False}
         outarg["log_count"] = 0
         outarg["log_codes"] = []
         outarg["log_users"] = []
         outarg["log_times"] = []
+        if seqs:
+            outarg["log_seqs"] = []
+        return outarg
 
-        # Ask for remaining entries one by one
-        num_entries = 1
-        while num_entries > 0:
-            # Send command and validate commutator state
-            cmd_state = self.send_command([0xA3], 12)
-            outarg.update(cmd_state)
-
-            if not (outarg["link_ok"] and
-                    outarg["reply_ok"] and
-                    outarg["commutator_ok"]):
-                # Command was not executed successfully
-                logging.warning("Unable to retrieve log entries from %s",
-                                self.commutator_name)
-                return outarg
+    def log_entry_received(self, outarg):
+        """ Add the log entry in the reply to a dump logging command to
+            outarg. Returns True if there was one, to erase before asking
+            for the next; outarg["read_ok"] is set once none are left.
+        """
+        if not self.command_ok(outarg, "retrieve log entries"):
+            return False
+        # Read the remainder of the packet
+        num_entries = self.read_log_entry(outarg)
+        if num_entries == 0:
+            # No log entries to add
+            outarg["read_ok"] = True
+        return bool(num_entries)
 
-            # Read the remainder of the packet
-            read_buf = outarg["reply_buf"][1:]
-            if len(read_buf) == 11:
-                # Make sure first element is the command
-                if (read_buf[0] != 0xA3):
-                    logging.error("%s did not answer with sent command as expected.",
-                                  self.commutator_name)
-                    return outarg
-                
-                # Read number of remaining entries
-                num_entries = read_buf[1]
-                if num_entries == 0:
-                    # No log entries to add
-                    outarg["read_ok"] = True
-                    logging.debug("No new log entries for %s.",
-                                  self.commutator_name)
+    def read_log_entry(self, outarg):
+        """ Add the log entry in the reply to a dump logging command to
+            outarg. Returns the number of entries the commutator had left,
+            None if the reply is invalid.
+        """
+        read_buf = outarg["reply_buf"][1:]
+        if len(read_buf) != 11:
+            # Not enough data bytes were received
+            logging.error("Machine %s reply data length (%d) should be %d.",
+                              self.commutator_name, len(read_buf), 11)
+            return None
+
+        # Make sure first element is the command
+        if (read_buf[0] != 0xA3):
+            logging.error("%s did not answer with sent command as expected.",
+                          self.commutator_name)
+            return None
+        
+        # Read number of remaining entries
+        num_entries = read_buf[1]
+        if num_entries == 0:
+            # No log entries to add
+            logging.debug("No new log entries for %s.",
+                          self.commutator_name)
+            return 0
+        
+        # Only update log count if higher
+        outarg["log_count"] = max(num_entries, outarg["log_count"])
+        self.add_log_entry(outarg, read_buf[2:11])
+        return num_entries
+
+    def add_log_entry(self, outarg, entry, seq = None):
+        """ Add a 9 bytes log entry (event code, 4 bytes user, 4 bytes
+            age in seconds, LSB first) to outarg, or pass it to
+            log_handler. seq is its sequence number, None if unknown.
+        """
+        code = entry[0]
+        user = entry[1:5]
+        
+        # Immediately convert elapsed time in seconds
+        # to UTC date and time for logging
+        unsigned_long_time = entry[5] + 256 * (entry[6] + 256 * (entry[7] + 256 * entry[8]))
+        log_time = datetime.now() - timedelta(seconds=unsigned_long_time)
+        logging.info("Machine: %s; Time: %s; Event code %s; User %s",
+                     self.commutator_name,
+                     str(log_time.strftime("%Y-%m-%d %H:%M:%S")),
+                     hex(code),
+                     hex(0x01000000 * user[0] + 
+                     0x00010000 * user[1] + 
+                     0x00000100 * user[2] + 
+                     user[3]))
+        if self.log_handler is not None:
+            self.log_handler(code, user, log_time, seq)
+            return
+        outarg["log_codes"].append(code)
+        outarg["log_users"].append(user)
+        outarg["log_times"].append(log_time)
+        if seq is not None:
+            outarg["log_seqs"].append(seq)
+
+    def dump_logging_bulk(self):
+        """ Retrieve the log entries by bursts of frames (0xB1), then have
+            the commutator erase them up to the last one received (0xB2).
+        """
+        # Initialise outputs
+        outarg = self.log_outarg(True)
+
+        last_seq = None
+        num_failures = 0
+        more = True
+        while more:
+            burst = self.log_burst_received(outarg, self.log_burst(), last_seq)
+            if burst is None:
+                return outarg
+            seq, more = burst
+            if seq != last_seq:
+                # Command commutator to erase the entries received
+                outarg.update(self.send_command([0xB2, seq & 0xFF, seq >> 8]))
+                if not self.log_entry_erased(outarg):
                     return outarg
-                
-                # Only update log count if higher
-                outarg["log_count"] = max(num_entries, outarg["log_count"])
-                outarg["log_codes"].append(read_buf[2])
-                outarg["log_users"].append(read_buf[3:7])
-                
-                # Immediately convert elapsed time in seconds
-                # to UTC date and time for logging
-                unsigned_long_time = read_buf[7] + 256 * (read_buf[8] + 256 * (read_buf[9] + 256 * read_buf[10]))
-                outarg["log_times"].append(datetime.now() - \
-                                       timedelta(seconds=unsigned_long_time))
-                logging.info("Machine: %s; Time: %s; Event code %s; User %s",
-                             self.commutator_name,
-                             str(outarg["log_times"][-1].strftime("%Y-%m-%d %H:%M:%S")),
-                             hex(outarg["log_codes"][-1]),
-                             hex(0x01000000 * outarg["log_users"][-1][0] + 
-                             0x00010000 * outarg["log_users"][-1][1] + 
-                             0x00000100 * outarg["log_users"][-1][2] + 
-                             outarg["log_users"][-1][3]))
-                             
-                # Command commutator to erase this entry
-                cmd_state = self.send_command([0xB0])
-                outarg.update(cmd_state)
-                if not (outarg["link_ok"] and
-                        outarg["reply_ok"] and
-                        outarg["commutator_ok"]):
-                    # Command was not executed successfully
-                    logging.warning("Unable to make %s delete an entry that's been written to event log file.",
-                                    self.commutator_name)
+                last_seq = seq
+            elif more:
+                # Entries are waiting but none came through
+                num_failures += 1
+                if self.log_stalled(num_failures):
                     return outarg
 
-            else:
-                # Not enough data bytes were received
-                logging.error("Machine %s reply data length (%d) should be %d.",
-                                  self.commutator_name, len(read_buf), 11)
+        # Everything went fine
+        outarg["read_ok"] = True
+        return outarg
+
+    def retrieve_log(self, stored_seq):
+        """ Retrieve the log entries following stored_seq, the sequence
+            number of the last entry already stored (None to start from the
+            oldest), by bursts of frames. Nothing is erased: once the
+            entries are stored, erase_log_to(outarg["last_seq"]) has the
+            commutator erase them. A retrieval cut short can thus start
+            again from the last entry stored, without loss or duplicates.
+        """
+        # Initialise outputs
+        outarg = self.log_outarg(True)
+        outarg["last_seq"] = stored_seq
+
+        num_failures = 0
+        more = True
+        while more:
+            last_seq = outarg["last_seq"]
+            frames = self.log_burst(last_seq)
+            if frames:
+                last_seq = self.log_start(frames, last_seq)
+            burst = self.log_burst_received(outarg, frames, last_seq)
+            if burst is None:
                 return outarg
-        
+            seq, more = burst
+            outarg["last_seq"] = seq
+            if seq == last_seq and more:
+                # Entries are waiting but none came through
+                num_failures += 1
+                if self.log_stalled(num_failures):
+                    return outarg
+
         # Everything went fine
-        outarg["read_ok"] = True  
-        return outarg                
+        outarg["read_ok"] = True
+        return outarg
+
+    def log_start(self, frames, last_seq):
+        """ Sequence number of the last entry stored, given a burst asked
+            to start right after last_seq. A commutator that no longer
+            holds that entry (log overflow or restart) starts from its
+            oldest one: the entries before it are lost.
+        """
+        frame = frames[0]
+        if last_seq is None or len(frame) < 5 or frame[1] != 0xB1:
+            return last_seq
+        frame_seq = frame[2] + 0x100 * frame[3]
+        if frame_seq != (last_seq + 1) & 0xFFFF:
+            logging.warning("Log of %s goes on from entry %d instead of %d, entries were lost or its log restarted.",
+                            self.commutator_name, frame_seq, (last_seq + 1) & 0xFFFF)
+            return (frame_seq - 1) & 0xFFFF
+        return last_seq
+
+    def erase_log_to(self, seq):
+        """ Have the commutator erase its log entries up to seq included
+            ([0xB2, seq LSB, seq MSB]), once they are stored.
+        """
+        outarg = self.send_command([0xB2, seq & 0xFF, seq >> 8])
+        self.log_entry_erased(outarg)
+        return outarg
+
+    def log_command(self, last_seq):
+        """ Bulk dump command: [0xB1, number of frames], followed by the
+            sequence number of the first entry wanted (2 bytes, LSB first)
+            unless the burst starts from the oldest entry (last_seq None).
+        """
+        command = [0xB1, self.log_burst_frames]
+        if last_seq is not None:
+            seq = (last_seq + 1) & 0xFFFF
+            command.extend([seq & 0xFF, seq >> 8])
+        return command
+
+    def log_burst(self, last_seq = None):
+        """ Send the bulk dump command and collect the burst of frames that
+            follows. Returns the frames received, None if the command was
+            not acknowledged.
+        """
+        if not self.link_allowed([0xB1]):
+            return None
+        self.init_radio()
+        command = self.log_command(last_seq)
+        num_retries = 0
+        while not self.radio.write(command):
+            num_retries += 1
+            delay = self.write_retry(command, num_retries, self.num_retries)
+            if delay is None:
+                return None
+            time.sleep(delay)
+        self.circuit_breaker().record_success()
+
+        frames = []
+        while len(frames) < self.log_burst_frames:
+            read_buf = bytearray(32)
+            read_len = self.receive_reply(read_buf, 32, True)
+            if not read_len:
+                break
+            frames.append(read_buf[:read_len])
+            if self.last_log_frame(frames[-1]):
+                break
+        return frames
+
+    def last_log_frame(self, frame):
+        """ Check frame is the last one of its burst."""
+        return len(frame) < 5 or not frame[4] & 0x80
+
+    def log_burst_received(self, outarg, frames, last_seq):
+        """ Add the log entries of a burst of frames (None if the bulk dump
+            command was not acknowledged) to outarg, see read_log_burst.
+            Returns the sequence number of the last entry received and
+            whether more are waiting, None if the retrieval cannot go on.
+        """
+        outarg["link_ok"] = frames is not None
+        if not frames:
+            logging.warning("Unable to retrieve log entries from %s",
+                            self.commutator_name)
+            return None
+        burst = self.read_log_burst(outarg, frames, last_seq)
+        if not outarg["commutator_ok"]:
+            return None
+        return burst
+
+    def log_stalled(self, num_failures):
+        """ Check whether a log retrieval that got no new entries from
+            num_failures bursts in a row gives up.
+        """
+        if num_failures < self.num_retries:
+            return False
+        logging.warning("Unable to retrieve log entries from %s",
+                        self.commutator_name)
+        return True
+
+    def read_log_burst(self, outarg, frames, last_seq):
+        """ Add the log entries of a burst of frames to outarg, skipping
+            the ones already received (up to last_seq) and stopping at a
+            missing frame. Each frame holds the commutator state, 0xB1,
+            the 2 bytes sequence number of its first entry (LSB first), the
+            number of entries in its low nibble with bit 7 set if more
+            entries follow, then up to 3 entries of 9 bytes.
+            Returns the sequence number of the last entry received and
+            whether more entries are waiting.
+        """
+        outarg["reply_ok"] = True
+        outarg["commutator_ok"] = False
+        seq = last_seq
+        more = True
+        for frame in frames:
+            if len(frame) < 5 or frame[1] != 0xB1:
+                logging.error("%s did not answer with sent command as expected.",
+                              self.commutator_name)
+                break
+            if frame[0] != 0xAF:
+                logging.error("Machine %s has a problem. Please verify.",
+                              self.commutator_name)
+                outarg["commutator_ok"] = False
+                return seq, False
+            outarg["commutator_ok"] = True
+            num_entries = frame[4] & 0x0F
+            if len(frame) != 5 + 9 * num_entries:
+                logging.error("Machine %s reply data length (%d) should be %d.",
+                              self.commutator_name, len(frame), 5 + 9 * num_entries)
+                break
+            frame_seq = frame[2] + 0x100 * frame[3]
+            if seq is not None and 0 < ((frame_seq - seq - 1) & 0xFFFF) < 0x8000:
+                # Starts after the entry expected next: a frame was lost
+                break
+            for n in range(num_entries):
+                entry_seq = (frame_seq + n) & 0xFFFF
+                if seq is not None and not 0 < ((entry_seq - seq) & 0xFFFF) < 0x8000:
+                    # Already received before its erase command failed
+                    continue
+                self.add_log_entry(outarg, frame[5 + 9 * n:14 + 9 * n], entry_seq)
+                outarg["log_count"] += 1
+                seq = entry_seq
+            more = bool(frame[4] & 0x80)
+
+        if seq is None or seq == last_seq:
+            logging.debug("No new log entries for %s.",
+                          self.commutator_name)
+        return seq, more
+
+    def log_entry_erased(self, outarg):
+        """ Check the reply to the erase command sent after a log entry."""
+        if not (outarg["link_ok"] and
+                outarg["reply_ok"] and
+                outarg["commutator_ok"]):
+            # Command was not executed successfully
+            logging.warning("Unable to make %s delete an entry that's been written to event log file.",
+                            self.commutator_name)
+            return False
+        return True
                     
     def update_table(self, table):
         """ Send each access table entry. The table is a 2 elements list:
             [0] List of 4 bytes card IDs (ex: table[0][14] = [112, 64, 132, 11])
             [1] List of booleans (ex: table[1][14] = True if card is authorized)
         """
+        if self.table_window:
+            return self.update_table_window(table)
+        if self.table_frame_entries:
+            return self.update_table_frames(table)
+
         # Initialise outputs
         table_size = len(table[0])
-        outarg = {"send_ok":    False,
-                  "recv_ok":    False,
-                  "commutator_ok": False,
-                  "update_ok":  False,
-                  "num_entries": table_size,
-                  "num_authmod": 0,
-                  "num_newcard": 0}
+        outarg = self.table_outarg(table)
+        if not self.link_allowed([0xA4]):
+            return outarg
     
         # Initialise radio
         self.init_radio()
         
         for i in range(table_size):
             # Prepare data to be sent
-            command = [0xA4, table_size-i]
-            command.append(int(table[1][i])) # authorisation
-            for byte_num in range(0, len(table[0][i]), 2):
-                command.append(int(table[0][i][byte_num], 16) * 0x10 + 
-                               int(table[0][i][byte_num+1], 16))
+            command = self.table_command(table, i)
             num_retries = 0
             while not self.radio.write(command):
-                time.sleep(0.010)
                 num_retries = num_retries + 1
-                if num_retries > 10:
-                    logging.warning("Unable to write %s command to %s. Radio link is down.",
-                                     hex(command[0]), self.commutator_name)
+                delay = self.write_retry(command, num_retries)
+                if delay is None:
                     return outarg
+                time.sleep(delay)
             # logging.debug("Command #%d sent.", i)
             # Wait for answer
-            read_buf = []
-            self.radio.startListening()
-            if not self.wait_rx():
-                # Only write operation succeeded, exit
-                outarg["send_ok"] = True
-                logging.warning("No response from %s.",
-                                self.commutator_name)
-                return outarg
-            
-            # Read received buffer
-            self.radio.read(read_buf, 3)
-            
-            if not len(read_buf) == 3:
-                outarg["recv_ok"] = False
-                logging.warning("Machine %s reply data length (%d) is abnormal.",
-                                self.commutator_name, len(read_buf))
-                return outarg
-            
-            # Check received state
-            if read_buf[0] != 0xAF:
-                # Machine has a problem, exit
-                outarg["send_ok"] = True
-                outarg["recv_ok"] = True
-                logging.error("Machine %s has a problem. Please verify.",
-                                  self.commutator_name)
-                return outarg
-                
-            # Check command byte
-            if read_buf[1] != 0xA4:
-                # Returned command does not match, exit
-                outarg["send_ok"] = True
-                logging.error("%s did not answer with sent command as expected.",
-                               self.commutator_name)
+            read_buf = bytearray(3)
+            read_len = self.receive_reply(read_buf, 3)
+            if not self.check_table_reply(outarg, read_buf, read_len, table, i):
                 return outarg
+            outarg["num_acked"] = i + 1
+            if not self.ack_payload:
+                self.radio.stopListening()
             
-            # Check how this entry was managed
-            if read_buf[2] == 0xD1:
-                # No update was required for this card
-                pass
-            elif read_buf[2] == 0xD2:
-                # Authorisation was modified for this card
-                logging.debug("Card #%d modified (%s%s%s%s%s%s%s%s), now auth = %d.", i, table[0][i][0], table[0][i][1], table[0][i][2], table[0][i][3], table[0][i][4], table[0][i][5], table[0][i][6], table[0][i][7], table[1][i])
-                outarg["num_authmod"] += 1
-            elif read_buf[2] == 0xD3:
-                # New card added
-                logging.debug("Card #%d added.", i)
-                outarg["num_newcard"] += 1
-            elif read_buf[2] == 0xDF:
-                # Memory full, exit
-                outarg["send_ok"] = True
-                outarg["recv_ok"] = True
-                logging.error("Memory full on %s. Upgrade Arduino device or remove unused user cards from database.")
+        return self.table_updated(outarg)
+
+    def table_outarg(self, table):
+        """ Outputs of a table update before any entry was sent."""
+        return {"send_ok":    False,
+                "recv_ok":    False,
+                "commutator_ok": False,
+                "update_ok":  False,
+                "num_entries": len(table[0]),
+                "num_authmod": 0,
+                "num_newcard": 0,
+                "num_acked":  0}
+
+    def sync_table(self, table, shadow, journal = None):
+        """ Send only the entries of table that differ from shadow, the
+            table the commutator held after the last successful update
+            (see table_shadow.py). Falls back to a full update_table when
+            there is no shadow or the commutator memory does not match it.
+            outarg["delta"] tells which was done and outarg["shadow"] is
+            the new shadow, still shadow if the update failed: the next
+            run checks it against the commutator memory again, and resumes
+            an interrupted delta update from it.
+            journal is the one left by an interrupted update, see
+            resume_table.
+        """
+        memory = self.table_memory()
+        if self.table_digest and memory["read_ok"] and \
+           self.digest_matches(table, shadow, memory):
+            return self.table_skipped(table, shadow, memory)
+
+        delta, num_new = self.shadow_delta(table, shadow, memory, journal)
+        if delta is not None:
+            outarg = self.resume_table(delta, journal, memory)
+            if outarg["update_ok"] and not self.delta_applied(outarg, delta, num_new):
+                delta = None
+        if delta is None:
+            outarg = self.resume_table(table, journal, memory)
+        cards = self.table_synced(outarg, table, delta, shadow)
+        if cards is not None:
+            outarg["shadow"] = self.new_shadow(cards, self.table_memory())
+        return outarg
+
+    def table_memory(self):
+        """ Commutator memory state for sync_table: the reply to the table
+            digest command with table_digest set, to check memory otherwise.
+        """
+        if self.table_digest:
+            return self.check_digest()
+        return self.check_memory()
+
+    def resume_table(self, table, journal, memory):
+        """ update_table, starting after the entries acknowledged during an
+            interrupted update of the same table (journal, see
+            table_journal.py) unless the commutator memory (reply to a
+            check memory or digest command) shows it lost them since.
+            outarg["resumed"] tells if it did and outarg["journal"] is the
+            journal to keep for the next run, None once the table is sent.
+            Nothing is sent while the memory state is unknown, the journal
+            being kept as it is.
+        """
+        start, journal = self.resume_start(table, journal, memory)
+        if start is None:
+            return self.table_deferred(journal)
+        outarg = self.update_table([table[0][start:], table[1][start:]])
+        return self.table_checkpoint(outarg, start, journal, memory)
+
+    def resume_start(self, table, journal, memory):
+        """ Entry to start the update of table from, with the journal of
+            the update. The entry is None if the memory state (reply to a
+            check memory or digest command) is needed to resume and unknown.
+        """
+        checksum = self.table_checksum(table)
+        start = 0
+        if journal is None:
+            pass
+        elif not memory["read_ok"]:
+            logging.warning("Memory state of %s unavailable, keeping the interrupted update for the next run.",
+                            self.commutator_name)
+            return None, journal
+        elif journal["checksum"] != checksum or journal["num_entries"] != len(table[0]):
+            logging.info("Table of %s changed since the interrupted update, sending it from the start.",
+                         self.commutator_name)
+            journal = None
+        elif memory["mem_used"] < journal["mem_used"] + journal["num_newcard"]:
+            logging.warning("Memory of %s lost entries since the interrupted update, sending the table from the start.",
+                            self.commutator_name)
+            journal = None
+        else:
+            start = journal["num_acked"]
+            logging.info("Resuming the table update of %s at entry %d of %d.",
+                         self.commutator_name, start, len(table[0]))
+        if journal is None:
+            journal = {"checksum": checksum,
+                       "num_entries": len(table[0]),
+                       "num_acked": 0,
+                       "mem_used": memory["mem_used"] if memory["read_ok"] else 0,
+                       "num_newcard": 0,
+                       "num_authmod": 0}
+        return start, journal
+
+    def table_deferred(self, journal):
+        """ Outputs of resume_table when nothing was sent, journal being
+            kept for the next run.
+        """
+        return {"send_ok":    False,
+                "recv_ok":    False,
+                "commutator_ok": False,
+                "update_ok":  False,
+                "num_entries": 0,
+                "num_authmod": 0,
+                "num_newcard": 0,
+                "num_acked":  0,
+                "resumed":    False,
+                "journal":    journal}
+
+    def table_checkpoint(self, outarg, start, journal, memory):
+        """ Complete outarg once the update started at entry start ended."""
+        outarg["resumed"] = start > 0
+        outarg["num_newcard"] += journal["num_newcard"]
+        outarg["num_authmod"] += journal["num_authmod"]
+        outarg["journal"] = None
+        num_acked = start + outarg["num_acked"]
+        if not outarg["update_ok"] and num_acked > 0 and memory["read_ok"]:
+            # Checkpoint for the next run, unless the update started afresh
+            # without a memory state to check the checkpoint against
+            journal = dict(journal)
+            journal["num_acked"] = num_acked
+            journal["num_newcard"] = outarg["num_newcard"]
+            journal["num_authmod"] = outarg["num_authmod"]
+            outarg["journal"] = journal
+        return outarg
+
+    def table_checksum(self, table):
+        """ Checksum of the table entries, in order."""
+        checksum = hashlib.sha1()
+        for card, auth in zip(table[0], table[1]):
+            checksum.update(('%s:%d;' % (card, bool(auth))).encode('ascii'))
+        return checksum.hexdigest()
+
+    def shadow_delta(self, table, shadow, memory, journal = None):
+        """ Delta update to send given the table shadow and the reply to a
+            check memory command, None if the whole table must be sent.
+            Returns it with the number of new cards it holds.
+        """
+        if shadow is None:
+            logging.info("No table shadow for %s, sending the whole table.",
+                         self.commutator_name)
+        elif not memory["read_ok"]:
+            logging.warning("Memory state of %s unavailable, sending the whole table.",
+                            self.commutator_name)
+        elif not self.shadow_valid(shadow, memory) and \
+             not self.delta_pending(table, shadow, memory, journal):
+            logging.warning("Memory of %s does not match its table shadow, sending the whole table.",
+                            self.commutator_name)
+        else:
+            return self.table_delta(table, shadow["cards"])
+        return None, 0
+
+    def shadow_valid(self, shadow, memory):
+        """ Check the commutator memory state (reply to a check memory or
+            digest command) is the one recorded in shadow.
+        """
+        if not memory["read_ok"] or memory["mem_used"] != shadow["mem_used"]:
+            return False
+        if "digest" in memory and "digest" in shadow:
+            return memory["digest"] == shadow["digest"]
+        return True
+
+    def delta_pending(self, table, shadow, memory, journal):
+        """ Check journal is the one of an interrupted delta update from
+            shadow, the commutator memory having grown only by what it sent
+            since (see resume_start).
+        """
+        if journal is None or not memory["read_ok"] or \
+           journal["mem_used"] != shadow["mem_used"]:
+            return False
+        delta = self.table_delta(table, shadow["cards"])[0]
+        return journal["checksum"] == self.table_checksum(delta) and \
+               memory["mem_used"] >= journal["mem_used"] + journal["num_newcard"]
+
+    def new_shadow(self, cards, memory):
+        """ Shadow of the commutator table once it holds cards, None if
+            its memory state is unknown.
+        """
+        if not memory["read_ok"]:
+            return None
+        shadow = {"mem_used": memory["mem_used"], "cards": cards}
+        if "digest" in memory:
+            shadow["digest"] = memory["digest"]
+        return shadow
+
+    def table_synced(self, outarg, table, delta, shadow):
+        """ Complete outarg once the delta (None for the whole table) was
+            sent. Returns the cards of the new shadow, None if the update
+            failed.
+        """
+        outarg["delta"] = delta is not None
+        outarg["skipped"] = False
+        outarg["num_saved"] = 0
+        outarg["table_size"] = len(table[0])
+        # Kept if the update failed, often before anything reached the
+        # commutator
+        outarg["shadow"] = shadow
+        if not outarg["update_ok"]:
+            return None
+        if delta is None:
+            cards = {}
+            delta = table
+        else:
+            cards = dict(shadow["cards"])
+        for card, auth in zip(delta[0], delta[1]):
+            cards[card] = bool(auth)
+        return cards
+
+    def table_cards(self, table, shadow):
+        """ Cards the commutator holds once table is sent, as a dictionary
+            of card ID -> authorisation.
+        """
+        cards = {}
+        if shadow is not None:
+            # Cards left out of the table stay, without authorisation
+            for card in shadow["cards"]:
+                cards[card] = False
+        for card, auth in zip(table[0], table[1]):
+            cards[card] = bool(auth)
+        return cards
+
+    def cards_digest(self, cards):
+        """ Digest of a table (dict of card ID -> authorisation): sum of
+            the entry hashes, so that it does not depend on the order of
+            the entries and is updated entry by entry by the commutator.
+        """
+        digest = 0
+        for card, auth in cards.items():
+            card_bytes = [int(card[byte_num:byte_num+2], 16)
+                          for byte_num in range(0, len(card), 2)]
+            digest += entry_hash(card_bytes, auth)
+        return digest & 0xFFFFFFFF
+
+    def digest_matches(self, table, shadow, memory):
+        """ Check the commutator digest (reply to a digest command) is the
+            one it will have once table is sent.
+        """
+        cards = self.table_cards(table, shadow)
+        num_cards = len(cards)
+        digest = self.cards_digest(cards)
+        if shadow is not None and "digest" in shadow:
+            # Cards the commutator held before the server kept a shadow
+            num_cards += shadow["mem_used"] - len(shadow["cards"])
+            digest += shadow["digest"] - self.cards_digest(shadow["cards"])
+        return memory["mem_used"] == num_cards and \
+               memory["digest"] == digest & 0xFFFFFFFF
+
+    def table_skipped(self, table, shadow, memory):
+        """ Outputs of sync_table when the commutator table is up to date.
+            num_saved is the number of commands the update would have
+            taken, on top of the digest command.
+        """
+        num_sent = len(table[0]) + 1
+        if shadow is not None and self.shadow_valid(shadow, memory):
+            num_sent = len(self.table_delta(table, shadow["cards"])[0]) + 2
+        logging.info("Table of %s is up to date, %d commands saved.",
+                     self.commutator_name, num_sent - 1)
+        return {"send_ok":    True,
+                "recv_ok":    True,
+                "commutator_ok": True,
+                "update_ok":  True,
+                "num_entries": 0,
+                "num_authmod": 0,
+                "num_newcard": 0,
+                "delta":      False,
+                "skipped":    True,
+                "num_saved":  num_sent - 1,
+                "resumed":    False,
+                "journal":    None,
+                "command_time": memory["command_time"],
+                "table_size": len(table[0]),
+                "shadow":     self.new_shadow(self.table_cards(table, shadow), memory)}
+
+    def delta_applied(self, outarg, delta, num_new):
+        """ Check the replies to a delta update match the table shadow."""
+        num_authmod = len(delta[0]) - num_new
+        if outarg["num_newcard"] == num_new and outarg["num_authmod"] == num_authmod:
+            return True
+        logging.warning("%s reported %d new and %d modified cards instead of %d and %d, sending the whole table.",
+                        self.commutator_name, outarg["num_newcard"],
+                        outarg["num_authmod"], num_new, num_authmod)
+        return False
+
+    def table_delta(self, table, cards):
+        """ Entries of table that differ from cards, the shadow of the
+            commutator table (dict of card ID -> authorisation), and the
+            number of them the commutator does not hold yet. The
+            commutator has no command to delete a card: the cards left out
+            of the table lose their authorisation instead.
+        """
+        delta = [[], []]
+        num_new = 0
+        for card, auth in zip(table[0], table[1]):
+            if card not in cards:
+                num_new += 1
+            elif cards[card] == bool(auth):
+                continue
+            delta[0].append(card)
+            delta[1].append(bool(auth))
+        listed = set(table[0])
+        for card in sorted(cards):
+            if cards[card] and card not in listed:
+                delta[0].append(card)
+                delta[1].append(False)
+        return delta, num_new
+
+    def update_table_frames(self, table):
+        """ Send the access table entries by frames of several entries
+            (see table_frame).
+        """
+        # Initialise outputs
+        table_size = len(table[0])
+        outarg = self.table_outarg(table)
+        if not self.link_allowed([0xB4]):
+            return outarg
+
+        # Initialise radio
+        self.init_radio()
+
+        i = 0
+        while i < table_size:
+            # Prepare data to be sent
+            command = self.table_frame(table, i)
+            num_retries = 0
+            while not self.radio.write(command):
+                num_retries = num_retries + 1
+                delay = self.write_retry(command, num_retries)
+                if delay is None:
+                    return outarg
+                time.sleep(delay)
+            # Wait for answer
+            read_buf = bytearray(5)
+            read_len = self.receive_reply(read_buf, 5)
+            num_entries = self.check_frame_reply(outarg, read_buf, read_len,
+                                                 table, i, (len(command) - 4) // 4)
+            if num_entries is None:
                 return outarg
-            else:
-                # Receive error, code not recognised, exit
-                outarg["send_ok"] = True
+            i += num_entries
+            outarg["num_acked"] = i
+            if not self.ack_payload:
+                self.radio.stopListening()
+
+        return self.table_updated(outarg)
+
+    def update_table_window(self, table):
+        """ Send the access table entries without waiting for a reply to
+            each: up to table_window entries are sent, then the commutator
+            acknowledges all the entries received so far (see
+            read_window_status). The entries are numbered, so that only
+            the missing ones are sent again.
+        """
+        # Initialise outputs
+        table_size = len(table[0])
+        outarg = self.table_outarg(table)
+        if not self.link_allowed([0xB5]):
+            return outarg
+
+        # A new session number tells the commutator a new update starts
+        session = random.randrange(0x100)
+        acked = [False] * table_size
+        base = 0
+        num_stalls = 0
+        while base < table_size:
+            # Send the entries of the window not acknowledged yet, back to
+            # back. The radio is still in RX after the window status.
+            self.init_radio()
+            entries = self.window_entries(acked, base)
+            unacked = self.write_window(table, entries, session)
+            if 0 < len(unacked) < len(entries):
+                # Send again at once the entries the radio got no ACK for,
+                # unless none went through (the window status tells why)
+                self.write_window(table, unacked, session)
+
+            # Cumulative and selective acknowledgement
+            status = self.send_command([0xB6, session], 11)
+            progress = self.window_progress(outarg, status, acked, num_stalls)
+            if progress is None:
                 return outarg
-            self.radio.stopListening()
+            base, num_stalls = progress
+
+        return self.table_updated(outarg)
+
+    def window_entries(self, acked, base):
+        """ Entries of the window starting at entry base not acknowledged
+            yet.
+        """
+        window = min(self.table_window, 16)
+        return [i for i in range(base, min(base + window, len(acked)))
+                if not acked[i]]
+
+    def window_progress(self, outarg, status, acked, num_stalls):
+        """ Mark the entries acknowledged in the reply to a window status
+            command (see read_window_status), num_stalls windows in a row
+            having acknowledged none before. Returns the first entry not
+            acknowledged and the new num_stalls, None if the update cannot
+            go on.
+        """
+        num_acked = acked.count(True)
+        base = self.read_window_status(outarg, status, acked)
+        if base is None:
+            return None
+        outarg["num_acked"] = base
+        if acked.count(True) > num_acked:
+            return base, 0
+        num_stalls += 1
+        if num_stalls == self.num_retries:
+            outarg["send_ok"] = True
+            logging.warning("%s acknowledged no table entries after %d windows.",
+                            self.commutator_name, num_stalls)
+            return None
+        return base, num_stalls
+
+    def write_window(self, table, entries, session):
+        """ Queue the numbered entries in the radio TX FIFO (write_fast),
+            waiting for it to drain (tx_standby) whenever it is full.
+            Returns the entries the radio got no ACK for.
+        """
+        unacked = []
+        queued = []
+        for i in entries:
+            command = self.window_command(table, i, session)
+            if not self.radio.write_fast(command):
+                unacked += [j for j, ok in zip(queued, self.radio.tx_standby()) if not ok]
+                queued = []
+                self.radio.write_fast(command)
+            queued.append(i)
+        unacked += [j for j, ok in zip(queued, self.radio.tx_standby()) if not ok]
+        return unacked
+
+    def window_command(self, table, i, session):
+        """ Numbered table entry i:
+            [0xB5, session, sequence number (2 bytes, little endian),
+             authorisation, 4 card ID bytes]
+        """
+        command = [0xB5, session, i & 0xFF, i >> 8, int(table[1][i])]
+        for byte_num in range(0, len(table[0][i]), 2):
+            command.append(int(table[0][i][byte_num], 16) * 0x10 +
+                           int(table[0][i][byte_num+1], 16))
+        return command
+
+    def read_window_status(self, outarg, status, acked):
+        """ Mark the entries acknowledged in the reply to a window status
+            command:
+            [state, 0xB6, next expected entry (2 bytes), entries received
+             after it (2 bytes, bit k for entry next+1+k), cards added
+             (2 bytes), authorisations modified (2 bytes), flags (bit 0:
+             memory full)], little endian, counts since the session start.
+            Returns the first entry not acknowledged, None if the update
+            cannot go on.
+        """
+        if not (status["link_ok"] and status["reply_ok"]):
+            outarg["send_ok"] = status["link_ok"]
+            logging.warning("No window status from %s.",
+                            self.commutator_name)
+            return None
+
+        read_buf = status["reply_buf"]
+        if not status["commutator_ok"]:
+            # Machine has a problem, exit
+            outarg["send_ok"] = True
+            outarg["recv_ok"] = True
+            logging.error("Machine %s has a problem. Please verify.",
+                              self.commutator_name)
+            return None
+        if not len(read_buf) == 11 or read_buf[1] != 0xB6:
+            outarg["send_ok"] = True
+            logging.error("%s did not answer the window status as expected.",
+                          self.commutator_name)
+            return None
+
+        base = min(read_buf[2] + read_buf[3] * 0x100, len(acked))
+        for i in range(base):
+            acked[i] = True
+        received_bits = read_buf[4] + read_buf[5] * 0x100
+        for k in range(16):
+            if received_bits & (1 << k) and base + 1 + k < len(acked):
+                acked[base + 1 + k] = True
+        outarg["num_newcard"] = read_buf[6] + read_buf[7] * 0x100
+        outarg["num_authmod"] = read_buf[8] + read_buf[9] * 0x100
+        logging.debug("Window status of %s: next entry %d, %d added, %d modified.",
+                      self.commutator_name, base,
+                      outarg["num_newcard"], outarg["num_authmod"])
+
+        if read_buf[10] & 0x01:
+            # Memory full, exit
+            outarg["send_ok"] = True
+            outarg["recv_ok"] = True
+            logging.error("Memory full on %s. Upgrade Arduino device or remove unused user cards from database.",
+                          self.commutator_name)
+            return None
+        return base
+
+    def table_frame(self, table, i):
+        """ Table update frame for up to table_frame_entries entries from
+            entry i, 32 bytes at most:
+            [0xB4, remaining (2 bytes, little endian), authorisation bits
+             (bit k for entry i+k), 4 card ID bytes of each entry]
+        """
+        table_size = len(table[0])
+        num_entries = min(self.table_frame_entries, 7, table_size - i)
+        auth_bits = 0
+        for k in range(num_entries):
+            if table[1][i+k]:
+                auth_bits |= 1 << k
+        # Remaining entries on two bytes, saturated for larger tables
+        remaining = min(table_size-i, 0xFFFF)
+        command = [0xB4, remaining & 0xFF, remaining >> 8, auth_bits]
+        for k in range(num_entries):
+            card = table[0][i+k]
+            for byte_num in range(0, len(card), 2):
+                command.append(int(card[byte_num], 16) * 0x10 +
+                               int(card[byte_num+1], 16))
+        return command
+
+    def check_frame_reply(self, outarg, read_buf, read_len, table, i, num_sent):
+        """ Check the reply to a table update frame starting at entry i:
+            [state, 0xB4, number of entries managed, status bits (2 bytes,
+             little endian, 2 bits per entry: 0 unchanged, 1 modified,
+             2 added, 3 memory full)]
+            Returns the number of entries managed, None if the update
+            cannot go on.
+        """
+        if read_len is None:
+            # Only write operation succeeded, exit
+            outarg["send_ok"] = True
+            logging.warning("No response from %s.",
+                            self.commutator_name)
+            return None
+
+        if not read_len == 5 or read_buf[1] != 0xB4:
+            outarg["send_ok"] = True
+            logging.error("%s did not answer the table frame as expected.",
+                          self.commutator_name)
+            return None
+
+        if read_buf[0] != 0xAF:
+            # Machine has a problem, exit
+            outarg["send_ok"] = True
+            outarg["recv_ok"] = True
+            logging.error("Machine %s has a problem. Please verify.",
+                              self.commutator_name)
+            return None
+
+        num_entries = read_buf[2]
+        if num_entries == 0 or num_entries > num_sent:
+            outarg["send_ok"] = True
+            logging.error("%s managed %d entries of a %d entries frame.",
+                          self.commutator_name, num_entries, num_sent)
+            return None
+        status_bits = read_buf[3] + read_buf[4] * 0x100
+        for k in range(num_entries):
+            code = [0xD1, 0xD2, 0xD3, 0xDF][(status_bits >> 2*k) & 3]
+            if not self.count_table_entry(outarg, code, table, i+k):
+                return None
+
+        if num_entries < num_sent:
+            # The commutator takes smaller frames
+            logging.debug("%s takes %d entries per frame.",
+                          self.commutator_name, num_entries)
+            self.table_frame_entries = num_entries
+        return num_entries
+
+    def table_command(self, table, i):
+        """ Table update command for entry i."""
+        table_size = len(table[0])
+        # Remaining entries on one byte, saturated for larger tables
+        command = [0xA4, min(table_size-i, 0xFF)]
+        command.append(int(table[1][i])) # authorisation
+        for byte_num in range(0, len(table[0][i]), 2):
+            command.append(int(table[0][i][byte_num], 16) * 0x10 + 
+                           int(table[0][i][byte_num+1], 16))
+        return command
+
+    def check_table_reply(self, outarg, read_buf, read_len, table, i):
+        """ Check the reply to the update of entry i, None if no reply came.
+            Returns True if the update can go on with the next entry.
+        """
+        if read_len is None:
+            # Only write operation succeeded, exit
+            outarg["send_ok"] = True
+            logging.warning("No response from %s.",
+                            self.commutator_name)
+            return False
+        
+        if not read_len == 3:
+            outarg["recv_ok"] = False
+            logging.warning("Machine %s reply data length (%d) is abnormal.",
+                            self.commutator_name, read_len)
+            return False
+        
+        # Check received state
+        if read_buf[0] != 0xAF:
+            # Machine has a problem, exit
+            outarg["send_ok"] = True
+            outarg["recv_ok"] = True
+            logging.error("Machine %s has a problem. Please verify.",
+                              self.commutator_name)
+            return False
             
+        # Check command byte
+        if read_buf[1] != 0xA4:
+            # Returned command does not match, exit
+            outarg["send_ok"] = True
+            logging.error("%s did not answer with sent command as expected.",
+                           self.commutator_name)
+            return False
+        
+        return self.count_table_entry(outarg, read_buf[2], table, i)
+
+    def count_table_entry(self, outarg, code, table, i):
+        """ Count how entry i was managed by the commutator (0xD1 to 0xDF).
+            Returns True if the update can go on with the next entry.
+        """
+        if code == 0xD1:
+            # No update was required for this card
+            pass
+        elif code == 0xD2:
+            # Authorisation was modified for this card
+            logging.debug("Card #%d modified (%s%s%s%s%s%s%s%s), now auth = %d.", i, table[0][i][0], table[0][i][1], table[0][i][2], table[0][i][3], table[0][i][4], table[0][i][5], table[0][i][6], table[0][i][7], table[1][i])
+            outarg["num_authmod"] += 1
+        elif code == 0xD3:
+            # New card added
+            logging.debug("Card #%d added.", i)
+            outarg["num_newcard"] += 1
+        elif code == 0xDF:
+            # Memory full, exit
+            outarg["send_ok"] = True
+            outarg["recv_ok"] = True
+            logging.error("Memory full on %s. Upgrade Arduino device or remove unused user cards from database.",
+                          self.commutator_name)
+            return False
+        else:
+            # Receive error, code not recognised, exit
+            outarg["send_ok"] = True
+            return False
+        return True
+
+    def table_updated(self, outarg):
+        """ Complete outarg once every entry was accepted."""
+        self.circuit_breaker().record_success()
         outarg["send_ok"] = True
         outarg["recv_ok"] = True
         outarg["update_ok"] = True
@@ -300,30 +1306,28 @@ class LinkCommand():
     def check_memory(self):
         outarg = {"read_ok": False}
         # Send command and validate commutator state
-        cmd_state = self.send_command([0xA5], 6)
-        outarg.update(cmd_state)
-        
-        if not (outarg["link_ok"] and
-                outarg["reply_ok"] and
-                outarg["commutator_ok"]):
-            # Command was not executed successfully
-            logging.warning("Unable to get memory size from %s",
-                             self.commutator_name)
-            return outarg
+        outarg.update(self.send_command([0xA5], 6))
+        if self.command_ok(outarg, "get memory size"):
+            # Read the remainder of the packet
+            outarg["read_ok"] = self.read_memory_state(outarg)
+        return outarg
 
-        # Read the remainder of the packet
+    def read_memory_state(self, outarg):
+        """ Add the memory state in the reply to a check memory command to
+            outarg. Returns False if the reply is invalid.
+        """
         read_buf = outarg["reply_buf"][1:]
         if not len(read_buf) == 5:
             # Invalid message received
             logging.error("%s did not answer with enough bytes.",
                           self.commutator_name)
-            return outarg
+            return False
 
         # Make sure first element is the command
         if (read_buf[0] != 0xA5):
             logging.error("%s did not answer with sent command as expected.",
                                self.commutator_name)
-            return outarg
+            return False
         
         # Read memory state
         outarg["mem_size"] = read_buf[2] + read_buf[1] * 0x100
@@ -332,27 +1336,129 @@ class LinkCommand():
         logging.info("Memory state on %s: %d/%d used.",
                      self.commutator_name, outarg["mem_used"],
                      outarg["mem_size"])
+        return True
 
-        outarg["read_ok"] = True
+    def check_digest(self):
+        """ Send the table digest command."""
+        outarg = {"read_ok": False}
+        # Send command and validate commutator state
+        start = time.time()
+        outarg.update(self.send_command([0xB3], 8))
+        outarg["command_time"] = time.time() - start
+        if self.command_ok(outarg, "get table digest"):
+            # Read the remainder of the packet
+            outarg["read_ok"] = self.read_digest_state(outarg)
         return outarg
 
+    def read_digest_state(self, outarg):
+        """ Add the number of cards and table digest in the reply to a
+            digest command to outarg. Returns False if the reply is invalid.
+        """
+        read_buf = outarg["reply_buf"][1:]
+        if not len(read_buf) == 7 or read_buf[0] != 0xB3:
+            logging.error("%s did not answer the digest command as expected.",
+                          self.commutator_name)
+            return False
+
+        outarg["mem_used"] = read_buf[2] + read_buf[1] * 0x100
+        outarg["digest"] = struct.unpack(">I", bytes(bytearray(read_buf[3:7])))[0]
+        logging.debug("Table digest of %s: %d cards, %08X.",
+                      self.commutator_name, outarg["mem_used"], outarg["digest"])
+        return True
+
     def clear_memory(self):
         """ Send the clear memory command."""
         return self.send_command([0xA6])
     
-    def wait_rx(self):
-        num_retry = 0
+    def receive_reply(self, read_buf, rx_len, frame = False, attempt = 0):
+        """ Read the reply to the command just written into read_buf.
+            Returns the number of bytes read, None if no reply came.
+            With frame set, the reply length varies: only the bytes sent
+            by the commutator are read, up to rx_len. attempt is the
+            number of times the command was already tried.
+        """
+        start = time.time()
+        read_len = self.read_reply(read_buf, rx_len, frame,
+                                   self.retry_policy().reply_timeout(attempt))
+        self.reply_timed(read_len, start)
+        return read_len
+
+    def reply_timed(self, read_len, start):
+        """ Record the reply (read_len None if it was lost) to a command
+            written at time start in the retry policy.
+        """
+        policy = self.retry_policy()
+        if read_len is None:
+            policy.record_loss()
+        else:
+            policy.record_reply(time.time() - start)
+
+    def read_reply(self, read_buf, rx_len, frame, timeout):
+        """ receive_reply, waiting timeout at most."""
+        if not self.ack_payload:
+            # The commutator sends its reply in a packet of its own
+            self.radio.startListening()
+            if not self.wait_rx(timeout):
+                return None
+            return self.read_rx(read_buf, rx_len, frame)
+
+        # The ACK to the command itself can only carry a stale reply
+        self.read_ack_payload(bytearray(32), 32)
+        # Fetch the reply (0xAA) until the commutator has loaded it in its ACK
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if not self.radio.write([0xAA]):
+                return None
+            read_len = self.read_ack_payload(read_buf, rx_len)
+            if read_len is not None:
+                return read_len
+        return None
+
+    def read_rx(self, read_buf, rx_len, frame):
+        """ Read the reply waiting in the radio RX FIFO, see receive_reply."""
+        if frame:
+            rx_len = min(rx_len, self.radio.getDynamicPayloadSize())
+        return self.radio.read_into(read_buf, rx_len)
+
+    def read_ack_payload(self, read_buf, rx_len):
+        """ Read the reply the last ACK carried, up to rx_len bytes. Returns
+            the number of bytes read, None if the ACK carried none.
+        """
+        if not self.radio.isAckPayloadAvailable():
+            return None
+        return self.radio.read_into(read_buf,
+                                    min(rx_len, self.radio.ack_payload_length))
+
+    def wait_rx(self, timeout):
+        deadline = time.time() + timeout
+        if getattr(self.radio, "irq_pin", 0):
+            # Sleep on the radio IRQ line instead of polling its STATUS register
+            while not self.radio.available([0]):
+                remaining = deadline - time.time()
+                if remaining <= 0 or not self.radio.wait_for_event(remaining):
+                    return False
+            return True
+
+        timing = getattr(self.radio, "timing", None)
+        if timing is not None:
+            # Sleeps between polls as below, the overshoot being recorded
+            while not self.radio.available([0]):
+                if time.time() > deadline:
+                    return False
+                timing.poll(self.wait_rx_sleep, "wait_rx")
+            return True
+
         while not self.radio.available([0]):
-            time.sleep(self.wait_rx_sleep)
-            num_retry += 1
-            if num_retry == self.wait_rx_retry:
+            if time.time() > deadline:
                 return False
+            time.sleep(self.wait_rx_sleep)
         return True            
 
 class DummyRadio():
     """ This test class mimics the behaviour of the lib_nrf24.py has used
         for this project. It also allows testing various errors that are
-        less practical to generate with real hardware.
+        less practical to generate with real hardware. For timing, losses
+        and several commutators on the air, see the commutator_sim package.
     """
     def __init__(self):
         # Error emulation
@@ -363,25 +1469,70 @@ class DummyRadio():
         self.link_errors    = {}
         self.commutator_errors = {}
         self.reply_errors   = {}
+        self.ack_payload_modes = {}
+        self.b_ack_payload = False
         
         # Communication buffers
+        self.rx_mode = False
         self.rx_buf = []
         self.tx_buf = []
+        # Frames following rx_buf in a burst
+        self.rx_frames = []
 
         # Current channel
         self.channel = -1
 
+        # Time taken by a write (s)
+        self.write_time = 0.010
+
+        # Reply returned in the ACK payload
+        self.ack_payload_available = False
+        self.ack_payload_length = 0
+
         # Machine access table
         self.access_table = [[], []]
         self.mem_size = 0
         self.mem_used = 0
 
+        # Log entries: code, card ID bytes and age (s), oldest first
+        self.log_code = []
+        self.log_user = []
+        self.log_age  = []
+        # Sequence number of the oldest log entry
+        self.log_seq = 0
+
+        # Entries managed per table update frame
+        self.frame_entries = 7
+
+        # Numbered table entries: session, next expected entry, entries
+        # received after it, cards added, authorisations modified, memory full
+        self.window_state = [None, 0, set(), 0, 0, False]
+
+        # Probability of losing each command, ACK and reply on the air
+        self.loss = 0.0
+        self.random = random.Random(1)
+
+        # Writes acknowledged before the link goes down, None for no limit
+        self.writes_left = None
+
+        # Results of the payloads queued by write_fast
+        self.tx_results = []
+
+    def state(self):
+        # Commutator state in the replies: 0xAF fine, 0xA0 problem
+        if self.b_commutator_err:
+            return 0xA0
+        return 0xAF
+
     def link_err(self, channel):    self.link_errors[hex(channel)] = True       
     def link_ok(self, channel):     self.link_errors[hex(channel)] = False       
     def commutator_err(self, channel): self.commutator_errors[hex(channel)] = True       
     def commutator_ok(self, channel):  self.commutator_errors[hex(channel)] = False       
     def reply_err(self, channel):   self.reply_errors[hex(channel)] = True       
     def reply_ok(self, channel):    self.reply_errors[hex(channel)] = False       
+    def ack_payload_on(self, channel):  self.ack_payload_modes[hex(channel)] = True
+    def ack_payload_off(self, channel): self.ack_payload_modes[hex(channel)] = False
+    def enableAckPayload(self): pass
     def powerUp(self): pass
     def powerDown(self): pass
 
@@ -402,20 +1553,75 @@ class DummyRadio():
             self.b_reply_err = self.reply_errors[hex(channel)]
         else:
             self.b_reply_err = False
+        # Set ack payload reply mode if specified for this channel
+        if hex(channel) in self.ack_payload_modes:
+            self.b_ack_payload = self.ack_payload_modes[hex(channel)]
+        else:
+            self.b_ack_payload = False
         
     def write(self, buf):
+        if self.writes_left is not None:
+            if self.writes_left == 0:
+                # Link went down
+                time.sleep(self.write_time)
+                return False
+            self.writes_left -= 1
+        if self.loss and self.random.random() < self.loss:
+            # Command lost on the air, it never reaches the commutator
+            time.sleep(self.write_time)
+            return False
+        acked = self.receive(buf)
+        if acked and self.loss:
+            if self.random.random() < self.loss:
+                # Reply lost on the air
+                self.rx_buf = []
+            if self.random.random() < self.loss:
+                # ACK lost on the air, the command went through all the same
+                return False
+        return acked
+
+    def write_fast(self, buf):
+        # Sent at once, the result kept for tx_standby. The TX FIFO holds 3
+        # payloads and the radio stops on the first one not acknowledged.
+        if len(self.tx_results) == 3:
+            return False
+        if self.tx_results and not self.tx_results[-1]:
+            self.tx_results.append(False)
+        else:
+            self.tx_results.append(DummyRadio.write(self, buf))
+        return True
+
+    def tx_standby(self, timeout = None):
+        results = self.tx_results
+        self.tx_results = []
+        return results
+
+    def receive(self, buf):
+        # Errors may have been changed since the channel was set
+        self.setChannel(self.channel)
         # Necessarily in TX mode
         self.rx_mode = False
         # Wait 10 ms
-        time.sleep(0.010)
+        time.sleep(self.write_time)
         if self.b_link_err:
             # No ack on write
             return False
 
+        # Any reply waiting in the commutator rides on this ACK
+        self.next_frame()
+        self.ack_payload_available = self.b_ack_payload and len(self.rx_buf) > 0
+        self.ack_payload_length = len(self.rx_buf)
+
         if self.b_reply_err:
             # Ack succeeded  but no reply was received
             return True
         
+        if buf[0] == 0xAA:
+            # Reply fetch, nothing to process
+            return True
+        # A new command ends any burst in progress
+        self.rx_frames = []
+
         # Return the expected reply from Arduino
         if (buf[0] == 0xA0 or
             buf[0] == 0xA1 or
@@ -425,7 +1631,7 @@ class DummyRadio():
             buf[0] == 0xA9 or
             buf[0] == 0xB0):
             # Register, enable or disable command, answer state
-            self.rx_buf = [0xAF - 0x0F * (self.b_commutator_err)]
+            self.rx_buf = [self.state()]
             print("Machine would receive %s command, sending back %d." % (hex(buf[0]), self.rx_buf[0]))
 
         elif buf[0] == 0xA3:
@@ -433,7 +1639,7 @@ class DummyRadio():
             num_entries = len(self.log_code)
             if num_entries == 0:
                 # Send empty log buffer
-                self.rx_buf.append(0xAF + 0x0F * (self.b_commutator_err)) 
+                self.rx_buf.append(self.state()) 
                 # Repeat the command itself
                 self.rx_buf.append(0xA3)
                 # Number of remaining entries, including this one
@@ -449,7 +1655,7 @@ class DummyRadio():
                 self.rx_buf.append(0)
             else:
                 # Dump 1 log entry
-                self.rx_buf.append(0xAF + 0x0F * (self.b_commutator_err)) 
+                self.rx_buf.append(self.state()) 
                 # Repeat the command itself
                 self.rx_buf.append(0xA3) 
                 # Number of remaining entries, including this one
@@ -469,72 +1675,199 @@ class DummyRadio():
                 del self.log_code[0]
                 del self.log_user[0]
                 del self.log_age[0]
-                print self.rx_buf
+                print(self.rx_buf)
 
         elif buf[0] == 0xA4:
             # Table update
             # Machine state
-            self.rx_buf.append(0xAF + 0x0F * (self.b_commutator_err)) 
+            self.rx_buf.append(self.state()) 
             # Repeat the command itself
             self.rx_buf.append(0xA4)
             # Do nothing if the number of remaining entries is 0
             if buf[1] == 0:
                 return True
-            # Check if the card ID is in memory
-            card_id = buf[3:7]
-            user_auth = buf[2]
-            if card_id in self.access_table[0]:
-                user_auth_prev = self.access_table[1] \
-                                [self.access_table[0].index(card_id)]
-                # Check if authorisation was updated
-                if user_auth_prev == user_auth:
-                    self.rx_buf.append(0xD1)
-                else:
-                    self.rx_buf.append(0xD2)
-            else:
-                # Check if another user can fit in memory
-                self.mem_used = len(self.access_table[0])
-                if self.mem_used < self.mem_size:
-                    self.rx_buf.append(0xD3)
-                    self.access_table[0].append(card_id)
-                    self.access_table[1].append(user_auth)
-                else:
-                    self.rx_buf.append(0xDF)
-            
+            self.rx_buf.append(self.table_entry(buf[3:7], buf[2]))
+
+        elif buf[0] == 0xB4:
+            # Table update frame, as many entries as the commutator takes
+            self.rx_buf.append(self.state())
+            self.rx_buf.append(0xB4)
+            num_entries = min((len(buf) - 4) // 4, self.frame_entries)
+            status_bits = 0
+            for k in range(num_entries):
+                code = self.table_entry(buf[4+4*k:8+4*k], (buf[3] >> k) & 1)
+                status_bits |= [0xD1, 0xD2, 0xD3, 0xDF].index(code) << 2*k
+                if code == 0xDF:
+                    # Memory full, the remaining entries are not managed
+                    num_entries = k + 1
+                    break
+            self.rx_buf.extend([num_entries, status_bits & 0xFF, status_bits >> 8])
+
         elif buf[0] == 0xA5:
             # Dump 1 log entry
-            self.rx_buf.append(0xAF + 0x0F * (self.b_commutator_err)) 
+            self.rx_buf.append(self.state()) 
             # Repeat the command itself
             self.rx_buf.append(0xA5) 
-            # Memory total size
-            self.rx_buf.append(self.mem_size % 0x100) 
-            self.rx_buf.append(int(self.mem_size / 0x100)) 
-            # Memory used
+            # Memory total size, MSB first
+            self.rx_buf.append(self.mem_size >> 8)
+            self.rx_buf.append(self.mem_size & 0xFF)
+            # Memory used, MSB first
             self.mem_used = len(self.access_table[0])
-            self.rx_buf.append(self.mem_used % 0x100) 
-            self.rx_buf.append(int(self.mem_used / 0x100))
+            self.rx_buf.append(self.mem_used >> 8)
+            self.rx_buf.append(self.mem_used & 0xFF)
             
+        elif buf[0] == 0xB1:
+            # Bulk log dump: burst of frames of up to 3 entries, oldest first
+            # or from the given sequence number if still held
+            num_entries = len(self.log_code)
+            start = 0
+            if len(buf) >= 4:
+                offset = (buf[2] + 0x100 * buf[3] - self.log_seq) & 0xFFFF
+                if offset <= num_entries:
+                    start = offset
+            frames = []
+            for first in range(start, max(num_entries, start + 1), 3)[:buf[1]]:
+                count = min(3, num_entries - first)
+                seq = (self.log_seq + first) & 0xFFFF
+                frame = [self.state(), 0xB1,
+                         seq & 0xFF, seq >> 8, count]
+                if first + count < num_entries:
+                    # More entries follow
+                    frame[4] |= 0x80
+                for n in range(first, first + count):
+                    frame.append(self.log_code[n])
+                    frame.extend(self.log_user[n])
+                    frame.extend(struct.unpack("4B", struct.pack("<I", self.log_age[n])))
+                frames.append(frame)
+            self.rx_buf = frames[0]
+            self.rx_frames = frames[1:]
+
+        elif buf[0] == 0xB2:
+            # Erase log entries up to the given sequence number
+            num_erased = (buf[1] + 0x100 * buf[2] - self.log_seq + 1) & 0xFFFF
+            if num_erased >= 0x8000:
+                # Older than the oldest entry, already erased
+                num_erased = 0
+            num_erased = min(num_erased, len(self.log_code))
+            del self.log_code[:num_erased]
+            del self.log_user[:num_erased]
+            del self.log_age[:num_erased]
+            self.log_seq = (self.log_seq + num_erased) & 0xFFFF
+            self.rx_buf = [self.state()]
+
+        elif buf[0] == 0xB5:
+            # Numbered table entry, no reply
+            self.rx_buf = []
+            state = self.window_state
+            if buf[1] != state[0]:
+                # New session
+                self.window_state = state = [buf[1], 0, set(), 0, 0, False]
+            seq = buf[2] + buf[3] * 0x100
+            if seq < state[1] or seq in state[2]:
+                # Duplicate, already managed
+                return True
+            code = self.table_entry(buf[5:9], buf[4])
+            if code == 0xD2:
+                state[4] += 1
+            elif code == 0xD3:
+                state[3] += 1
+            elif code == 0xDF:
+                state[5] = True
+            state[2].add(seq)
+            while state[1] in state[2]:
+                state[2].remove(state[1])
+                state[1] += 1
+
+        elif buf[0] == 0xB6:
+            # Window status
+            state = self.window_state
+            if buf[1] != state[0]:
+                state = [buf[1], 0, set(), 0, 0, False]
+            received_bits = 0
+            for seq in state[2]:
+                if state[1] < seq <= state[1] + 16:
+                    received_bits |= 1 << (seq - state[1] - 1)
+            self.rx_buf = [self.state(), 0xB6]
+            for value in [state[1], received_bits, state[3], state[4]]:
+                self.rx_buf.extend([value & 0xFF, value >> 8])
+            self.rx_buf.append(int(state[5]))
+
+        elif buf[0] == 0xB3:
+            # Table digest
+            self.rx_buf.append(self.state())
+            self.rx_buf.append(0xB3)
+            num_cards = len(self.access_table[0])
+            self.rx_buf.append(num_cards >> 8)
+            self.rx_buf.append(num_cards & 0xFF)
+            digest = 0
+            for card_id, user_auth in zip(self.access_table[0], self.access_table[1]):
+                digest += entry_hash(card_id, user_auth)
+            self.rx_buf.extend(struct.unpack("4B", struct.pack(">I", digest & 0xFFFFFFFF)))
+
         elif buf[0] == 0xA6:
             # Answer state
-            self.rx_buf = [0xAF + 0x0F * (self.b_commutator_err)]
+            self.rx_buf = [self.state()]
             # Remove all cards from memory
             self.access_table = [[],[]]
-            radio.mem_used = 0
+            self.mem_used = 0
             
         return True
     
+    def table_entry(self, card_id, user_auth):
+        """ Add or update a card of the access table, returns the reply
+            code (0xD1 to 0xDF).
+        """
+        card_id = list(card_id)
+        # Check if the card ID is in memory
+        if card_id in self.access_table[0]:
+            card_num = self.access_table[0].index(card_id)
+            # Check if authorisation was updated
+            if self.access_table[1][card_num] == user_auth:
+                return 0xD1
+            self.access_table[1][card_num] = user_auth
+            return 0xD2
+        # Check if another user can fit in memory
+        self.mem_used = len(self.access_table[0])
+        if self.mem_used < self.mem_size:
+            self.access_table[0].append(card_id)
+            self.access_table[1].append(user_auth)
+            return 0xD3
+        return 0xDF
+
     def read(self, buf, buf_len=-1):
         del buf[:]
         # Read and empty RX buffer entries
         buf.extend(self.rx_buf[0:buf_len])
         del self.rx_buf[0:buf_len]
         return len(buf)
+
+    def next_frame(self):
+        # The next frame of a burst comes once the previous one was read
+        if len(self.rx_buf) == 0 and len(self.rx_frames) > 0:
+            self.rx_buf = self.rx_frames.pop(0)
+
+    def read_into(self, buf, buf_len=-1):
+        self.next_frame()
+        if buf_len < 0:
+            buf_len = len(buf)
+        # Read and empty RX buffer entries
+        data = self.rx_buf[0:buf_len]
+        buf[:len(data)] = bytearray(data)
+        del self.rx_buf[0:buf_len]
+        return len(data)
     
     def getDynamicPayloadSize(self):
+        self.next_frame()
         return len(self.rx_buf)
 
     def available(self, pipe_num):        
-        return pipe_num == [0] and self.rx_mode
+        # In ack payload mode, the commutator never sends a reply packet
+        return pipe_num == [0] and self.rx_mode and not self.b_ack_payload
+
+    def isAckPayloadAvailable(self):
+        result = self.ack_payload_available
+        self.ack_payload_available = False
+        return result
     
     def startListening(self):
         self.rx_mode = True
@@ -554,7 +1887,8 @@ class DummyRadio():
     
 # UNIT TEST (if script is executed directly)
 if __name__ == '__main__':
-    import struct
+    import table_shadow
+
     logging.basicConfig(filename='test_link_command.log',
                         format='%(asctime)s:%(levelname)s:%(funcName)s:%(message)s',
                         level=logging.DEBUG)
@@ -686,6 +2020,289 @@ if __name__ == '__main__':
 
     # Check memory after clearing
     print("\nExpecting empty memory.")
-    print(links[2].check_memory())    
+    print(links[2].check_memory())
+
+    # Reply returned in the ACK payload instead of a reply packet
+    radio.ack_payload_on(channels[2])
+    ack_link = LinkCommand(radio, channels[2], commutator_ids[2],
+                           commutator_names[2], True)
+    print("\nChecking commutator replying in the ACK payload.")
+    print(ack_link.check())
+
+    print("\nExpecting empty memory (ACK payload reply).")
+    print(ack_link.check_memory())
+
+    print("\nUpdating access table (ACK payload reply).")
+    print(ack_link.update_table(new_table))
+
+    print("\nRadio retunes (most commands reuse the current channel).")
+    print(links[2].radio_state())
+
+    # Log entries retrieved by bursts of frames, 2 frames per burst
+    def fill_log():
+        radio.log_code = [0x30, 0x33, 0x30, 0x31, 0x33, 0x31, 0x32]
+        radio.log_age  = [600, 570, 300, 270, 180, 150, 60]
+        radio.log_user = [[0x70, 0x40, 0x84, 0x0B], [0x70, 0x40, 0x84, 0x0B],
+                          [0x70, 0x40, 0x84, 0x0B], [0x45, 0x55, 0x55, 0x55],
+                          [0x70, 0x40, 0x84, 0x0B], [0x45, 0x55, 0x55, 0x55],
+                          [0x45, 0x55, 0x55, 0x55]]
+    for bulk_link in [links[2], ack_link]:
+        bulk_link.bulk_log = True
+        bulk_link.log_burst_frames = 2
+    radio.ack_payload_off(channels[2])
+    fill_log()
+    print("\nExpecting 7 log entries by bursts of frames.")
+    status = links[2].dump_logging()
+    print((status["read_ok"], status["log_count"], status["log_codes"]))
+
+    print("\nExpecting no log entries left.")
+    status = links[2].dump_logging()
+    print((status["read_ok"], status["log_count"], radio.log_seq))
+
+    radio.ack_payload_on(channels[2])
+    fill_log()
+    print("\nExpecting 7 log entries by bursts of frames (ACK payload reply).")
+    status = ack_link.dump_logging()
+    print((status["read_ok"], status["log_count"], status["log_codes"]))
+
+    # Table updates sending only the entries changed since the last one
+    radio.ack_payload_off(channels[2])
+    links[2].clear_memory()
+    radio.mem_size = 10
+    sync_table = [['7040840B', '45555555', '67892311', 'A55F78BC'],
+                  [True, False, True, True]]
+    print("\nExpecting a full update without a table shadow.")
+    status = links[2].sync_table(sync_table, None)
+    print((status["update_ok"], status["delta"], status["num_entries"], status["shadow"]))
+
+    print("\nExpecting 2 entries sent: 1 authorisation change, 1 card removed.")
+    sync_table = [['7040840B', '45555555', '67892311'], [True, True, True]]
+    status = links[2].sync_table(sync_table, status["shadow"])
+    print((status["update_ok"], status["delta"], status["num_entries"], status["shadow"]))
+
+    print("\nExpecting no entries sent when nothing changed.")
+    status = links[2].sync_table(sync_table, status["shadow"])
+    print((status["update_ok"], status["delta"], status["num_entries"]))
+
+    print("\nExpecting the shadow kept while the commutator is out of reach, then no entries sent.")
+    shadow = status["shadow"]
+    radio.link_err(channels[2])
+    status = links[2].sync_table(sync_table, shadow)
+    radio.link_ok(channels[2])
+    links[2].circuit_breaker().record_success()
+    print((status["update_ok"], status["shadow"] == shadow))
+    status = links[2].sync_table(sync_table, status["shadow"])
+    print((status["update_ok"], status["delta"], status["num_entries"]))
+
+    print("\nExpecting a full update after the memory was cleared.")
+    links[2].clear_memory()
+    status = links[2].sync_table(sync_table, status["shadow"])
+    print((status["update_ok"], status["delta"], status["num_entries"]))
+
+    print("\nExpecting a full update after the commutator contradicted the shadow.")
+    status["shadow"]["cards"]['45555555'] = False
+    status = links[2].sync_table(sync_table, status["shadow"])
+    print((status["update_ok"], status["delta"], status["num_entries"]))
+
+    print("\nExpecting the update skipped when the table digest matches.")
+    links[2].table_digest = True
+    status = links[2].sync_table(sync_table, status["shadow"])
+    print((status["update_ok"], status["skipped"], status["num_entries"], status["num_saved"]))
+
+    print("\nExpecting 1 entry sent after a change, then the update skipped.")
+    sync_table[1][2] = False
+    status = links[2].sync_table(sync_table, status["shadow"])
+    print((status["update_ok"], status["skipped"], status["num_entries"]))
+    status = links[2].sync_table(sync_table, status["shadow"])
+    print((status["update_ok"], status["skipped"], status["num_entries"]))
+
+    print("\nExpecting the update skipped without a shadow when the digest matches.")
+    status = links[2].sync_table(sync_table, None)
+    print((status["update_ok"], status["skipped"], status["num_entries"]))
+
+    print("\nExpecting the update skipped with the shadow read back from its file, a card being held out of it.")
+    links[2].clear_memory()
+    links[2].update_table([sync_table[0] + ['B0B0B0B0'], sync_table[1] + [True]])
+    status = links[2].sync_table(sync_table, None)
+    table_shadow.write_table_shadow('test_table_shadow.json', status["shadow"])
+    shadow = table_shadow.read_table_shadow('test_table_shadow.json')
+    table_shadow.write_table_shadow('test_table_shadow.json', None)
+    status = links[2].sync_table(sync_table, shadow)
+    print((status["update_ok"], status["skipped"], status["num_entries"], "digest" in shadow))
+
+    # Table entries packed by frames, the commutator taking 4 per frame
+    links[2].table_digest = False
+    links[2].table_frame_entries = 7
+    radio.frame_entries = 4
+    radio.mem_size = 30
+    links[2].clear_memory()
+    frame_table = [['%08X' % (0x70408400 + n) for n in range(20)],
+                   [n % 3 != 0 for n in range(20)]]
+    print("\nExpecting 20 cards added by frames of 4 entries.")
+    status = links[2].update_table(frame_table)
+    print((status["update_ok"], status["num_newcard"], links[2].table_frame_entries))
+
+    print("\nExpecting 20 authorisations modified.")
+    frame_table[1] = [n % 3 == 0 for n in range(20)]
+    status = links[2].update_table(frame_table)
+    print((status["update_ok"], status["num_authmod"], status["num_newcard"]))
+
+    print("\nExpecting memory full after 10 more cards.")
+    frame_table = [['%08X' % (0x55558400 + n) for n in range(12)], [True] * 12]
+    status = links[2].update_table(frame_table)
+    print((status["update_ok"], status["num_newcard"], len(radio.access_table[0])))
+
+    print("\nExpecting a reply timeout adapted to the reply times observed.")
+    policy = links[2].retry_policy()
+    print((len(policy.reply_times) >= policy.min_samples,
+           policy.reply_timeout() < links[2].wait_rx_timeout,
+           policy.backoff(1) <= policy.backoff_base * (1 + 4 * policy.loss_rate())))
+
+    print("\nExpecting commands to the non-powered commutator to fail at once.")
+    print(links[0].circuit_breaker().state)
+    start = time.time()
+    status = links[0].check()
+    print((status["link_ok"], time.time() - start < 0.01))
+
+    print("\nExpecting a single try once the cool-down is over, then success.")
+    links[0].circuit_breaker().open_until = time.time()
+    print(links[0].check()["link_ok"])
+    radio.link_ok(channels[0])
+    links[0].circuit_breaker().open_until = time.time()
+    print((links[0].check()["link_ok"], links[0].circuit_breaker().state))
+
+    # Entries in flight, acknowledged by windows, on a radio losing packets
+    links[2].table_frame_entries = 0
+    radio.loss = 0.1
+    radio.write_time = 0.002
+    radio.mem_size = 100
+    window_table = [['%08X' % (0x45550000 + n) for n in range(60)],
+                    [n % 2 == 0 for n in range(60)]]
+    print("\nTable update throughput with 10% of the packets lost, by window size.")
+    for window in [0, 1, 4, 8, 16]:
+        links[2].table_window = window
+        links[2].clear_memory()
+        start = time.time()
+        status = links[2].update_table(window_table)
+        print("Window %2d: %s, %d cards added in %.2f s." %
+              (window, "done" if status["update_ok"] else "aborted",
+               len(radio.access_table[0]), time.time() - start))
+    radio.loss = 0.0
+
+    # Table update interrupted, then resumed by the next run
+    links[2].table_window = 0
+    radio.write_time = 0.001
+    links[2].clear_memory()
+    radio.writes_left = 25
+    print("\nExpecting an interrupted update and a checkpoint after 24 entries.")
+    status = links[2].sync_table(window_table, None)
+    print((status["update_ok"], status["resumed"], status["journal"]["num_acked"]))
+
+    print("\nExpecting the update resumed at entry 24 once the link is back.")
+    radio.writes_left = None
+    links[2].circuit_breaker().record_success()
+    status = links[2].sync_table(window_table, None, status["journal"])
+    print((status["update_ok"], status["resumed"], status["num_entries"],
+           status["num_newcard"], status["journal"], len(radio.access_table[0])))
+
+    print("\nExpecting the update started again after the table changed.")
+    links[2].clear_memory()
+    radio.writes_left = 25
+    status = links[2].sync_table(window_table, None)
+    radio.writes_left = None
+    links[2].circuit_breaker().record_success()
+    window_table[1][0] = not window_table[1][0]
+    status = links[2].sync_table(window_table, None, status["journal"])
+    print((status["update_ok"], status["resumed"], status["num_entries"]))
+
+    print("\nExpecting the update started again after the memory was cleared.")
+    links[2].clear_memory()
+    radio.writes_left = 25
+    status = links[2].sync_table(window_table, None)
+    radio.writes_left = None
+    links[2].circuit_breaker().record_success()
+    links[2].clear_memory()
+    status = links[2].sync_table(window_table, None, status["journal"])
+    print((status["update_ok"], status["resumed"], status["num_entries"]))
+
+    print("\nExpecting an interrupted delta update of 20 entries resumed at entry 9, the shadow kept.")
+    for n in range(10, 20):
+        window_table[1][n] = not window_table[1][n]
+    window_table[0].extend(['%08X' % (0x46660000 + n) for n in range(10)])
+    window_table[1].extend([True] * 10)
+    radio.writes_left = 10
+    status = links[2].sync_table(window_table, status["shadow"])
+    radio.writes_left = None
+    links[2].circuit_breaker().record_success()
+    print((status["update_ok"], status["delta"], status["shadow"] is not None,
+           status["journal"]["num_acked"]))
+    status = links[2].sync_table(window_table, status["shadow"], status["journal"])
+    print((status["update_ok"], status["delta"], status["resumed"], status["num_entries"],
+           status["num_newcard"], status["num_authmod"], status["journal"],
+           len(radio.access_table[0])))
+
+    print("\nExpecting the checkpoint kept while the memory cannot be read, then the update resumed.")
+    links[2].clear_memory()
+    radio.writes_left = 25
+    status = links[2].sync_table(window_table, None)
+    radio.writes_left = None
+    journal = status["journal"]
+    radio.link_err(channels[2])
+    links[2].circuit_breaker().record_success()
+    status = links[2].sync_table(window_table, None, journal)
+    radio.link_ok(channels[2])
+    links[2].circuit_breaker().record_success()
+    print((status["update_ok"], status["num_entries"], status["journal"] == journal))
+    status = links[2].sync_table(window_table, None, status["journal"])
+    print((status["update_ok"], status["resumed"], status["num_entries"], status["journal"]))
+
+    # Log entries retrieved by sequence number, erased once stored
+    fill_log()
+    print("\nExpecting 7 log entries retrieved, none erased before they are stored.")
+    status = links[2].retrieve_log(None)
+    print((status["read_ok"], status["log_count"], len(radio.log_code)))
+    stored_seq = status["last_seq"]
+
+    print("\nExpecting no entries twice when the erase command was lost, then none left.")
+    status = links[2].retrieve_log(stored_seq)
+    print((status["read_ok"], status["log_count"], status["last_seq"] == stored_seq))
+    links[2].erase_log_to(stored_seq)
+    print(len(radio.log_code))
+
+    print("\nExpecting a retrieval cut after 6 entries to go on with the 7th.")
+    fill_log()
+    radio.writes_left = 1
+    status = links[2].retrieve_log(stored_seq)
+    radio.writes_left = None
+    links[2].circuit_breaker().record_success()
+    print((status["read_ok"], status["log_count"]))
+    stored_seq = status["last_seq"]
+    status = links[2].retrieve_log(stored_seq)
+    print((status["read_ok"], status["log_count"], status["log_seqs"][0] == (stored_seq + 1) & 0xFFFF))
+    stored_seq = status["last_seq"]
+    links[2].erase_log_to(stored_seq)
+    print(len(radio.log_code))
+
+    print("\nExpecting all the entries of a restarted log.")
+    fill_log()
+    radio.log_seq = 0
+    status = links[2].retrieve_log(stored_seq)
+    print((status["read_ok"], status["log_count"], status["log_seqs"]))
 
+    # Log entries passed on one by one as they arrive
+    events = []
+    links[2].log_handler = lambda code, user, log_time, seq: events.append((code, seq))
+    radio.log_seq = 0
+    print("\nExpecting 7 log entries streamed to the handler, none kept in the outputs.")
+    status = links[2].retrieve_log(None)
+    print((status["read_ok"], status["log_count"], len(status["log_codes"]), events))
+    links[2].erase_log_to(status["last_seq"])
 
+    print("\nExpecting 7 log entries streamed one per command.")
+    fill_log()
+    del events[:]
+    links[2].bulk_log = False
+    status = links[2].dump_logging()
+    print((status["read_ok"], len(status["log_codes"]), events))
+    links[2].bulk_log = True
+    links[2].log_handler = None
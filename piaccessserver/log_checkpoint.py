@@ -0,0 +1,34 @@
+# coding: utf-8
+import json
+import os
+import logging
+
+# The log checkpoint of a commutator is the sequence number of the last log
+# entry written to its event log file:
+#   {"last_seq": 1234}
+# The commutator only erases its entries up to that one, and the next
+# retrieval starts right after it.
+
+def log_checkpoint_filename(commutator_name):
+    return 'log_checkpoint_' + commutator_name + '.json'
+
+def read_log_checkpoint(filename):
+    # Returns None if no entry was stored yet
+    if not os.path.exists(filename):
+        return None
+    try:
+        with open(filename, 'r') as checkpoint_file:
+            checkpoint = json.load(checkpoint_file)
+        return int(checkpoint["last_seq"]) & 0xFFFF
+    except (ValueError, KeyError, TypeError, AttributeError, IOError):
+        logging.warning("Log checkpoint %s is unreadable, ignoring it.", filename)
+        return None
+
+def write_log_checkpoint(filename, last_seq):
+    # Replace the file at once
+    temp_filename = filename + '.tmp'
+    with open(temp_filename, 'w') as checkpoint_file:
+        json.dump({"last_seq": last_seq}, checkpoint_file, sort_keys=True)
+        checkpoint_file.flush()
+        os.fsync(checkpoint_file.fileno())
+    os.rename(temp_filename, filename)
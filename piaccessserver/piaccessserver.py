@@ -7,7 +7,7 @@
 # Import Python modules
 import sys
 import ConfigParser
-from time import strftime, sleep
+from time import strftime, sleep, localtime
 import logging
 import argparse
 from glob import glob
@@ -19,7 +19,13 @@ import csv
 # Import project modules
 import db_connect
 from link_command import LinkCommand
+from radio_pool import RadioPool, failed_operations
 import csv_rw
+import table_shadow
+import table_journal
+import log_checkpoint
+import retry_policy
+import circuit_breaker
 
 # Configure GPIO and SPI
 import RPi.GPIO as GPIO
@@ -37,23 +43,77 @@ from lib_nrf24 import NRF24
 w_pipe = [0xF0, 0xF0, 0xF0, 0xF0, 0xE1]
 r_pipe = [0xF0, 0xF0, 0xF0, 0xF0, 0xD2]
 
-radio = NRF24(GPIO, spidev.SpiDev())
+def setup_radio(section):
+    radio = NRF24(GPIO, spidev.SpiDev())
 
-# Use configuration file parameter values to setup radio
-radio.begin(0, 25)
-#sleep(1)
-# setRetries(delay, count) -> both between 0 and 15
-radio.setRetries(15,15)
-radio.setPayloadSize(12)
-radio.setDataRate(NRF24.BR_1MBPS)
-radio.setPALevel(NRF24.PA_MAX)
-radio.setAutoAck(True)
-radio.enableDynamicPayloads()
+    # Use configuration file parameter values to setup radio
+    csn_pin = 0
+    if config.has_option(section, 'csn_pin'):
+        csn_pin = config.getint(section, 'csn_pin')
+    ce_pin = 25
+    if config.has_option(section, 'ce_pin'):
+        ce_pin = config.getint(section, 'ce_pin')
+    irq_pin = 0
+    if config.has_option(section, 'irq_pin'):
+        irq_pin = config.getint(section, 'irq_pin')
+    if config.has_option(section, 'spi_profile'):
+        radio.spi_profile = config.get(section, 'spi_profile')
+    radio.begin(csn_pin, ce_pin, irq_pin)
+    #sleep(1)
+    # setRetries(delay, count) -> both between 0 and 15
+    radio.setRetries(15,15)
+    radio.setPayloadSize(12)
+    radio.setDataRate(NRF24.BR_1MBPS)
+    radio.setPALevel(NRF24.PA_MAX)
+    radio.setAutoAck(True)
+    radio.enableDynamicPayloads()
+    # Only used by the commutators set to reply_mode = ack_payload
+    radio.enableAckPayload()
 
-radio.openWritingPipe(w_pipe)
-radio.openReadingPipe(1, r_pipe)
+    radio.openWritingPipe(w_pipe)
+    radio.openReadingPipe(1, r_pipe)
 
-#radio.printDetails()
+    #radio.printDetails()
+    return radio
+
+# First radio in the RADIO section, others in RADIO1, RADIO2...
+radios = [setup_radio('RADIO')]
+while config.has_section('RADIO%d' % len(radios)):
+    radios.append(setup_radio('RADIO%d' % len(radios)))
+
+# Commutators are spread over the radios in configuration file order,
+# unless they are assigned one
+radio_pool = RadioPool(radios)
+for section in config.sections():
+    if config.has_option(section, 'channel'):
+        radio_num = None
+        if config.has_option(section, 'radio'):
+            radio_num = config.getint(section, 'radio')
+        radio_pool.assign(section, radio_num)
+
+# Reply times and losses of each commutator, from the previous runs
+link_history_filename = 'link_history.json'
+if config.has_option('COMMUTATORS', 'link_history'):
+    link_history_filename = config.get('COMMUTATORS', 'link_history')
+LinkCommand.retry_policies = retry_policy.read_link_history(link_history_filename)
+
+# Commutators that stopped answering during the previous runs
+breakers_filename = 'circuit_breakers.json'
+if config.has_option('COMMUTATORS', 'circuit_breakers'):
+    breakers_filename = config.get('COMMUTATORS', 'circuit_breakers')
+LinkCommand.circuit_breakers = circuit_breaker.read_circuit_breakers(breakers_filename)
+
+def report_failures(results):
+    """ Print and count the commutators whose operation failed in a
+        radio_pool.run.
+    """
+    failures = failed_operations(results)
+    for commutator_name in sorted(failures):
+        print('Operation on commutator %s failed: %s' % (commutator_name, failures[commutator_name]))
+    if len(failures) > 0:
+        print('%d of %d commutators failed, see the software events log.' %
+              (len(failures), len(results)))
+    return failures
 
 # Main commands
 def server_db_retrieve(args = []):
@@ -146,19 +206,59 @@ def commutator_update(args):
         authorisations = [authorisations[comm_num]]
       
     # Update commutators
-    num_commutators = 0
+    tables = {}
     for index, commutator in enumerate(commutators):
         if config.has_section(commutator):
-            # Load radio parameters from config file
-            channel = config.getint(commutator, 'channel')
-            commutator_id = config.getint(commutator, 'id')
-            # Create a link for this commutator
-            #print('Creating a link to %s (id = %d) on channel %d.' % (commutator, commutator_id, channel))
-            link = LinkCommand(radio, channel,
-                               commutator_id, commutator)
-            #print [cards, authorisations[index]]
-            status = link.update_table([cards, authorisations[index]])
-            num_commutators = num_commutators + 1
+            tables[commutator] = [cards, authorisations[index]]
+
+    # Send only what changed since the last update, unless told otherwise
+    table_sync = 'delta'
+    if config.has_option('COMMUTATORS', 'table_sync'):
+        table_sync = config.get('COMMUTATORS', 'table_sync')
+    if args.full:
+        table_sync = 'full'
+
+    def update_commutator(commutator):
+        # Create a link for this commutator
+        link = get_link(commutator)
+        #print tables[commutator]
+        shadow_filename = table_shadow.table_shadow_filename(commutator)
+        shadow = None
+        if table_sync == 'delta':
+            shadow = table_shadow.read_table_shadow(shadow_filename)
+        # Resume the update interrupted during a previous run, if any
+        journal_filename = table_journal.table_journal_filename(commutator)
+        journal = table_journal.read_table_journal(journal_filename)
+        status = link.sync_table(tables[commutator], shadow, journal)
+        table_shadow.write_table_shadow(shadow_filename, status['shadow'])
+        table_journal.write_table_journal(journal_filename, status['journal'])
+        return status
+
+    statuses = radio_pool.run([commutator for commutator in commutators if commutator in tables],
+                              update_commutator)
+    failures = report_failures(statuses)
+    statuses = dict((commutator, status) for commutator, status in statuses.items()
+                    if commutator not in failures)
+    num_commutators = len(statuses)
+    num_sent = sum(status['num_entries'] for status in statuses.values())
+    num_entries = sum(status['table_size'] for status in statuses.values())
+    num_delta = len([status for status in statuses.values() if status['delta']])
+    logging.info('%d of %d table entries sent, %d commutators updated with changes only.' %
+                 (num_sent, num_entries, num_delta))
+    # Commands saved by the commutators found up to date, timed as long as
+    # the digest command of each of them
+    skipped = [status for status in statuses.values() if status['skipped']]
+    time_saved = sum(status['num_saved'] * status['command_time'] for status in skipped)
+    logging.info('%d commutators were up to date and skipped, saving %d commands (about %.1f s of radio time).' %
+                 (len(skipped), sum(status['num_saved'] for status in skipped), time_saved))
+    # Transfers resumed from where a previous run was interrupted
+    transfers = [status for status in statuses.values() if not status['skipped']]
+    resumed = [status for status in transfers if status['resumed']]
+    interrupted = [status for status in transfers if status['journal'] is not None]
+    logging.info('%d table transfers resumed, %d started afresh, %d interrupted and checkpointed for the next run.' %
+                 (len(resumed), len(transfers) - len(resumed), len(interrupted)))
+    print('%d table transfers resumed, %d started afresh, %d interrupted.' %
+          (len(resumed), len(transfers) - len(resumed), len(interrupted)))
             
     # Display result
     if(args.commutator_name == 'all'):      
@@ -218,45 +318,70 @@ def commutator_get_log(args):
     csv_rw.member_access_read('access_tables.csv', commutators_csv,
                               members_csv, memberships_csv, cards_csv, authorisations_csv)
                               
-    # Update commutators
-    for index, commutator in enumerate(commutators):
-        if config.has_section(commutator):
-            # Load radio parameters from config file
-            channel = config.getint(commutator, 'channel')
-            commutator_id = config.getint(commutator, 'id')
-            # Create a link for this commutator
-            #print('Creating a link to %s (id = %d) on channel %d.' % (commutator, commutator_id, channel))
-            link = LinkCommand(radio, channel,
-                               commutator_id, commutator)            
-            status = link.dump_logging()
-            
-            # Write events to log file
-            filename = get_commutator_log_filename(commutator)
-            with open(filename, 'ab') as csvfile:
-                log_file = csv.writer(csvfile, delimiter=';',
-                                        quotechar='"', quoting=csv.QUOTE_MINIMAL)
-                for event_num in range(status['log_count']):
-                    # Compute card code from individual bytes
-                    card_hex_code = hex(0x01000000 * status["log_users"][event_num][0] + 
-                                        0x00010000 * status["log_users"][event_num][1] + 
-                                        0x00000100 * status["log_users"][event_num][2] + 
-                                        status["log_users"][event_num][3])
-                    card_hex_code = card_hex_code[2:10].upper()
-                    # Find card code in database card list
-                    member_name = 'Unknown'
-                    membership_type = 0
-                    for member_num in range(len(members_csv)):
-                        if cards_csv[member_num] == card_hex_code:
-                            member_name = members_csv[member_num]
-                            membership_type = memberships_csv[member_num]
-                                                     
-                    print(hex(status["log_codes"][event_num]))
-                    print(event_strings[hex(status["log_codes"][event_num])])
-                    log_file.writerow((status['log_times'][event_num].strftime("%Y-%m-%d %H:%M:%S"),
-                                      hex(status["log_codes"][event_num]),
-                                      card_hex_code, member_name, membership_type, 
-                                      event_strings[hex(status["log_codes"][event_num])]))            
-            os.chmod(filename, 0o777)
+    # Member name and membership type of each card, the last listed one
+    # if a card appears twice
+    card_members = {}
+    for member_num in range(len(members_csv)):
+        card_members[cards_csv[member_num]] = (members_csv[member_num],
+                                               memberships_csv[member_num])
+
+    # Events written to the log files between two syncs to disk
+    fsync_events = 16
+    if config.has_option('COMMUTATORS', 'log_fsync_events'):
+        fsync_events = config.getint('COMMUTATORS', 'log_fsync_events')
+
+    # Retrieve events and write them to each commutator log file as they arrive
+    def get_log(commutator):
+        # Create a link for this commutator
+        link = get_link(commutator)
+        filename = get_commutator_log_filename(commutator)
+        with open(filename, 'ab') as csvfile:
+            log_file = csv.writer(csvfile, delimiter=';',
+                                    quotechar='"', quoting=csv.QUOTE_MINIMAL)
+            num_unsynced = [0]
+
+            def write_event(code, user, log_time, seq):
+                # Compute card code from individual bytes
+                card_hex_code = hex(0x01000000 * user[0] + 
+                                    0x00010000 * user[1] + 
+                                    0x00000100 * user[2] + 
+                                    user[3])
+                card_hex_code = card_hex_code[2:10].upper()
+                # Find card code in database card list
+                member_name, membership_type = card_members.get(card_hex_code,
+                                                                ('Unknown', 0))
+                log_file.writerow((log_time.strftime("%Y-%m-%d %H:%M:%S"),
+                                  hex(code),
+                                  card_hex_code, member_name, membership_type, 
+                                  event_strings[hex(code)]))
+                num_unsynced[0] += 1
+                if num_unsynced[0] == fsync_events:
+                    csvfile.flush()
+                    os.fsync(csvfile.fileno())
+                    num_unsynced[0] = 0
+
+            link.log_handler = write_event
+            if link.bulk_log:
+                # Entries after the last one stored, erased once on disk
+                checkpoint_filename = log_checkpoint.log_checkpoint_filename(commutator)
+                stored_seq = log_checkpoint.read_log_checkpoint(checkpoint_filename)
+                status = link.retrieve_log(stored_seq)
+            else:
+                status = link.dump_logging()
+            csvfile.flush()
+            os.fsync(csvfile.fileno())
+        os.chmod(filename, 0o777)
+        if link.bulk_log and status['last_seq'] is not None:
+            # The entries are on disk, the commutator can erase them
+            if status['last_seq'] != stored_seq:
+                log_checkpoint.write_log_checkpoint(checkpoint_filename, status['last_seq'])
+            link.erase_log_to(status['last_seq'])
+        return status
+
+    report_failures(radio_pool.run([commutator for commutator in commutators
+                                    if config.has_section(commutator)],
+                                   get_log))
+
     # Display result
     if(args.commutator_name == 'all'):      
       logging.info('The logged events of all %0.0f commutators were retrieved.' % len(commutators))
@@ -308,6 +433,31 @@ def get_commutator_log_filename(commutator_name):
         os.chmod(log_file[0], 0o777)
     return log_file[0]
 
+def get_link(commutator_name):
+    # Load radio parameters from config file
+    channel = config.getint(commutator_name, 'channel')
+    commutator_id = config.getint(commutator_name, 'id')
+    # Commutator firmware may return its replies in the auto-ACK payload
+    ack_payload = False
+    if config.has_option(commutator_name, 'reply_mode'):
+        ack_payload = config.get(commutator_name, 'reply_mode') == 'ack_payload'
+    link = LinkCommand(radio_pool.radio_for(commutator_name), channel,
+                       commutator_id, commutator_name, ack_payload)
+    # Commutator firmware may send its log entries by bursts of frames
+    if config.has_option(commutator_name, 'log_mode'):
+        link.bulk_log = config.get(commutator_name, 'log_mode') == 'bulk'
+    # Commutator firmware may give the digest of its table
+    if config.has_option(commutator_name, 'table_digest'):
+        link.table_digest = config.getboolean(commutator_name, 'table_digest')
+    # Commutator firmware may take several table entries per frame
+    if config.has_option(commutator_name, 'table_mode'):
+        if config.get(commutator_name, 'table_mode') == 'frames':
+            link.table_frame_entries = 7
+    # Commutator firmware may take numbered table entries acknowledged by windows
+    if config.has_option(commutator_name, 'table_window'):
+        link.table_window = config.getint(commutator_name, 'table_window')
+    return link
+
 def get_commutators():
     # Check if a table is available
     csv_filename = glob('access_tables.csv')
@@ -335,76 +485,77 @@ def send_commutator_command(commutator_name, command_name):
     else:
       commutators = [commutator_name]
       
-    # Update commutators
-    for index, commutator in enumerate(commutators):
-        if config.has_section(commutator):
-            # Load radio parameters from config file
-            channel = config.getint(commutator, 'channel')
-            commutator_id = config.getint(commutator, 'id')
-            # Create a link for this commutator
-            #print('Creating a link to %s (id = %d) on channel %d.' % (commutator, commutator_id, channel))
-            link = LinkCommand(radio, channel,
-                               commutator_id, commutator)
-            status = {"commutator_ok": True}
-            if command_name == 'check':
-                status = link.check()
-                if status["commutator_ok"]:
-                    print('Commutator %s is functional.' % commutator)
-                    logging.info('Commutator %s is functional.' % commutator)
-                else:
-                    print('Commutator %s did not answer as expected (%s)' % (commutator, status))
-            elif command_name == 'auto':
-                status = link.auto()
-                if status["commutator_ok"]:
-                    print('Commutator %s set to automatic mode.' % commutator)
-                    logging.info('Commutator %s set to automatic mode.' % commutator)
-                else:
-                    print('Commutator %s did not answer as expected (%s)' % (commutator, status))
-            elif command_name == 'on':
-                status = link.enable_commutator()
-                if status["commutator_ok"]:
-                    print('Commutator %s set to always on mode.' % commutator)
-                    logging.info('Commutator %s set to always on mode.' % commutator)
-                else:
-                    print('Commutator %s did not answer as expected (%s)' % (commutator, status))
-            elif command_name == 'off':
-                status = link.disable_commutator()
-                if status["commutator_ok"]:
-                    print('Commutator %s set to always off mode.' % commutator)
-                    logging.info('Commutator %s set to always off mode.' % commutator)
-                else:
-                    print('Commutator %s did not answer as expected (%s)' % (commutator, status))
-            elif command_name == 'clear_memory':
-                status = link.clear_memory()
-                if status["commutator_ok"]:
-                    print('Commutator %s memory was cleared.' % commutator)
-                    logging.info('Commutator %s memory was cleared.' % commutator)
-                else:
-                    print('Commutator %s did not answer as expected (%s)' % (commutator, status))
-            elif command_name == 'single_activation':
-                status = link.single_activation()
-                if status["commutator_ok"]:
-                    print('Commutator %s set to single activation mode.' % commutator)
-                    logging.info('Commutator %s set to single activation mode.' % commutator)
-                else:
-                    print('Commutator %s did not answer as expected (%s)' % (commutator, status))
-            elif command_name == 'double_activation':
-                status = link.double_activation()
-                if status["commutator_ok"]:
-                    print('Commutator %s set to double activation mode.' % commutator)
-                    logging.info('Commutator %s set to double activation mode.' % commutator)
-                else:
-                    print('Commutator %s did not answer as expected (%s)' % (commutator, status))
-            elif command_name == 'check_memory':
-                status = link.check_memory()
-                if status["commutator_ok"]:
-                    print("Memory state on %s: %d/%d used." % (commutator, status["mem_used"], status["mem_size"]))
-                    # -> Logging entry set by function call
-                else:
-                    print('Commutator %s did not answer as expected (%s)' % (commutator, status))
-            #obs = radio.read_register(NRF24.OBSERVE_TX)
-            #radio.print_observe_tx(obs)
+    # Send the command to each commutator
+    def send(commutator):
+        # Create a link for this commutator
+        link = get_link(commutator)
+        status = {"commutator_ok": True}
+        if command_name == 'check':
+            status = link.check()
+            if status["commutator_ok"]:
+                print('Commutator %s is functional.' % commutator)
+                logging.info('Commutator %s is functional.' % commutator)
+            else:
+                print('Commutator %s did not answer as expected (%s)' % (commutator, status))
+        elif command_name == 'auto':
+            status = link.auto()
+            if status["commutator_ok"]:
+                print('Commutator %s set to automatic mode.' % commutator)
+                logging.info('Commutator %s set to automatic mode.' % commutator)
+            else:
+                print('Commutator %s did not answer as expected (%s)' % (commutator, status))
+        elif command_name == 'on':
+            status = link.enable_commutator()
+            if status["commutator_ok"]:
+                print('Commutator %s set to always on mode.' % commutator)
+                logging.info('Commutator %s set to always on mode.' % commutator)
+            else:
+                print('Commutator %s did not answer as expected (%s)' % (commutator, status))
+        elif command_name == 'off':
+            status = link.disable_commutator()
+            if status["commutator_ok"]:
+                print('Commutator %s set to always off mode.' % commutator)
+                logging.info('Commutator %s set to always off mode.' % commutator)
+            else:
+                print('Commutator %s did not answer as expected (%s)' % (commutator, status))
+        elif command_name == 'clear_memory':
+            status = link.clear_memory()
+            if status["commutator_ok"]:
+                print('Commutator %s memory was cleared.' % commutator)
+                logging.info('Commutator %s memory was cleared.' % commutator)
+                # Next update sends the whole table
+                table_shadow.write_table_shadow(table_shadow.table_shadow_filename(commutator), None)
+                table_journal.write_table_journal(table_journal.table_journal_filename(commutator), None)
+            else:
+                print('Commutator %s did not answer as expected (%s)' % (commutator, status))
+        elif command_name == 'single_activation':
+            status = link.single_activation()
+            if status["commutator_ok"]:
+                print('Commutator %s set to single activation mode.' % commutator)
+                logging.info('Commutator %s set to single activation mode.' % commutator)
+            else:
+                print('Commutator %s did not answer as expected (%s)' % (commutator, status))
+        elif command_name == 'double_activation':
+            status = link.double_activation()
+            if status["commutator_ok"]:
+                print('Commutator %s set to double activation mode.' % commutator)
+                logging.info('Commutator %s set to double activation mode.' % commutator)
+            else:
+                print('Commutator %s did not answer as expected (%s)' % (commutator, status))
+        elif command_name == 'check_memory':
+            status = link.check_memory()
+            if status["commutator_ok"]:
+                print("Memory state on %s: %d/%d used." % (commutator, status["mem_used"], status["mem_size"]))
+                # -> Logging entry set by function call
+            else:
+                print('Commutator %s did not answer as expected (%s)' % (commutator, status))
+        #obs = radio.read_register(NRF24.OBSERVE_TX)
+        #radio.print_observe_tx(obs)
+        return status
 
+    report_failures(radio_pool.run([commutator for commutator in commutators
+                                    if config.has_section(commutator)],
+                                   send))
 
     
 if __name__ == '__main__':
@@ -426,6 +577,7 @@ if __name__ == '__main__':
         
     parser_sdr = subparsers.add_parser('commutator_update', description='Updates the access tables of a commutator.')
     parser_sdr.add_argument('-n', '--commutator_name', default='all', help=commutator_name_help)
+    parser_sdr.add_argument('-f', '--full', action='store_true', help='Send the whole table, not only the entries changed since the last update.')
     parser_sdr.set_defaults(func=commutator_update)
         
     parser_sdr = subparsers.add_parser('commutator_on', description='Sets commutator as always on.')
@@ -477,5 +629,35 @@ if __name__ == '__main__':
     # Execute required function 
     args.func(args)
 
+    # Report the commutators that are not answering
+    if len(LinkCommand.circuit_breakers) > 0:
+        circuit_breaker.write_circuit_breakers(breakers_filename, LinkCommand.circuit_breakers)
+    for commutator_name, breaker in sorted(LinkCommand.circuit_breakers.items()):
+        if breaker.state != 'closed':
+            message = 'Commutator %s is not answering: %d commands skipped, next try after %s.' % \
+                      (commutator_name, breaker.num_skipped,
+                       strftime("%Y-%m-%d %H:%M:%S", localtime(breaker.open_until)))
+            print(message)
+            logging.warning(message)
+
+    # Keep the link history for the next runs
+    if len(LinkCommand.retry_policies) > 0:
+        retry_policy.write_link_history(link_history_filename, LinkCommand.retry_policies)
+    for commutator_name, policy in sorted(LinkCommand.retry_policies.items()):
+        stats = policy.stats()
+        logging.debug('Link to %s: %d exchanges, %.0f%% lost, reply timeout %.1f ms.' %
+                      (commutator_name, stats['count'], stats['loss_rate'] * 100, stats['timeout_ms']))
+
+    # Report how often switching between commutators required retuning
+    for link_radio, state in LinkCommand.radio_states.items():
+        logging.debug('Radio on channel %s: %d retunes, %d avoided.' %
+                      (state['channel'], state['retunes'], state['retunes_avoided']))
+
+    # Report how far radio delays overshot the datasheet timings
+    for radio_num, radio in enumerate(radios):
+        for name, stats in sorted(radio.timing.overshoot_stats().items()):
+            logging.debug('Radio %d %s delays: %d, overshoot mean %.1f us, max %.1f us.' %
+                          (radio_num, name, stats['count'], stats['mean_us'], stats['max_us']))
+
         
         
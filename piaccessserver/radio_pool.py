@@ -0,0 +1,79 @@
+import threading
+import logging
+
+class RadioPool():
+    """ Several radios (ex: one on each SPI chip select of the Pi) serving the
+    commutators. Each commutator is assigned to one radio. Operations on
+    commutators assigned to different radios run at the same time, while the
+    commutators sharing a radio are served one after the other.
+    """
+    def __init__(self, radios):
+        self.radios      = radios
+        self.assignments = {}
+
+    def assign(self, commutator_name, radio_num = None):
+        """ Assign a commutator to a radio, the next one in turn if radio_num
+            is not given.
+        """
+        if radio_num is None:
+            radio_num = len(self.assignments) % len(self.radios)
+        if radio_num < 0 or radio_num >= len(self.radios):
+            logging.error("Radio %d assigned to %s does not exist, using radio 0.",
+                          radio_num, commutator_name)
+            radio_num = 0
+        self.assignments[commutator_name] = radio_num
+        return self.radios[radio_num]
+
+    def radio_for(self, commutator_name):
+        """ Radio serving a commutator, assigning one if needed."""
+        if commutator_name not in self.assignments:
+            return self.assign(commutator_name)
+        return self.radios[self.assignments[commutator_name]]
+
+    def run(self, commutator_names, operation):
+        """ Call operation(commutator_name) for each commutator, with one
+            thread per radio. Returns the results in a dictionary indexed by
+            commutator name; the result of an operation that raised is its
+            exception, the other commutators being served all the same.
+        """
+        # Group commutators by radio, keeping the requested order
+        groups = [[] for radio in self.radios]
+        for commutator_name in commutator_names:
+            self.radio_for(commutator_name)
+            groups[self.assignments[commutator_name]].append(commutator_name)
+        groups = [group for group in groups if len(group) > 0]
+
+        results = {}
+        def serve(group):
+            for commutator_name in group:
+                try:
+                    results[commutator_name] = operation(commutator_name)
+                except Exception as e:
+                    logging.exception("Operation on %s failed.", commutator_name)
+                    results[commutator_name] = e
+
+        if len(groups) == 1:
+            # Nothing to overlap
+            serve(groups[0])
+        else:
+            threads = [threading.Thread(target=serve, args=(group,))
+                       for group in groups]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        failures = failed_operations(results)
+        if len(failures) > 0:
+            logging.error("Operation failed on %d of %d commutators: %s.",
+                          len(failures), len(results),
+                          ', '.join('%s (%s)' % (commutator_name, failures[commutator_name])
+                                    for commutator_name in sorted(failures)))
+        return results
+
+def failed_operations(results):
+    """ Exceptions of the operations that failed in results of
+        RadioPool.run, indexed by commutator name.
+    """
+    return dict((commutator_name, result) for commutator_name, result in results.items()
+                if isinstance(result, Exception))
@@ -0,0 +1,108 @@
+import json
+import os
+import random
+import logging
+
+class RetryPolicy():
+    """ Reply timeout and retry delays of a commutator link, derived from
+    the history of its recent exchanges. The reply timeout follows the
+    reply times observed, and the delays only come after a failure, longer
+    after each one and with jitter so that retries do not keep colliding.
+        timeout = policy.reply_timeout(attempt)
+        policy.record_reply(reply_time) or policy.record_loss()
+        time.sleep(policy.backoff(num_failures))
+    """
+    def __init__(self, max_timeout = 0.5):
+        self.max_timeout    = max_timeout # Also used until the history is long enough (s)
+        self.min_timeout    = 0.010
+        self.timeout_factor = 3           # Timeout is this times the reply time percentile
+        self.percentile     = 0.95
+        self.min_samples    = 10
+        self.history_len    = 100
+        self.backoff_base   = 0.010       # Delay after a first failure (s)
+        self.backoff_max    = 0.4
+        self.reply_times    = []          # Last reply times (s)
+        self.outcomes       = []          # Last exchanges: True if replied, False if lost
+        self.random         = random.Random()
+
+    def record_reply(self, reply_time):
+        self.reply_times.append(reply_time)
+        del self.reply_times[:-self.history_len]
+        self.record_outcome(True)
+
+    def record_loss(self):
+        self.record_outcome(False)
+
+    def record_outcome(self, replied):
+        self.outcomes.append(replied)
+        del self.outcomes[:-self.history_len]
+
+    def loss_rate(self):
+        if len(self.outcomes) == 0:
+            return 0.0
+        return self.outcomes.count(False) / float(len(self.outcomes))
+
+    def reply_time(self, fraction):
+        """ Reply time percentile, None without history."""
+        if len(self.reply_times) == 0:
+            return None
+        reply_times = sorted(self.reply_times)
+        return reply_times[min(len(reply_times) - 1, int(len(reply_times) * fraction))]
+
+    def reply_timeout(self, attempt = 0):
+        """ Time to wait for a reply to the attempt-th try of a command."""
+        if len(self.reply_times) < self.min_samples:
+            return self.max_timeout
+        timeout = max(self.min_timeout,
+                      self.timeout_factor * self.reply_time(self.percentile))
+        # Wait longer at each retry, in case the replies became slower
+        return min(self.max_timeout, timeout * 2 ** attempt)
+
+    def backoff(self, num_failures):
+        """ Delay before retrying after num_failures failures in a row."""
+        if num_failures <= 0:
+            return 0.0
+        # Links losing many packets start from longer delays
+        delay = self.backoff_base * (1 + 4 * self.loss_rate()) * 2 ** (num_failures - 1)
+        delay = min(self.backoff_max, delay)
+        return self.random.uniform(delay / 2, delay)
+
+    def stats(self):
+        """ History summary, reply times in ms."""
+        stats = {"count": len(self.outcomes),
+                 "loss_rate": self.loss_rate(),
+                 "timeout_ms": self.reply_timeout() * 1000}
+        if len(self.reply_times) > 0:
+            stats["median_ms"] = self.reply_time(0.5) * 1000
+            stats["p95_ms"] = self.reply_time(self.percentile) * 1000
+        return stats
+
+def read_link_history(filename, max_timeout = 0.5):
+    """ Retry policies saved by write_link_history, in a dictionary indexed
+        by commutator name.
+    """
+    policies = {}
+    if not os.path.exists(filename):
+        return policies
+    try:
+        with open(filename, 'r') as history_file:
+            history = json.load(history_file)
+        for commutator_name, state in history.items():
+            policy = RetryPolicy(max_timeout)
+            policy.reply_times = [float(reply_time) for reply_time in state["reply_times"]]
+            policy.outcomes = [bool(replied) for replied in state["outcomes"]]
+            policies[str(commutator_name)] = policy
+    except (ValueError, KeyError, TypeError, AttributeError, IOError):
+        logging.warning("Link history %s is unreadable, ignoring it.", filename)
+        return {}
+    return policies
+
+def write_link_history(filename, policies):
+    history = {}
+    for commutator_name, policy in policies.items():
+        history[commutator_name] = {"reply_times": policy.reply_times,
+                                    "outcomes": policy.outcomes}
+    temp_filename = filename + '.tmp'
+    with open(temp_filename, 'w') as history_file:
+        json.dump(history, history_file, sort_keys=True)
+    os.rename(temp_filename, filename)
@@ -0,0 +1,46 @@
+# coding: utf-8
+import json
+import os
+import logging
+
+# The journal of a commutator table update is kept while the update is not
+# complete, so that the next run resumes it instead of starting again:
+#   {"checksum": "3f2a...", "num_entries": 2000, "num_acked": 1800,
+#    "mem_used": 12, "num_newcard": 1790, "num_authmod": 3}
+# checksum identifies the table being sent (entries in order), num_acked
+# is the number of entries acknowledged from its start, mem_used the
+# commutator memory state before the update began and num_newcard,
+# num_authmod what the commutator reported for the acknowledged entries.
+
+def table_journal_filename(commutator_name):
+    return 'table_journal_' + commutator_name + '.json'
+
+def read_table_journal(filename):
+    # Returns None if there is no usable journal
+    if not os.path.exists(filename):
+        return None
+    try:
+        with open(filename, 'r') as journal_file:
+            journal = json.load(journal_file)
+        return {"checksum": str(journal["checksum"]),
+                "num_entries": int(journal["num_entries"]),
+                "num_acked": int(journal["num_acked"]),
+                "mem_used": int(journal["mem_used"]),
+                "num_newcard": int(journal["num_newcard"]),
+                "num_authmod": int(journal["num_authmod"])}
+    except (ValueError, KeyError, TypeError, AttributeError, IOError):
+        logging.warning("Table journal %s is unreadable, ignoring it.", filename)
+        return None
+
+def write_table_journal(filename, journal):
+    # Replace the file at once, a journal None removes it
+    if journal is None:
+        if os.path.exists(filename):
+            os.remove(filename)
+        return
+    temp_filename = filename + '.tmp'
+    with open(temp_filename, 'w') as journal_file:
+        json.dump(journal, journal_file, sort_keys=True)
+        journal_file.flush()
+        os.fsync(journal_file.fileno())
+    os.rename(temp_filename, filename)
@@ -0,0 +1,45 @@
+# coding: utf-8
+import json
+import os
+import logging
+
+# The shadow of a commutator table is what the server knows the commutator
+# holds after the last successful update:
+#   {"mem_used": 4, "cards": {"7040840B": True, "45555555": False, ...}}
+# mem_used is the commutator memory state right after that update, used to
+# detect a commutator that was cleared or updated by other means since.
+# With the table digest command, "digest" is the table digest the
+# commutator reported then, cards held outside the shadow included.
+
+def table_shadow_filename(commutator_name):
+    return 'table_shadow_' + commutator_name + '.json'
+
+def read_table_shadow(filename):
+    # Returns None if there is no usable shadow
+    if not os.path.exists(filename):
+        return None
+    try:
+        with open(filename, 'r') as shadow_file:
+            shadow = json.load(shadow_file)
+        result = {"mem_used": int(shadow["mem_used"]),
+                  "cards": dict((str(card), bool(auth))
+                                for card, auth in shadow["cards"].items())}
+        if "digest" in shadow:
+            result["digest"] = int(shadow["digest"])
+        return result
+    except (ValueError, KeyError, TypeError, AttributeError, IOError):
+        logging.warning("Table shadow %s is unreadable, ignoring it.", filename)
+        return None
+
+def write_table_shadow(filename, shadow):
+    # Replace the file at once, a shadow None removes it
+    if shadow is None:
+        if os.path.exists(filename):
+            os.remove(filename)
+        return
+    temp_filename = filename + '.tmp'
+    with open(temp_filename, 'w') as shadow_file:
+        json.dump(shadow, shadow_file, sort_keys=True)
+        shadow_file.flush()
+        os.fsync(shadow_file.fileno())
+    os.rename(temp_filename, filename)